@@ -0,0 +1,59 @@
+"""
+Compare two sets of benchmark results as written by run.py and report regressions.
+
+Usage:
+    compare.py [--threshold=PERCENT] <baseline> <candidate>
+
+Options:
+    --threshold=PERCENT     Percentage increase in wall time or peak memory which is reported
+                            as a regression. [default: 10]
+
+    <baseline>              JSON results for the baseline release.
+    <candidate>             JSON results for the candidate release.
+
+The exit status is 1 if any benchmark regressed by more than the threshold.
+
+"""
+import json
+import sys
+
+import docopt
+
+
+def main():
+    opts = docopt.docopt(__doc__)
+    threshold = float(opts['--threshold']) / 100.
+
+    with open(opts['<baseline>']) as f:
+        baseline = index_results(json.load(f))
+    with open(opts['<candidate>']) as f:
+        candidate = index_results(json.load(f))
+
+    regressed = False
+    print('{:<40} {:>10} {:>10} {:>8} {:>8}'.format(
+        'benchmark', 'base (s)', 'cand (s)', 'time', 'rss'))
+    for key in sorted(set(baseline) & set(candidate)):
+        old, new = baseline[key], candidate[key]
+        time_ratio = ratio(new['wall_time'], old['wall_time'])
+        rss_ratio = ratio(new['peak_rss_kb'], old['peak_rss_kb'])
+        flag = ''
+        if time_ratio > 1 + threshold or rss_ratio > 1 + threshold:
+            flag = ' REGRESSION'
+            regressed = True
+        print('{:<40} {:>10.3f} {:>10.3f} {:>+7.1f}% {:>+7.1f}%{}'.format(
+            '{} @ {}'.format(*key), old['wall_time'], new['wall_time'],
+            100 * (time_ratio - 1), 100 * (rss_ratio - 1), flag))
+
+    return 1 if regressed else 0
+
+
+def index_results(document):
+    return {(result['name'], result['scale']): result for result in document['results']}
+
+
+def ratio(new, old):
+    return new / old if old > 0 else 1.
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,245 @@
+"""
+Generate synthetic SMS CSV exports and jwplayer metadata snapshots for benchmarking.
+
+The generated data set for a scale of N contains:
+
+- a media CSV export with N media items, most of which have both a video and an audio clip,
+- a collection CSV export with one collection for every 100 media items,
+- a jwplayer video snapshot, as written by "sms2jwplayer fetch videos", where most media items
+  have a matching video, some of which are out of date, some of which are duplicated and some of
+  which have no corresponding media item,
+- a jwplayer channel snapshot, as written by "sms2jwplayer fetch channels", with a similar mix.
+
+Usage:
+    datagen.py [--seed=N] <scale> <directory>
+
+Options:
+    --seed=N        Seed for random number generator. [default: 0]
+
+    <scale>         Number of media items to generate.
+    <directory>     Directory to write data set to. It is created if it does not exist.
+
+"""
+import csv
+import datetime
+import json
+import os
+import random
+import sys
+
+import docopt
+
+from sms2jwplayer.genupdatejob import make_resource_for_video, make_resource_for_channel
+from sms2jwplayer import csv as smscsv
+
+#: Column headings of the media CSV export
+MEDIA_HEADERS = smscsv.MediaItem._fields
+
+#: Column headings of the collection CSV export
+COLLECTION_HEADERS = smscsv.CollectionItem._fields
+
+#: Number of resources per snapshot page, matching the page size used by fetch
+PAGE_SIZE = 1000
+
+#: Number of media items per collection
+COLLECTION_SIZE = 100
+
+#: Names of the files making up a data set
+MEDIA_CSV = 'media.csv'
+COLLECTION_CSV = 'collections.csv'
+VIDEOS_PREFIX = 'videos_'
+CHANNELS_PREFIX = 'channels_'
+
+WORDS = (
+    'lecture seminar introduction advanced quantum biology history law cambridge department '
+    'series part interview discussion research methods analysis theory practice'
+).split()
+
+
+def main():
+    opts = docopt.docopt(__doc__)
+    generate(int(opts['<scale>']), opts['<directory>'], seed=int(opts['--seed']))
+
+
+def generate(scale, directory, seed=0):
+    """
+    Generate a data set of *scale* media items in *directory*. Returns a dictionary giving the
+    paths of the generated files.
+
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    epoch = datetime.datetime(2008, 1, 1, tzinfo=datetime.timezone.utc)
+    media_ids_by_collection = {}
+    videos = []
+
+    with open(os.path.join(directory, MEDIA_CSV), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(MEDIA_HEADERS)
+        clip_id = 0
+        for media_id in range(1, scale + 1):
+            collection_id = 1 + (media_id - 1) // COLLECTION_SIZE
+            media_ids_by_collection.setdefault(collection_id, []).append(media_id)
+            created_at = epoch + datetime.timedelta(minutes=media_id)
+
+            # Most media items have both a video and an audio clip
+            formats = [smscsv.MediaFormat.VIDEO, smscsv.MediaFormat.AUDIO]
+            if rng.random() < 0.2:
+                formats = [rng.choice(formats)]
+
+            items = []
+            for format_ in formats:
+                clip_id += 1
+                has_image = rng.random() < 0.5
+                item = smscsv.MediaItem(
+                    media_id=media_id, clip_id=clip_id, format=format_,
+                    filename='/archive/{}/{}.mp4'.format(media_id, clip_id),
+                    created_at=created_at, title=sentence(rng, 4),
+                    description=sentence(rng, 20), collection_id=collection_id, instid='UIS',
+                    aspect_ratio='16x9', creator='spqr2', publisher='', copyright='',
+                    language='en', keywords=sentence(rng, 3), visibility='world', acl=[''],
+                    screencast=False, image_id=media_id if has_image else None,
+                    image_md5='{:032x}'.format(media_id) if has_image else '',
+                    featured=False, branding=False, last_updated_at=created_at,
+                    updated_by='spqr2', downloadable=False, withdrawn='',
+                    quality=smscsv.MediaQuality.HIGH,
+                )
+                items.append(item)
+                writer.writerow(media_row(item))
+
+            videos.extend(videos_for_media(rng, items))
+
+    # Some managed videos whose media item no longer exists and some unmanaged videos
+    for index in range(scale // 100):
+        videos.append({
+            'key': 'gone{:06d}'.format(index), 'mediatype': 'video',
+            'custom': {'sms_media_id': 'media:{}:'.format(scale + index + 1)},
+        })
+        videos.append({'key': 'unman{:06d}'.format(index), 'mediatype': 'video', 'custom': {}})
+    rng.shuffle(videos)
+
+    collections = []
+    with open(os.path.join(directory, COLLECTION_CSV), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLLECTION_HEADERS)
+        for collection_id, media_ids in sorted(media_ids_by_collection.items()):
+            created_at = epoch + datetime.timedelta(days=collection_id)
+            collection = smscsv.CollectionItem(
+                collection_id=collection_id, title=sentence(rng, 3),
+                description=sentence(rng, 10), website_url='', created_by='spqr2',
+                instid='UIS', groupid='', image_id=None, acl=[''], created_at=created_at,
+                last_updated_at=created_at, updated_by='spqr2',
+                media_ids=[str(media_id) for media_id in media_ids],
+            )
+            collections.append(collection)
+            writer.writerow(collection_row(collection))
+
+    channels = [channel for collection in collections
+                for channel in channels_for_collection(rng, collection)]
+
+    video_files = write_snapshot(directory, VIDEOS_PREFIX, 'videos', videos)
+    channel_files = write_snapshot(directory, CHANNELS_PREFIX, 'channels', channels)
+
+    return {
+        'media_csv': os.path.join(directory, MEDIA_CSV),
+        'collection_csv': os.path.join(directory, COLLECTION_CSV),
+        'videos': video_files,
+        'channels': channel_files,
+    }
+
+
+def videos_for_media(rng, items):
+    """
+    Return a list of jwplayer videos for a media item given its clips. Most media items have one
+    up to date video, some are out of date, some are duplicated and some have no video.
+
+    """
+    roll = rng.random()
+    if roll < 0.05:
+        return []
+
+    video = make_resource_for_video(items[0])
+    video.update({
+        'key': 'v{:07d}'.format(items[0].clip_id), 'updated': rng.randint(0, 1 << 30),
+        'mediatype': 'video' if items[0].format == smscsv.MediaFormat.VIDEO else 'audio',
+    })
+    if items[0].image_md5:
+        video['custom']['sms_image_status'] = rng.choice(['image_status:loaded:', ''])
+    if roll < 0.15:
+        video['title'] = 'out of date'
+    videos = [video]
+
+    if roll > 0.98 and len(items) > 1:
+        duplicate = dict(video, key='v{:07d}'.format(items[1].clip_id), mediatype='audio')
+        videos.append(duplicate)
+    return videos
+
+
+def channels_for_collection(rng, collection):
+    """Return a list of jwplayer channels for a collection, out of date in various ways."""
+    roll = rng.random()
+    if roll < 0.05:
+        return []
+
+    channel = make_resource_for_channel(collection)
+    media_ids = collection.media_ids
+    if roll < 0.2:
+        # Missing some media items
+        media_ids = media_ids[:len(media_ids) // 2]
+    channel['key'] = 'c{:07d}'.format(collection.collection_id)
+    channel['custom']['sms_media_ids'] = 'media_ids:{}:'.format(','.join(media_ids))
+    return [channel]
+
+
+def write_snapshot(directory, prefix, data_type, resources):
+    """Write resources in pages as "sms2jwplayer fetch" would. Return the list of paths."""
+    paths = []
+    for offset in range(0, len(resources), PAGE_SIZE):
+        page = resources[offset:offset+PAGE_SIZE]
+        path = os.path.join(directory, '{}{:06d}.json'.format(prefix, offset))
+        with open(path, 'w') as f:
+            json.dump({
+                'status': 'ok', data_type: page, 'offset': offset, 'limit': PAGE_SIZE,
+                'total': len(resources),
+            }, f)
+        paths.append(path)
+    return paths
+
+
+def media_row(item):
+    """Return the CSV export row for a media item."""
+    row = []
+    for name, value in zip(MEDIA_HEADERS, item):
+        row.append(csv_value(name, value))
+    return row
+
+
+def collection_row(collection):
+    """Return the CSV export row for a collection."""
+    row = []
+    for name, value in zip(COLLECTION_HEADERS, collection):
+        row.append(csv_value(name, value))
+    return row
+
+
+def csv_value(name, value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (smscsv.MediaFormat, smscsv.MediaQuality)):
+        return value.value
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, list):
+        return ','.join(value)
+    return str(value)
+
+
+def sentence(rng, n_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+"""
+End-to-end benchmarks for the sms2jwplayer synchronisation pipeline.
+
+Each benchmark is run in a fresh process against a synthetic data set generated by
+:py:mod:`datagen`. Wall time, peak resident set size and throughput in rows per second are
+recorded for the timed portion of each benchmark and written as a JSON document suitable for
+comparing releases with compare.py.
+
+Usage:
+    run.py [--scale=N]... [--benchmark=NAME]... [--data-dir=DIR] [--output=FILE]
+        [--apply-limit=N] [--latency=SECONDS] [--seed=N]
+    run.py --list
+
+Options:
+    --scale=N           Number of media items in the synthetic data set. Suffixes "k" and "M"
+                        are accepted. May be repeated. [default: 10k]
+    --benchmark=NAME    Only run the named benchmark. May be repeated.
+    --data-dir=DIR      Directory to cache generated data sets in. If omitted, a temporary
+                        directory is used.
+    --output=FILE       Write JSON results to FILE. If omitted, use stdout.
+    --apply-limit=N     Maximum number of jobs to apply in the applyupdatejob benchmark.
+                        [default: 200]
+    --latency=SECONDS   Latency of the fake JWPlatform API. [default: 0]
+    --seed=N            Seed for the data set generator. [default: 0]
+    --list              List available benchmarks.
+
+"""
+import concurrent.futures
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import docopt
+
+import datagen
+
+#: Benchmark functions keyed by name. Each takes a data set and a dictionary of options and
+#: returns a (rows, callable) pair. The callable is the timed portion of the benchmark.
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def load_media_items(dataset):
+    from sms2jwplayer import csv as smscsv
+    with open(dataset['media_csv']) as f:
+        return smscsv.load(smscsv.MediaItem, f)
+
+
+def load_collections(dataset):
+    from sms2jwplayer import csv as smscsv
+    with open(dataset['collection_csv']) as f:
+        return smscsv.load(smscsv.CollectionItem, f)
+
+
+def load_metadata(paths, data_type):
+    resources = []
+    for path in paths:
+        with open(path) as f:
+            resources.extend(json.load(f).get(data_type, []))
+    return resources
+
+
+def genupdatejob_opts():
+    return {
+        '--strip-leading': '0', '--base': 'https://sms.example.com/',
+        '--base-image-url': 'https://sms.example.com/image/',
+    }
+
+
+@benchmark
+def bench_csv_load(dataset, opts):
+    from sms2jwplayer import csv as smscsv
+
+    with open(dataset['media_csv']) as f:
+        rows = sum(1 for _ in f) - 1
+
+    def run():
+        with open(dataset['media_csv']) as f:
+            smscsv.load(smscsv.MediaItem, f)
+    return rows, run
+
+
+@benchmark
+def bench_choose_media_format(dataset, opts):
+    from sms2jwplayer import genupdatejob
+    items = load_media_items(dataset)
+    return len(items), lambda: genupdatejob.choose_media_format(items)
+
+
+@benchmark
+def bench_genupdatejob_videos(dataset, opts):
+    from sms2jwplayer import genupdatejob
+    items = load_media_items(dataset)
+    videos = load_metadata(dataset['videos'], 'videos')
+    return len(items) + len(videos), lambda: genupdatejob.process_videos(
+        genupdatejob_opts(), io.StringIO(), items, videos)
+
+
+@benchmark
+def bench_genupdatejob_channels(dataset, opts):
+    from sms2jwplayer import genupdatejob
+    collections = load_collections(dataset)
+    channels = load_metadata(dataset['channels'], 'channels')
+    return len(collections) + len(channels), lambda: genupdatejob.process_channels(
+        {}, io.StringIO(), collections, channels)
+
+
+@benchmark
+def bench_genupdatejob_videos_in_channels(dataset, opts):
+    from sms2jwplayer import genupdatejob
+    collections = load_collections(dataset)
+    channels = load_metadata(dataset['channels'], 'channels')
+    return len(collections) + len(channels), lambda: genupdatejob.process_videos_in_channels(
+        {}, io.StringIO(), collections, channels)
+
+
+@benchmark
+def bench_tidy(dataset, opts):
+    from sms2jwplayer import tidy
+    videos = load_metadata(dataset['videos'], 'videos')
+    return len(videos), lambda: tidy.write_delete_job(io.StringIO(), tidy.duplicate_deletes(
+        videos, 'videos', 'media', rank=tidy.video_rank))
+
+
+@benchmark
+def bench_applyupdatejob(dataset, opts):
+    from unittest import mock
+    import sms2jwplayer
+    from sms2jwplayer import applyupdatejob, genupdatejob
+    from sms2jwplayer.test import fakeapi
+
+    items = load_media_items(dataset)
+    videos = load_metadata(dataset['videos'], 'videos')
+    job_fobj = io.StringIO()
+    genupdatejob.process_videos(genupdatejob_opts(), job_fobj, items, videos)
+    jobs = json.loads(job_fobj.getvalue())
+
+    # Only apply metadata updates and creates. Thumbnail jobs would try to fetch images.
+    limit = int(opts['--apply-limit'])
+    updates = [job for job in jobs['update'] if job['type'] == 'videos'][:limit]
+    creates = jobs['create'][:max(0, limit - len(updates))]
+    job_fn = os.path.join(tempfile.mkdtemp(), 'job.json')
+    with open(job_fn, 'w') as f:
+        json.dump({'update': updates, 'create': creates}, f)
+
+    platform = fakeapi.FakeJWPlatform()
+    platform.load_metadata({'videos': videos})
+
+    def run():
+        with fakeapi.running_server(platform=platform, latency=float(opts['--latency'])) as s:
+            environ = {
+                'JWPLAYER_API_KEY': 'key', 'JWPLAYER_API_SECRET': 'secret',
+                'JWPLAYER_API_URL': s.url,
+            }
+            with mock.patch.dict(os.environ, environ):
+                applyupdatejob.main(
+                    docopt.docopt(sms2jwplayer.__doc__, argv=['applyupdatejob', job_fn]))
+    return len(updates) + len(creates), run
+
+
+def run_benchmark(name, dataset, opts):
+    """Run a single benchmark. Intended to be called in a fresh process."""
+    rows, func = BENCHMARKS[name](dataset, opts)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    func()
+    wall_time = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'name': name, 'rows': rows, 'wall_time': wall_time,
+        'rows_per_second': rows / wall_time if wall_time > 0 else None,
+        'peak_rss_kb': peak_rss, 'setup_peak_rss_kb': rss_before,
+    }
+
+
+def parse_scale(scale):
+    multipliers = {'k': 1000, 'M': 1000000}
+    if scale[-1] in multipliers:
+        return int(scale[:-1]) * multipliers[scale[-1]]
+    return int(scale)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    opts = docopt.docopt(__doc__)
+    if opts['--list']:
+        for name in sorted(BENCHMARKS):
+            print(name)
+        return
+
+    names = opts['--benchmark'] or sorted(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if len(unknown) > 0:
+        print('Unknown benchmark(s): ' + ', '.join(sorted(unknown)), file=sys.stderr)
+        return 1
+
+    data_dir = opts['--data-dir'] or tempfile.mkdtemp(prefix='sms2jwplayer-bench-')
+    context = multiprocessing.get_context('spawn')
+
+    results = []
+    for scale in (parse_scale(scale) for scale in opts['--scale']):
+        print('Generating data set with scale {}'.format(scale), file=sys.stderr)
+        dataset = datagen.generate(
+            scale, os.path.join(data_dir, str(scale)), seed=int(opts['--seed']))
+
+        for name in names:
+            # Each benchmark runs in a fresh process so peak memory is measured independently
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                result = executor.submit(run_benchmark, name, dataset, opts).result()
+            result['scale'] = scale
+            print('{name} @ {scale}: {wall_time:.3f}s, {peak_rss_kb} KiB'.format(**result),
+                  file=sys.stderr)
+            results.append(result)
+
+    document = {
+        'revision': git_revision(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+    if opts['--output'] is None:
+        json.dump(document, sys.stdout, indent=2)
+    else:
+        with open(opts['--output'], 'w') as f:
+            json.dump(document, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
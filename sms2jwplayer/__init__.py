@@ -3,14 +3,44 @@ Tool to support bulk import of University of Cambridge SMS into JWPlayer.
 
 Usage:
     sms2jwplayer (-h | --help)
-    sms2jwplayer fetch (videos|channels) [--verbose] [--base-name=NAME]
+    sms2jwplayer fetch (videos|channels) [--verbose] [--base-name=NAME] [--snapshot=FILE]
+        [--metrics-textfile=FILE] [--metrics-json=FILE] [--profile=FILE] [--profile-mode=MODE]
+        [--trace-stages]
     sms2jwplayer genupdatejob videos [--verbose] [--strip-leading=N]
-        [--output=FILE] --base=URL --base-image-url=URL <csv> <metadata>...
-    sms2jwplayer genupdatejob channels [--verbose] [--output=FILE] <csv> <metadata>...
-    sms2jwplayer genupdatejob videos_in_channels [--verbose] [--output=FILE] <csv> <metadata>...
-    sms2jwplayer applyupdatejob [--verbose] [--log-file=FILE] [<update>]
-    sms2jwplayer analytics [--output=FILE] [--verbose] <date>
-    sms2jwplayer tidy [--output=FILE] [--verbose] <metadata>...
+        [--output=FILE] --base=URL --base-image-url=URL [--profile=FILE] [--profile-mode=MODE]
+        [--trace-stages] [--merge-join] [--unmatched-report=FILE] [--delete-unmatched]
+        [--max-deletes=N] <csv> (--snapshot=FILE | <metadata>...)
+    sms2jwplayer genupdatejob channels [--verbose] [--output=FILE] [--profile=FILE]
+        [--profile-mode=MODE] [--trace-stages] [--merge-join] [--unmatched-report=FILE]
+        [--delete-unmatched] [--max-deletes=N] <csv> (--snapshot=FILE | <metadata>...)
+    sms2jwplayer genupdatejob videos_in_channels [--verbose] [--output=FILE] [--profile=FILE]
+        [--profile-mode=MODE] [--trace-stages] [--merge-join] [--unmatched-report=FILE]
+        <csv> (--snapshot=FILE | <metadata>...)
+    sms2jwplayer applyupdatejob [--verbose] [--log-file=FILE] [--snapshot=FILE]
+        [--delete-batch=N] [--delete-jobs=N] [--upload-jobs=N] [--image-cache=DIR]
+        [--image-cache-size=MB] [--image-check-polls=N] [--time-budget=SECONDS]
+        [--deferred=FILE] [--error-budget=N] [--shard=I/N] [--journal=FILE] [--verify]
+        [--metrics-textfile=FILE] [--metrics-json=FILE] [--profile=FILE] [--profile-mode=MODE]
+        [--trace-stages] [<update>]
+    sms2jwplayer analytics [--output=FILE] [--verbose] [--snapshot=FILE] [--cache=FILE]
+        [--cache-ttl=DAYS] [--cache-size=N] [--jobs=N] [--page-length=N]
+        [--rollup-dir=DIR] [--metrics-textfile=FILE] [--metrics-json=FILE] [--profile=FILE]
+        [--profile-mode=MODE] [--trace-stages] <date>
+    sms2jwplayer analytics --from=DATE --to=DATE [--output-dir=DIR] [--verbose]
+        [--snapshot=FILE] [--cache=FILE] [--cache-ttl=DAYS] [--cache-size=N] [--jobs=N]
+        [--page-length=N] [--rollup-dir=DIR] [--metrics-textfile=FILE] [--metrics-json=FILE]
+        [--profile=FILE] [--profile-mode=MODE] [--trace-stages]
+    sms2jwplayer mergejobs [--verbose] [--output=FILE] [--profile=FILE] [--profile-mode=MODE]
+        [--trace-stages] <job>...
+    sms2jwplayer mergelogs [--verbose] [--output=FILE] [--profile=FILE] [--profile-mode=MODE]
+        [--trace-stages] <log>...
+    sms2jwplayer tidy [--output=FILE] [--verbose] [--delete-orphans] [--max-deletes=N]
+        [--profile=FILE] [--profile-mode=MODE] [--trace-stages]
+        (--snapshot=FILE | <metadata>...)
+    sms2jwplayer sync [--verbose] [--strip-leading=N] --base=URL --base-image-url=URL
+        [--checkpoint-dir=DIR] [--log-file=FILE] [--metrics-textfile=FILE]
+        [--metrics-json=FILE] [--profile=FILE] [--profile-mode=MODE] [--trace-stages]
+        <media_csv> <collection_csv>
 
 Options:
     -h, --help          Show a brief usage summary.
@@ -21,8 +51,20 @@ Options:
                         endpoint.
     <update>            JSON file specifying update jobs as returned from genupdatejob. If omitted,
                         use stdin.
+    <job>               JSON file specifying jobs as returned from genupdatejob or tidy.
+    <log>               Log or journal file written by applyupdatejob.
 
     <date>              Date in YYYY-MM-DD format.
+    --from=DATE         First date in YYYY-MM-DD format of a range of dates.
+    --to=DATE           Last date in YYYY-MM-DD format of a range of dates.
+    --output-dir=DIR    Directory to write one CSV file per date to. [default: .]
+    --jobs=N            Maximum number of concurrent analytics requests. [default: 4]
+    --page-length=N     Number of rows in each page of analytics requested. [default: 1000]
+    --rollup-dir=DIR    Directory to additionally write total hits per media item, collection,
+                        institution and country to.
+
+    <media_csv>         CSV export of media items from SMS.
+    <collection_csv>    CSV export of collections from SMS.
 
     (videos|channels)   Type of list to retrieve
 
@@ -36,6 +78,67 @@ Options:
     --base-name=NAME    Base of filename used to save results to.
                         [default: videos_]
 
+    --snapshot=FILE     SQLite snapshot store of jwplayer metadata. The fetch command stores
+                        results in it instead of JSON files and other commands read metadata
+                        from it. Stale entries are only used where safe and otherwise jwplayer
+                        is queried directly.
+
+    --merge-join        Sort the SMS export and jwplayer metadata on SMS id, spilling to
+                        temporary files if need be, and match them in a single streaming pass
+                        so that memory use is bounded for very large libraries.
+    --unmatched-report=FILE     Write the key and SMS id of each jwplayer resource whose SMS id
+                                is not in the export to FILE as CSV.
+    --delete-unmatched  Also generate jobs to delete jwplayer resources whose SMS id is not in
+                        the export.
+    --max-deletes=N     Generate no delete jobs if there would be more than N. For genupdatejob
+                        the default is 100. For tidy there is no limit by default.
+
+    --checkpoint-dir=DIR    Directory to write fetched metadata and generated jobs to.
+
+    --delete-orphans    Also delete videos and channels which have no SMS id but which have
+                        other SMS custom properties and so were created by sms2jwplayer.
+
+    --metrics-textfile=FILE     Write metrics on jwplayer API calls to FILE in the Prometheus
+                                text format when the command exits.
+    --metrics-json=FILE         Write a JSON summary of metrics on jwplayer API calls to FILE
+                                when the command exits.
+
+    --profile=FILE      Profile the command and write the profile to FILE.
+    --profile-mode=MODE         Either "deterministic", which profiles every function call with
+                                cProfile and writes pstats output, or "sampling", which samples
+                                the stacks of all threads and writes folded stacks suitable for
+                                flame graphs. [default: deterministic]
+    --trace-stages      Log the wall time and peak memory use of each stage of the command.
+
+    --delete-batch=N    Maximum number of videos deleted by each API call. [default: 1]
+    --delete-jobs=N     Number of concurrent workers making delete API calls. [default: 1]
+    --upload-jobs=N     Number of thumbnails uploaded or checked concurrently. [default: 1]
+    --image-cache=DIR   Directory in which to cache thumbnails so that each distinct image is
+                        downloaded from SMS once.
+    --image-cache-size=MB   Maximum size of the thumbnail cache in megabytes. Larger thumbnails
+                        are not downloaded. [default: 1024]
+    --image-check-polls=N   Maximum number of times the status of a thumbnail which is still
+                        being processed is polled. [default: 1]
+    --time-budget=SECONDS   Do not start any more jobs once SECONDS have passed. Jobs are
+                        started in order of priority: access control changes, creates, other
+                        updates, channel membership, deletes and then thumbnail jobs.
+    --error-budget=N    Do not start any more jobs once N jobs have failed.
+    --deferred=FILE     Write the jobs which were not started within the time or error budget
+                        to FILE as a job description for a later run.
+    --shard=I/N         Only apply the jobs in shard I of N, counting from 0. Jobs changing the
+                        same resource are always in the same shard so that N processes or hosts
+                        may apply a job description in parallel.
+    --journal=FILE      Append each response to FILE as soon as it is received.
+    --verify            Fetch the current state of updated videos and channels before applying
+                        updates and only write properties which still differ.
+                        Resources fetched into --snapshot in the last few minutes are used as
+                        they are.
+
+    --cache=FILE        Persistent cache of video metadata used by analytics to avoid fetching
+                        the same videos from jwplayer on every run.
+    --cache-ttl=DAYS    Number of days after which cached video metadata expires. [default: 30]
+    --cache-size=N      Maximum number of videos in the metadata cache. [default: 1000000]
+
     --limit=NUMBER      Limit feed to last NUMBER most updated videos. [default: 1000]
     --offset=NUMBER     Start feed at NUMBER-th most recently updated. This index is 0-based
                         [default: 0]
@@ -52,8 +155,14 @@ Sub commands:
                                      channels to match SMS.
     applyupdatejob                   Use JWPlatform API to update jwplayer data based on a job
                                      description file.
+    mergejobs                        Combine job description files into a single file with
+                                     duplicate and conflicting jobs merged.
+    mergelogs                        Combine log files from several applyupdatejob runs,
+                                     e.g. one per shard, into a single log file.
     analytics                        Generate SMS analytics for a given day.
     tidy                             Generate an update job which tidies the jwplayer database.
+    sync                             Fetch, generate and apply update jobs for videos, channels
+                                     and videos in channels in a single process.
 
 """
 import logging
@@ -63,6 +172,42 @@ import docopt
 def main():
     opts = docopt.docopt(__doc__)
     logging.basicConfig(level=logging.INFO if opts['--verbose'] else logging.WARN)
+
+    if opts['--trace-stages']:
+        from . import profiling
+        profiling.enable_stage_tracing()
+
+    if opts['--profile'] is not None:
+        from . import profiling
+        with profiling.profile(opts['--profile'], mode=opts['--profile-mode']):
+            run_command_with_metrics(opts)
+    else:
+        run_command_with_metrics(opts)
+
+
+def run_command_with_metrics(opts):
+    """
+    Run the subcommand selected by the docopt options dictionary *opts* and export metrics if
+    requested.
+
+    """
+    if opts['--metrics-textfile'] is None and opts['--metrics-json'] is None:
+        run_command(opts)
+        return
+
+    from . import metrics
+    metrics.REGISTRY.enabled = True
+    try:
+        run_command(opts)
+    finally:
+        if opts['--metrics-textfile'] is not None:
+            metrics.REGISTRY.write_textfile(opts['--metrics-textfile'])
+        if opts['--metrics-json'] is not None:
+            metrics.REGISTRY.write_json(opts['--metrics-json'])
+
+
+def run_command(opts):
+    """Run the subcommand selected by the docopt options dictionary *opts*."""
     if opts['fetch']:
         from . import fetch
         fetch.main(opts)
@@ -75,6 +220,15 @@ def main():
     elif opts['analytics']:
         from . import analytics
         analytics.main(opts)
+    elif opts['mergejobs']:
+        from . import mergejobs
+        mergejobs.main(opts)
+    elif opts['mergelogs']:
+        from . import mergelogs
+        mergelogs.main(opts)
     elif opts['tidy']:
         from . import tidy
         tidy.main(opts)
+    elif opts['sync']:
+        from . import sync
+        sync.main(opts)
@@ -4,6 +4,15 @@ jwplayer.
 
 The JWPLAYER_API_KEY and JWPLAYER_API_ANALYTICS_SECRET environment variables must be set.
 
+Analytics may be generated for a single day or for a range of days. In the latter case, one CSV
+file per day is written to the output directory. Days and pages of results within each day are
+fetched concurrently.
+
+If a rollup directory is given, the total number of hits for each day is also written to it per
+media item, collection, institution and country. The rollups are computed as the analytics are
+written and are named <date>-<field>.csv where <field> is one of the ROLLUP_FIELDS. Each has the
+headers <field> and num_hits.
+
 Output CSV headers:
 
     - clip_id
@@ -25,18 +34,21 @@ Output CSV headers:
 
 """
 import collections
+import concurrent.futures
 import csv
 import datetime
 import itertools
 import logging
 import os
+import threading
 import time
 import sys
 
 import requests
 import tqdm
 
-from .util import get_jwplatform_client, JWPlatformClientError
+from . import metrics
+from .util import get_jwplatform_client, get_v2_api_url, JWPlatformClientError
 from jwplatform.errors import JWPlatformRateLimitExceededError, JWPlatformNotFoundError
 
 LOG = logging.getLogger()
@@ -49,9 +61,35 @@ HEADERS = [
 #: Maximum number of attempts on an API call before giving up
 MAX_ATTEMPTS = 10
 
+#: Default number of rows requested in each page of analytics
+DEFAULT_PAGE_LENGTH = 1000
+
+#: Maximum number of rows buffered by write_output while their videos are resolved
+RESOLVE_BATCH_SIZE = 1000
+
+#: HTTP status codes from the analytics API which cause the request to be retried
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+#: Minimum and maximum delay in seconds between retries of analytics requests
+MIN_RETRY_DELAY = 1.
+MAX_RETRY_DELAY = 60.
+
+#: Timeout in seconds for analytics requests
+REQUEST_TIMEOUT = 120
+
+#: Endpoint name under which analytics requests are recorded in the metrics
+ANALYTICS_ENDPOINT = 'v2/analytics/queries'
+
 #: Map from jwplatform mediatype to SMS format
 FORMAT_MAP = {'video': 'mp4', 'audio': 'mp3'}
 
+#: Custom props of a video which are used to generate output rows and are persisted in the
+#: video metadata cache
+CACHED_CUSTOM_PROPS = ('sms_clip_id', 'sms_media_id', 'sms_collection_id', 'sms_instid')
+
+#: Output fields for which total hits are written by --rollup-dir
+ROLLUP_FIELDS = ('media_id', 'collection_id', 'instid', 'country')
+
 AnalyticsRow = collections.namedtuple('AnalyticsRow', 'media_id country_code plays')
 OutputRow = collections.namedtuple('OutputRow', HEADERS)
 
@@ -73,113 +111,348 @@ def main(opts):
         LOG.error('JWPLAYER_API_ANALYTICS_SECRET environment variable not set')
         sys.exit(1)
 
-    target_date = datetime.datetime.strptime(opts['<date>'], '%Y-%m-%d').date().isoformat()
-
-    rows = []
-    for page in itertools.count():
-        LOG.info('Fetching page index: %s', page)
-
-        # Get next page of analytics
-        response = get_analytics(api_key, api_secret, {
-            'start_date': target_date,
-            'end_date': target_date,
-            'metrics': [{
-                'operation': 'sum',
-                'field': 'plays',
-            }],
-            'dimensions': ['media_id', 'country_code'],
-            'sort': [{'field': 'plays', 'order': 'DESCENDING'}],
-            'page': page,
-            'page_length': 100,
-        })
-
-        # If we get no results, we're done
-        n_rows = len(response['data']['rows'])
-        if n_rows == 0:
-            LOG.info('No rows returned, we are done')
-            break
-
-        # Otherwise parse rows
-        LOG.info('Rows returned: %s', n_rows)
-        column_headers = response['metadata']['column_headers']
-        headings = column_headers['dimensions'] + column_headers['metrics']
-        rows.extend([
-            AnalyticsRow(**{
-                dimension['field']: datum
-                for dimension, datum in zip(headings, row)
+    snapshot = None
+    if opts.get('--snapshot') is not None:
+        from .snapshot import SnapshotStore
+        snapshot = SnapshotStore(opts['--snapshot'])
+
+    cache = None
+    if opts.get('--cache') is not None:
+        from .cache import PersistentCache
+        cache = PersistentCache(
+            opts['--cache'], ttl=float(opts['--cache-ttl']) * 24 * 60 * 60,
+            max_entries=int(opts['--cache-size']))
+
+    resolver = VideoResolver(client, snapshot, cache)
+
+    n_jobs = int(opts['--jobs'])
+    page_length = int(opts['--page-length'])
+
+    # Pages are fetched by a dedicated pool so that days waiting on their pages cannot starve the
+    # pool of workers.
+    with concurrent.futures.ThreadPoolExecutor(n_jobs) as page_executor:
+        def write_day(target_date, fobj):
+            rows = fetch_rows(
+                api_key, api_secret, target_date, page_executor, page_length=page_length,
+                window=n_jobs)
+
+            # If verbose flag is present, give a nice progress bar
+            if opts['--verbose']:
+                rows = tqdm.tqdm(rows, desc=target_date, unit='row')
+
+            rollups = Rollups() if opts.get('--rollup-dir') is not None else None
+            write_output(fobj, resolver, rows, rollups=rollups)
+
+            if rollups is not None:
+                os.makedirs(opts['--rollup-dir'], exist_ok=True)
+                rollups.write(os.path.join(opts['--rollup-dir'], target_date))
+
+        if opts['<date>'] is not None:
+            target_date = parse_date(opts['<date>'])
+            if opts['--output'] is not None and opts['--output'] != '-':
+                with open(opts['--output'], 'w') as fobj:
+                    write_day(target_date, fobj)
+            else:
+                write_day(target_date, sys.stdout)
+        else:
+            output_dir = opts['--output-dir']
+            os.makedirs(output_dir, exist_ok=True)
+
+            def write_day_file(target_date):
+                out_pn = os.path.join(output_dir, target_date + '.csv')
+                LOG.info('Writing analytics for %s to %s', target_date, out_pn)
+                with open(out_pn, 'w') as fobj:
+                    write_day(target_date, fobj)
+
+            dates = date_range(parse_date(opts['--from']), parse_date(opts['--to']))
+            with concurrent.futures.ThreadPoolExecutor(n_jobs) as day_executor:
+                for future in [day_executor.submit(write_day_file, d) for d in dates]:
+                    future.result()
+
+    if cache is not None:
+        LOG.info('Video metadata cache hits: %s, misses: %s', cache.hits, cache.misses)
+        cache.close()
+
+
+def parse_date(date):
+    """Parse a YYYY-MM-DD date and return it in ISO format."""
+    return datetime.datetime.strptime(date, '%Y-%m-%d').date().isoformat()
+
+
+def date_range(from_date, to_date):
+    """Return a list of ISO format dates from *from_date* to *to_date* inclusive."""
+    start = datetime.date.fromisoformat(from_date)
+    end = datetime.date.fromisoformat(to_date)
+    return [(start + datetime.timedelta(days=n)).isoformat()
+            for n in range((end - start).days + 1)]
+
+
+def fetch_rows(api_key, api_secret, target_date, executor, page_length=DEFAULT_PAGE_LENGTH,
+               window=1):
+    """
+    A generator which yields an :py:class:`.AnalyticsRow` for each (video, country) pair with
+    plays on *target_date*. Pages of results are fetched using *executor*, up to *window* pages
+    at a time, and rows are yielded in page order.
+
+    """
+    for first_page in itertools.count(0, window):
+        LOG.info('Fetching %s page indices: %s to %s', target_date, first_page,
+                 first_page + window - 1)
+        futures = [
+            executor.submit(get_analytics, api_key, api_secret, {
+                'start_date': target_date,
+                'end_date': target_date,
+                'metrics': [{
+                    'operation': 'sum',
+                    'field': 'plays',
+                }],
+                'dimensions': ['media_id', 'country_code'],
+                'sort': [{'field': 'plays', 'order': 'DESCENDING'}],
+                'page': page,
+                'page_length': page_length,
             })
-            for row in response['data']['rows']
-        ])
-
-    LOG.info('Got analytics for %s video(s)', len(rows))
-
-    # If verbose flag is present, give a nice progress bar
-    if opts['--verbose']:
-        rows_iterable = tqdm.tqdm(rows)
-    else:
-        rows_iterable = rows
-
-    if opts['--output'] is not None and opts['--output'] != '-':
-        with open(opts['--output'], 'w') as fobj:
-            write_output(fobj, client, rows_iterable)
-    else:
-        write_output(sys.stdout, client, rows_iterable)
-
-
-def write_output(fobj, client, rows_iterable):
+            for page in range(first_page, first_page + window)
+        ]
+
+        for future in futures:
+            response = future.result()
+            n_rows = len(response['data']['rows'])
+
+            # An empty page means we're done. A short page does not since the API may return
+            # fewer rows per page than were asked for.
+            if n_rows == 0:
+                LOG.info('No rows returned for %s, we are done', target_date)
+                for future in futures:
+                    future.cancel()
+                return
+
+            LOG.info('Rows returned for %s: %s', target_date, n_rows)
+
+            column_headers = response['metadata']['column_headers']
+            headings = column_headers['dimensions'] + column_headers['metrics']
+            for row in response['data']['rows']:
+                yield AnalyticsRow(**{
+                    dimension['field']: datum
+                    for dimension, datum in zip(headings, row)
+                })
+
+
+def write_output(fobj, resolver, rows_iterable, batch_size=RESOLVE_BATCH_SIZE, rollups=None):
+    """
+    Write a CSV row to *fobj* for each :py:class:`.AnalyticsRow` in *rows_iterable*. Video
+    metadata is looked up via *resolver*, a :py:class:`.VideoResolver`, once for each distinct
+    video. Rows whose video cannot be found are skipped. If *rollups* is not ``None``, each
+    output row is also added to it.
+
+    Rows are consumed from *rows_iterable* and written as they arrive, at most *batch_size* rows
+    at a time, so that output starts immediately and memory use does not depend on the number of
+    rows. Videos are resolved for each batch together.
+
+    """
     csv_writer = csv.writer(fobj)
     csv_writer.writerow(HEADERS)
 
-    LOG.info('Fetching video metadata')
+    rows_iterable = iter(rows_iterable)
+    n_rows = 0
+    while True:
+        rows = list(itertools.islice(rows_iterable, batch_size))
+        if len(rows) == 0:
+            break
+        n_rows += len(rows)
+
+        videos = resolver.resolve(row.media_id for row in rows)
+        for row in rows:
+            video = videos.get(row.media_id)
+            if video is None:
+                continue
+            output_row = make_output_row(row, video)
+            csv_writer.writerow(output_row)
+            if rollups is not None:
+                rollups.add(output_row)
+
+    LOG.info('Got analytics for %s video(s)', n_rows)
+
+
+class VideoResolver:
+    """
+    Resolves jwplayer video keys to video resources. Each key is looked up at most once. Keys are
+    looked up in *snapshot*, a :py:class:`~sms2jwplayer.snapshot.SnapshotStore`, and then in
+    *cache*, a :py:class:`~sms2jwplayer.cache.PersistentCache`, if they are not ``None``. Any
+    remaining keys are fetched from JWPlatform via *client* and stored in the cache.
+
+    Videos from the cache only include the properties returned by :py:func:`.trim_video`.
+
+    """
+    def __init__(self, client, snapshot=None, cache=None):
+        self.client = client
+        self.snapshot = snapshot
+        self.cache = cache
+
+        #: Number of videos.show calls made
+        self.api_calls = 0
+
+        # Map from key to video resource or None if the video could not be found
+        self._videos = {}
+
+        # delay between calls to not hit rate limit
+        self._delay = 0.1  # seconds
+
+        # Lock held while resolving so that concurrent callers do not fetch the same video
+        self._lock = threading.Lock()
+
+    def resolve(self, keys):
+        """
+        Return a dictionary mapping each key in *keys* to the corresponding video resource.
+        Keys whose video could not be found are omitted. This method may be called from
+        multiple threads.
+
+        """
+        with self._lock:
+            return self._resolve(set(keys))
+
+    def _resolve(self, keys):
+        missing = keys - set(self._videos)
+
+        if self.snapshot is not None and len(missing) > 0:
+            found = self.snapshot.by_keys('videos', missing)
+            LOG.info('Found %s of %s video(s) in snapshot', len(found), len(missing))
+            self._videos.update(found)
+            missing -= set(found)
+
+        if self.cache is not None and len(missing) > 0:
+            found = self.cache.get_many(missing)
+            LOG.info('Found %s of %s video(s) in cache', len(found), len(missing))
+            self._videos.update(found)
+            missing -= set(found)
+
+        LOG.info('Fetching %s video(s) from JWPlatform', len(missing))
+        for key in sorted(missing):
+            self._videos[key] = self._fetch(key)
+
+        if self.cache is not None and len(missing) > 0:
+            self.cache.put_many({
+                key: trim_video(self._videos[key]) for key in missing
+                if self._videos[key] is not None
+            })
 
-    # delay between calls to not hit rate limit
-    delay = 0.1  # seconds
+        return {key: self._videos[key] for key in keys if self._videos[key] is not None}
 
-    for row in rows_iterable:
+    def _fetch(self, key):
+        """Fetch a single video from JWPlatform, returning None if it could not be found."""
         for _ in range(MAX_ATTEMPTS):
             try:
+                self.api_calls += 1
                 try:
-                    response = client.videos.show(video_key=row.media_id)
+                    response = self.client.videos.show(video_key=key)
                 except JWPlatformNotFoundError:
                     # the video could have been deleted
-                    break
-
-                if not response.get('status') == 'ok':
-                    break
-
-                # extract custom properties
-                video = response.get('video', {})
-                custom = video.get('custom', {})
-
-                # get metadata for video
-                metadata = {
-                    'clip_id': custom.get('sms_clip_id', 'clip::').split(':')[1],
-                    'media_id': custom.get('sms_media_id', 'media::').split(':')[1],
-                    'collection_id': custom.get('sms_collection_id', 'collection::').split(':')[1],
-                    'format': FORMAT_MAP.get(video.get('mediatype'), ''),
-                    'country': row.country_code,
-                }
-
-                csv_writer.writerow(OutputRow(
-                    ip_addr='127.0.0.1',
-                    is_rtsp='f', is_itunes='f',
-                    instid='', quality='high', fetch_type='stream',
-                    lat='0', long='0', is_cam='f',
-                    num_hits=row.plays, num_bytes=0,
-                    **metadata
-                ))
+                    return None
 
                 # On a successful call, slightly shorten the delay
-                delay = max(1e-2, min(2., delay * 0.8))
-                time.sleep(delay)
-                break
+                self._delay = max(1e-2, min(2., self._delay * 0.8))
+                metrics.REGISTRY.sleep(self._delay)
+
+                if not response.get('status') == 'ok':
+                    return None
+                return response.get('video', {})
             except JWPlatformRateLimitExceededError:
-                delay = max(1e-2, min(2., 2. * delay))
+                metrics.REGISTRY.record_retry('rate_limit')
+                self._delay = max(1e-2, min(2., 2. * self._delay))
+                metrics.REGISTRY.sleep(self._delay)
+        return None
+
+
+def trim_video(video):
+    """Return a copy of *video* with only the properties used by :py:func:`.make_output_row`."""
+    custom = video.get('custom', {})
+    return {
+        'key': video.get('key'), 'mediatype': video.get('mediatype'),
+        'custom': {name: custom[name] for name in CACHED_CUSTOM_PROPS if name in custom},
+    }
+
+
+class Rollups:
+    """
+    Total hits of :py:class:`.OutputRow` instances for each value of the fields in
+    :py:data:`.ROLLUP_FIELDS`.
+
+    """
+    def __init__(self):
+        #: Dictionary mapping each field name to a Counter of hits per value of that field
+        self.counters = {field: collections.Counter() for field in ROLLUP_FIELDS}
+
+    def add(self, output_row):
+        """Add the hits from *output_row* to the totals."""
+        hits = int(output_row.num_hits)
+        for field, counter in self.counters.items():
+            counter[getattr(output_row, field)] += hits
+
+    def write(self, prefix):
+        """
+        Write one CSV file per field named <prefix>-<field>.csv containing the total hits for
+        each value of that field ordered by value.
+
+        """
+        for field, counter in self.counters.items():
+            with open('{}-{}.csv'.format(prefix, field), 'w') as fobj:
+                csv_writer = csv.writer(fobj)
+                csv_writer.writerow([field, 'num_hits'])
+                csv_writer.writerows(sorted(counter.items()))
+
+
+def make_output_row(row, video):
+    """Return the :py:class:`.OutputRow` for an :py:class:`.AnalyticsRow` and its video."""
+    # extract custom properties
+    custom = video.get('custom', {})
+
+    # get metadata for video
+    metadata = {
+        'clip_id': custom.get('sms_clip_id', 'clip::').split(':')[1],
+        'media_id': custom.get('sms_media_id', 'media::').split(':')[1],
+        'collection_id': custom.get('sms_collection_id', 'collection::').split(':')[1],
+        'instid': custom.get('sms_instid', 'instid::').split(':')[1],
+        'format': FORMAT_MAP.get(video.get('mediatype'), ''),
+        'country': row.country_code,
+    }
+
+    return OutputRow(
+        ip_addr='127.0.0.1',
+        is_rtsp='f', is_itunes='f',
+        quality='high', fetch_type='stream',
+        lat='0', long='0', is_cam='f',
+        num_hits=row.plays, num_bytes=0,
+        **metadata
+    )
 
 
 def get_analytics(api_key, api_secret, payload):
-    r = requests.post(
-        'https://api.jwplayer.com/v2/sites/' + api_key + '/analytics/queries/',
-        json=payload, headers={'Authorization': api_secret})
-    r.raise_for_status()
-    return r.json()
+    """
+    Run an analytics query against the JWPlatform v2 API and return the response. Requests which
+    fail with a rate limit or server error, or which fail to connect, are retried with exponential
+    backoff.
+
+    """
+    delay = MIN_RETRY_DELAY
+    for attempt in range(MAX_ATTEMPTS):
+        start = time.monotonic()
+        try:
+            r = requests.post(
+                get_v2_api_url('sites/' + api_key + '/analytics/queries/'),
+                json=payload, headers={'Authorization': api_secret}, timeout=REQUEST_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.REGISTRY.record_call(
+                ANALYTICS_ENDPOINT, time.monotonic() - start, e.__class__.__name__)
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            LOG.warning('Analytics request failed, retrying: %s', e)
+            metrics.REGISTRY.record_retry('connection_error')
+        else:
+            metrics.REGISTRY.record_call(
+                ANALYTICS_ENDPOINT, time.monotonic() - start, str(r.status_code))
+            if r.status_code not in RETRY_STATUS_CODES or attempt == MAX_ATTEMPTS - 1:
+                r.raise_for_status()
+                return r.json()
+            LOG.warning('Analytics request returned status %s, retrying', r.status_code)
+            metrics.REGISTRY.record_retry('rate_limit' if r.status_code == 429 else 'server_error')
+        metrics.REGISTRY.sleep(delay)
+        delay = min(MAX_RETRY_DELAY, 2. * delay)
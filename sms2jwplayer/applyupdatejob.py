@@ -44,28 +44,82 @@ The Delete object specifies a list of JWPlatform resources which need to be dele
         }
     }
 
+Jobs are applied in order of priority rather than in file order so that cheap changes which
+are visible to users are not held up behind many slow thumbnail jobs. If a time budget is given,
+jobs which were not started within it are written out in the same format so that they may be
+applied by a later run.
+
 """
+import concurrent.futures
+import heapq
 import json
 import logging
+import queue
+import re
 import sys
+import threading
 import time
+import zlib
 
 import tqdm
 from jwplatform.errors import JWPlatformRateLimitExceededError, JWPlatformError
 
-from . import util
+from . import circuitbreaker, mergejobs, metrics, profiling, util
 
 LOG = logging.getLogger('applyupdatejob')
 
 #: Maximum number of attempts on an API call before giving up
 MAX_ATTEMPTS = 20
 
+#: Maximum number of attempts on an API call which fails transiently before giving up
+MAX_TRANSIENT_ATTEMPTS = 5
+
 #: Maximum delay between each API call
 MAX_DELAY = 2.0
 
 #: Minimum delay between each API call
 MIN_DELAY = 0.02
 
+#: Data types whose delete API accepts a comma separated list of keys
+BULK_DELETE_TYPES = {'videos'}
+
+#: Thumbnail statuses which indicate that jwplayer has not finished processing an upload
+PENDING_THUMBNAIL_STATUSES = {'processing'}
+
+#: Delay in seconds before the first repeated poll of a thumbnail's status
+MIN_CHECK_DELAY = 5.
+
+#: Maximum delay in seconds between polls of a thumbnail's status
+MAX_CHECK_DELAY = 60.
+
+#: Types of update job which are verified before being applied
+VERIFIED_UPDATE_TYPES = ('videos', 'channels')
+
+#: Number of resources fetched by each call when verifying update jobs
+VERIFY_PAGE_SIZE = 1000
+
+#: Maximum number of resources of a data type which are fetched one at a time when verifying
+#: update jobs. If more are needed, they are fetched a page at a time from the list endpoint.
+VERIFY_SHOW_LIMIT = 50
+
+#: Maximum age in seconds of resources in the snapshot which are taken to be current when
+#: verifying update jobs
+VERIFY_SNAPSHOT_MAX_AGE = 600.
+
+#: Format of a shard specification: the 0-based index of the shard and the number of shards
+SHARD_RE = re.compile(r'^(?P<index>[0-9]+)/(?P<count>[0-9]+)$')
+
+#: Kinds of job in a job description
+JOB_KINDS = ('create', 'update', 'delete')
+
+#: Classes of job in the order in which they are applied. Access control changes are applied
+#: first, then creates and other metadata updates which are cheap and visible to users. Thumbnail
+#: jobs come last since there may be very many of them and uploads are slow. Thumbnail checks
+#: follow uploads to give jwplayer time to process them.
+JOB_CLASSES = (
+    'acl', 'create', 'update', 'membership', 'delete', 'image_load', 'image_check',
+)
+
 
 def main(opts):
     try:
@@ -74,47 +128,446 @@ def main(opts):
         LOG.error('jwplatform error: %s', e)
         sys.exit(1)
 
-    with util.input_stream(opts, '<update>') as f:
+    with profiling.stage('job load'), util.input_stream(opts, '<update>') as f:
         jobs = json.load(f)
 
-    updates, creates, deletes = [jobs.get(k, []) for k in ['update', 'create', 'delete']]
+    with profiling.stage('normalisation'):
+        jobs = mergejobs.merge_jobs([jobs])
 
-    LOG.info('Number of update jobs to process: %s', len(updates))
-    LOG.info('Number of create jobs to process: %s', len(creates))
-    LOG.info('Number of delete jobs to process: %s', len(deletes))
+    shard = None
+    if opts['--shard'] is not None:
+        try:
+            shard = parse_shard(opts['--shard'])
+        except ValueError as e:
+            LOG.error('%s', e)
+            sys.exit(1)
+        jobs = select_shard(jobs, *shard)
+
+    snapshot = None
+    if opts.get('--snapshot') is not None:
+        from .snapshot import SnapshotStore
+        snapshot = SnapshotStore(opts['--snapshot'])
+
+    image_cache = None
+    if opts['--image-cache'] is not None:
+        from .imagecache import ImageCache
+        image_cache = ImageCache(
+            opts['--image-cache'], max_bytes=int(opts['--image-cache-size']) * 1024 * 1024)
+
+    time_budget = None
+    if opts['--time-budget'] is not None:
+        time_budget = float(opts['--time-budget'])
+
+    error_budget = None
+    if opts['--error-budget'] is not None:
+        error_budget = int(opts['--error-budget'])
+
+    journal = None
+    if opts['--journal'] is not None:
+        journal = open(opts['--journal'], 'a')
+        if shard is not None:
+            journal.write(json.dumps({'shard': {'index': shard[0], 'count': shard[1]}}) + '\n')
 
     # If verbose flag is present, give a nice progress bar
-    if opts['--verbose'] is not None:
-        updates = tqdm.tqdm(updates)
-        creates = tqdm.tqdm(creates)
-        deletes = tqdm.tqdm(deletes)
+    try:
+        with profiling.stage('API application'):
+            log = apply_jobs(
+                client, jobs, progress=opts['--verbose'] is not None, snapshot=snapshot,
+                delete_batch_size=int(opts['--delete-batch']),
+                delete_workers=int(opts['--delete-jobs']),
+                upload_workers=int(opts['--upload-jobs']), image_cache=image_cache,
+                image_check_polls=int(opts['--image-check-polls']), time_budget=time_budget,
+                journal=journal, error_budget=error_budget, verify=opts['--verify'])
+    finally:
+        if journal is not None:
+            journal.close()
+
+    if image_cache is not None:
+        LOG.info('Image cache hits: %s, misses: %s', image_cache.hits, image_cache.misses)
+
+    if opts['--deferred'] is not None:
+        with util.output_stream(opts, '--deferred') as f:
+            json.dump(log['deferred'], f)
+
+    if shard is not None:
+        log['shard'] = {'index': shard[0], 'count': shard[1]}
 
-    create_responses = list(
-        execute_api_calls_respecting_rate_limit(create_calls(client, creates))
-    )
+    if opts['--log-file'] is not None:
+        with util.output_stream(opts, '--log-file') as f:
+            json.dump(log, f)
 
-    update_responses = list(
-        execute_api_calls_respecting_rate_limit(update_calls(client, updates))
-    )
 
-    delete_responses = list(
-        execute_api_calls_respecting_rate_limit(delete_calls(client, deletes))
-    )
+def apply_jobs(client, jobs, progress=False, snapshot=None, delete_batch_size=1,
+               delete_workers=1, upload_workers=1, image_cache=None, image_check_polls=1,
+               time_budget=None, journal=None, error_budget=None, verify=False):
+    """
+    Apply the create, update and delete jobs from a job description using *client*. If
+    *progress* is ``True``, show progress bars. If *snapshot* is not ``None``, it is a
+    :py:class:`~sms2jwplayer.snapshot.SnapshotStore` used to look up existing resources by SMS
+    id before falling back to searching JWPlatform. Returns a dictionary of the API responses for
+    each job, suitable for writing to the log file.
+
+    Jobs are applied in the order of their class in :py:data:`.JOB_CLASSES` as determined by
+    :py:func:`.job_class` and in file order within each class. If *time_budget* is not ``None``,
+    no job is started once that many seconds have passed. Similarly, if *error_budget* is not
+    ``None``, no job is started once that many jobs have failed. The jobs which were not started
+    are returned in the "deferred" entry of the log as a job description which may be applied by
+    a later run. All API calls share a
+    :py:class:`~sms2jwplayer.circuitbreaker.CircuitBreaker` which pauses them while the API is
+    failing.
+
+    If *verify* is ``True``, update jobs are first checked against the current state of the
+    resources they update as described in :py:func:`.verify_updates`.
+
+    If *journal* is not ``None``, it is a file to which each response is written as soon as it
+    is received so that progress is recorded even if the run is interrupted. Each line of the
+    journal is a JSON document in the same format as the returned log.
+
+    Deletions are made in batches of up to *delete_batch_size* keys where the API allows it by
+    *delete_workers* concurrent workers. The log records the outcome of each deleted key.
+    Thumbnails are uploaded by *upload_workers* concurrent workers. If *image_cache* is not
+    ``None``, it is used as for :py:func:`.update_calls`. Thumbnails are checked as described in
+    :py:func:`.check_images` with up to *image_check_polls* polls per video.
 
-    if opts['--log-file'] is not None:
-        with util.output_stream(opts, '--log-file') as f:
-            json.dump({
-                'create_responses': create_responses,
-                'update_responses': update_responses,
-                'delete_responses': delete_responses,
-            }, f)
+    """
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    breaker = circuitbreaker.CircuitBreaker(error_budget=error_budget)
+
+    if verify:
+        jobs = dict(jobs, update=verify_updates(client, jobs.get('update', []), snapshot, breaker))
+
+    # Map from (class, kind) to list of jobs of that class in file order
+    scheduled = {}
+    for kind in JOB_KINDS:
+        for job in jobs.get(kind, []):
+            scheduled.setdefault((job_class(kind, job), kind), []).append(job)
+
+    for (class_, kind), class_jobs in sorted(scheduled.items()):
+        LOG.info('Number of %s %s jobs to process: %s', class_, kind, len(class_jobs))
+
+    responses = {kind: [] for kind in JOB_KINDS}
+    deferred = {kind: [] for kind in JOB_KINDS}
+
+    def record(kind, kind_responses):
+        """Record responses to jobs of *kind* in the log and journal."""
+        for response in kind_responses:
+            responses[kind].append(response)
+            if journal is not None:
+                journal.write(json.dumps({kind + '_responses': [response]}) + '\n')
+                journal.flush()
+
+    def within_budget(class_jobs, kind):
+        """Yield jobs until the deadline passes or too many fail and defer the remainder."""
+        for index, job in enumerate(class_jobs):
+            if breaker.exhausted or (deadline is not None and time.monotonic() >= deadline):
+                deferred[kind].extend(class_jobs[index:])
+                return
+            yield job
+
+    for class_ in JOB_CLASSES:
+        for kind in JOB_KINDS:
+            class_jobs = scheduled.get((class_, kind), [])
+            if len(class_jobs) == 0:
+                continue
+
+            if class_ == 'image_check':
+                # Thumbnails are checked in rounds and so the deadline is checked per round
+                record(kind, check_images(
+                    client, class_jobs, max_polls=image_check_polls, workers=upload_workers,
+                    deadline=deadline, deferred=deferred[kind], breaker=breaker))
+                continue
+
+            queued = within_budget(class_jobs, kind)
+            if progress:
+                queued = tqdm.tqdm(queued, desc=class_, total=len(class_jobs))
+
+            if kind == 'create':
+                record(kind, execute_api_calls_respecting_rate_limit(
+                    create_calls(client, queued, snapshot), breaker))
+            elif kind == 'delete':
+                for response in execute_api_calls_in_parallel(
+                        delete_calls(client, queued, delete_batch_size), delete_workers,
+                        breaker):
+                    # Calls which succeed return a list of outcomes for each key they deleted
+                    if isinstance(response, list):
+                        record(kind, response)
+                    else:
+                        record(kind, [response])
+            elif class_ == 'image_load':
+                # Thumbnail uploads are limited by bandwidth rather than by the API rate limit
+                # so they are made concurrently.
+                record(kind, execute_api_calls_in_parallel(
+                    update_calls(client, queued, snapshot, image_cache), upload_workers,
+                    breaker))
+            else:
+                record(kind, execute_api_calls_respecting_rate_limit(
+                    update_calls(client, queued, snapshot), breaker))
+
+    n_deferred = sum(len(deferred_jobs) for deferred_jobs in deferred.values())
+    if n_deferred > 0:
+        LOG.warning('Budget exhausted: %s job(s) deferred', n_deferred)
+        if journal is not None:
+            journal.write(json.dumps({'deferred': deferred}) + '\n')
+
+    return {
+        'create_responses': responses['create'],
+        'update_responses': responses['update'],
+        'delete_responses': responses['delete'],
+        'deferred': deferred,
+    }
+
+
+def verify_updates(client, updates, snapshot=None, breaker=None):
+    """
+    Return the update jobs in *updates* with each update to a video or channel checked against
+    the current state of the resource in jwplayer. The delta between the current resource and
+    the resource in the job is recomputed as by genupdatejob so that only properties which still
+    differ are written. Jobs which are already satisfied are dropped. Other jobs, and jobs for
+    resources which could not be fetched, are returned unchanged.
+
+    Current resources are fetched by :py:func:`.fetch_resources`. If *snapshot* is not
+    ``None``, recently fetched resources are read from it and it is updated with any resources
+    fetched from jwplayer. *breaker* is as for
+    :py:func:`.execute_api_calls_respecting_rate_limit`.
+
+    """
+    from .genupdatejob import updated_keys
+
+    # Keys of the resources of each data type which are updated
+    keys = {data_type: set() for data_type in VERIFIED_UPDATE_TYPES}
+    for update in updates:
+        type_, resource = update.get('type'), update.get('resource', {})
+        if type_ in VERIFIED_UPDATE_TYPES:
+            key = resource.get(mergejobs.UPDATE_KEY_PARAMS[type_][1])
+            if key is not None:
+                keys[type_].add(key)
+
+    current = {
+        data_type: fetch_resources(client, data_type, data_type_keys, snapshot, breaker)
+        for data_type, data_type_keys in keys.items() if len(data_type_keys) > 0
+    }
+
+    verified, n_satisfied, n_changed = [], 0, 0
+    for update in updates:
+        type_, resource = update.get('type'), update.get('resource', {})
+        if type_ not in VERIFIED_UPDATE_TYPES:
+            verified.append(update)
+            continue
+
+        key_param = mergejobs.UPDATE_KEY_PARAMS[type_][1]
+        current_resource = current.get(type_, {}).get(resource.get(key_param))
+        if current_resource is None:
+            verified.append(update)
+            continue
+
+        target = {name: value for name, value in resource.items() if name != key_param}
+        delta = updated_keys(current_resource, target)
+        if len(delta) == 0:
+            n_satisfied += 1
+            continue
+        if delta != target:
+            n_changed += 1
+
+        delta[key_param] = resource[key_param]
+        verified.append({'type': type_, 'resource': delta})
+
+    LOG.info('Verification dropped %s satisfied update(s) and reduced %s to the properties '
+             'which still differ', n_satisfied, n_changed)
+    return verified
+
+
+def fetch_resources(client, data_type, keys, snapshot=None, breaker=None):
+    """
+    Return a dictionary mapping key to the current resource for each resource of *data_type*
+    in jwplayer whose key is in *keys*. Resources fetched into *snapshot* within the last
+    :py:data:`.VERIFY_SNAPSHOT_MAX_AGE` seconds are used as they are. If at most
+    :py:data:`.VERIFY_SHOW_LIMIT` of the others remain, each is fetched individually. Otherwise
+    they are fetched by :py:func:`.list_resources`. Resources which could not be fetched are
+    left out. *snapshot* and *breaker* are as for :py:func:`.verify_updates` except that failed
+    fetches are not charged to the error budget of *breaker*.
+
+    """
+    found = {}
+    if snapshot is not None:
+        found.update(snapshot.by_keys(
+            data_type, keys, fetched_after=time.time() - VERIFY_SNAPSHOT_MAX_AGE))
+    n_from_snapshot = len(found)
+
+    # Failing to fetch a resource, for example because it no longer exists, is not a job failure
+    # so use a breaker without an error budget. The breaker still pauses calls while jwplayer is
+    # failing.
+    if breaker is None or breaker.error_budget is not None:
+        breaker = circuitbreaker.CircuitBreaker()
+
+    remaining = set(keys) - set(found)
+    if 0 < len(remaining) <= VERIFY_SHOW_LIMIT:
+        fetched = show_resources(client, data_type, remaining, breaker)
+    elif len(remaining) > 0:
+        fetched = list_resources(client, data_type, remaining, breaker)
+    else:
+        fetched = {}
+
+    if snapshot is not None and len(fetched) > 0:
+        snapshot.upsert(data_type, list(fetched.values()))
+    found.update(fetched)
+
+    LOG.info('Found %s of %s %s for verification of which %s were in the snapshot',
+             len(found), len(keys), data_type, n_from_snapshot)
+    return found
+
+
+def show_resources(client, data_type, keys, breaker=None):
+    """
+    Return a dictionary mapping key to the current resource of *data_type* for each key in
+    *keys* which is found, fetching each resource with a separate call to the show endpoint.
+
+    """
+    keys = sorted(keys)
+    key_param = util.DELETE_KEY_PARAMS[data_type]
+
+    def show_calls():
+        for key in keys:
+            yield lambda delay, key=key: getattr(client, data_type).show(**{key_param: key})
+
+    found = {}
+    for key, response in zip(keys, execute_api_calls_respecting_rate_limit(show_calls(), breaker)):
+        if isinstance(response, dict) and data_type[:-1] in response:
+            found[key] = response[data_type[:-1]]
+        else:
+            LOG.warning('Failed to fetch current %s %s for verification: %s', data_type, key,
+                        response)
+    return found
+
+
+def list_resources(client, data_type, keys, breaker=None):
+    """
+    Return a dictionary mapping key to the current resource of *data_type* for each key in
+    *keys* which is found. The resources are fetched a page at a time from the list endpoint,
+    stopping once every resource has been found, so that many resources may be fetched with
+    few API calls. If fetching fails, the resources found so far are returned.
+
+    """
+    found, remaining = {}, set(keys)
+    offset = 0
+
+    def page_calls():
+        while len(remaining) > 0:
+            yield lambda delay, offset=offset: getattr(client, data_type).list(
+                result_offset=offset, result_limit=VERIFY_PAGE_SIZE)
+
+    for page in execute_api_calls_respecting_rate_limit(page_calls(), breaker):
+        if not isinstance(page, dict):
+            LOG.warning('Failed to fetch current %s for verification: %s', data_type, page)
+            break
+
+        resources = page.get(data_type, [])
+        if len(resources) == 0:
+            break
+        offset += len(resources)
+
+        for resource in resources:
+            if resource.get('key') in remaining:
+                found[resource['key']] = resource
+                remaining.discard(resource['key'])
+
+    return found
+
+
+def job_class(kind, job):
+    """
+    Return the class in :py:data:`.JOB_CLASSES` of *job* which is from the list of jobs of
+    *kind*: "create", "update" or "delete".
+
+    """
+    type_ = job.get('type')
+    if kind == 'delete':
+        return 'delete'
+    if type_ in {'videos_insert', 'videos_delete'}:
+        return 'membership'
+    if type_ in {'image_load', 'image_check'}:
+        return type_
+    if kind == 'update' and 'custom.sms_acl' in resource_to_params(job.get('resource', {})):
+        return 'acl'
+    return kind
+
+
+def parse_shard(spec):
+    """
+    Parse a shard specification of the form "I/N" and return an (I, N) tuple. Raise
+    :py:exc:`ValueError` if the specification is malformed.
+
+    """
+    match = SHARD_RE.match(spec)
+    if match is None:
+        raise ValueError('Shard must be of the form I/N: {}'.format(spec))
+    index, count = int(match.group('index')), int(match.group('count'))
+    if index >= count:
+        raise ValueError('Shard index must be less than the number of shards: {}'.format(spec))
+    return index, count
+
+
+def shard_key(kind, job):
+    """
+    Return the string used to assign *job* from the list of jobs of *kind* to a shard. Jobs which
+    change the same video have the same key, as do jobs which create, update or change the videos
+    in a channel since the latter rewrite the channel's list of media ids. Channels are identified
+    by their sms_collection_id custom prop where the job gives it.
+
+    """
+    type_, resource = job.get('type'), job.get('resource', {})
+
+    if type_ in {'videos_insert', 'videos_delete'}:
+        return 'collection:{}'.format(resource.get('collection_id'))
+
+    if kind == 'delete' and type_ in util.DELETE_KEY_PARAMS:
+        return '{}:{}'.format(type_, resource.get(util.DELETE_KEY_PARAMS[type_]))
+
+    if type_ == 'channels':
+        collection_id_prop = util.get_key_path(resource, 'custom.sms_collection_id')
+        try:
+            return 'collection:{}'.format(util.parse_custom_prop('collection', collection_id_prop))
+        except (TypeError, ValueError):
+            pass
+
+    if kind == 'create' and type_ == 'videos':
+        media_id_prop = util.get_key_path(resource, 'custom.sms_media_id')
+        if media_id_prop is not None:
+            return 'media:{}'.format(media_id_prop)
+    elif type_ in mergejobs.UPDATE_KEY_PARAMS:
+        data_type, key_param = mergejobs.UPDATE_KEY_PARAMS[type_]
+        if resource.get(key_param) is not None:
+            return '{}:{}'.format(data_type, resource[key_param])
+
+    # Otherwise, shard by the content of the job
+    return json.dumps(job, sort_keys=True)
 
 
-def videos_insert(client, delay, resource):
+def select_shard(jobs, index, count):
+    """
+    Return a job description containing the jobs from *jobs* in shard *index* of *count*. Jobs
+    are assigned to shards by the CRC32 of their :py:func:`.shard_key` so that the assignment is
+    the same on every host and jobs which change the same resource are in the same shard.
+
+    """
+    selected = {
+        kind: [
+            job for job in jobs.get(kind, [])
+            if zlib.crc32(shard_key(kind, job).encode('utf8')) % count == index
+        ]
+        for kind in JOB_KINDS
+    }
+    LOG.info('Selected %s job(s) in shard %s/%s', sum(len(v) for v in selected.values()),
+             index, count)
+    return selected
+
+
+def videos_insert(client, delay, resource, snapshot=None):
     """Inserts a video into a channel and updates the custom sms_media_ids param to reflect
-    the new state of the channel."""
+    the new state of the channel. If *snapshot* is not ``None``, it is used to look up the video
+    key. The channel is always retrieved from JWPlatform since its custom params change as videos
+    are inserted."""
     try:
-        video_key = util.key_for_media_id(resource['media_id'])
+        video_key = util.key_for_media_id(resource['media_id'], client, snapshot)
         time.sleep(delay)
     except util.VideoNotFoundError:
         return 'video not found for media_id: {}'.format(resource['media_id'])
@@ -132,6 +585,9 @@ def videos_insert(client, delay, resource):
     try:
         response = client.channels.videos.create(channel_key=channel['key'], video_key=video_key)
     except JWPlatformError as e:
+        # Failures which may succeed if retried are left to the caller to retry
+        if circuitbreaker.is_transient(e):
+            raise
         message = 'channel_key: {}, video_key: {} - {}'.format(channel['key'], video_key, e)
         # record this failure in the failed_media_ids property so we know not to re-run
         failed_media_ids.add(resource['media_id'])
@@ -146,11 +602,11 @@ def videos_insert(client, delay, resource):
     return response
 
 
-def videos_delete(client, delay, resource):
+def videos_delete(client, delay, resource, snapshot=None):
     """Deletes a video from a channel and updates the custom sms_media_ids param to reflect
-    the new state of the channel."""
+    the new state of the channel. *snapshot* is as for :py:func:`.videos_insert`."""
     try:
-        video_key = util.key_for_media_id(resource['media_id'])
+        video_key = util.key_for_media_id(resource['media_id'], client, snapshot)
         time.sleep(delay)
     except util.VideoNotFoundError:
         return 'video not found for media_id: {}'.format(resource['media_id'])
@@ -168,6 +624,8 @@ def videos_delete(client, delay, resource):
     try:
         response = client.channels.videos.delete(channel_key=channel['key'], video_key=video_key)
     except JWPlatformError as e:
+        if circuitbreaker.is_transient(e):
+            raise
         return 'channel_key: {}, video_key: {} - {}'.format(channel['key'], video_key, e)
     if response['status'] == 'ok':
         time.sleep(delay)
@@ -176,28 +634,28 @@ def videos_delete(client, delay, resource):
 
 
 def get_media_ids_from_channel(channel, prop_name='media_ids'):
-    """Retrieves the custom sms_media_ids param from a channel.
+    """Retrieves the custom sms_media_ids param from a channel as a set of ints.
     prop_name is used if failed_media_ids is required"""
     full_prop_name = 'sms_' + prop_name
     default = {full_prop_name: prop_name + '::'}
     media_ids_prop = channel.get('custom', default).get(full_prop_name, default[full_prop_name])
-    media_ids = util.parse_custom_prop(prop_name, media_ids_prop)
-    return set([] if media_ids == '' else [int(media_id) for media_id in media_ids.split(',')])
+    return util.decode_id_set(util.parse_custom_prop(prop_name, media_ids_prop))
 
 
 def update_media_ids(client, channel_key, media_ids, prop_name='media_ids'):
-    """Updates a channel with a new custom sms_media_ids param.
+    """Updates a channel with a new custom sms_media_ids param encoded by
+    :py:func:`~sms2jwplayer.util.encode_id_set`.
     prop_name is used if failed_media_ids is required"""
-    media_ids_string = ','.join(str(media_id) for media_id in media_ids)
     return client.channels.update(http_method='POST', **{
         'channel_key': channel_key,
-        'custom.sms_' + prop_name: prop_name + ':{}:'.format(media_ids_string)
+        'custom.sms_' + prop_name: prop_name + ':{}:'.format(util.encode_id_set(media_ids))
     })
 
 
-def create_calls(client, creates):
+def create_calls(client, creates, snapshot=None):
     """
-    Return an iterator of callables representing the API calls for each create job.
+    Return an iterator of callables representing the API calls for each create job. If
+    *snapshot* is not ``None``, it is consulted to determine if a resource already exists.
     """
     for create in creates:
         type_, resource = create.get('type'), create.get('resource', {})
@@ -227,7 +685,7 @@ def create_calls(client, creates):
                         # Attempt to find a matching video for this media id.
                         # If None found, that's OK.
                         try:
-                            video_key = util.key_for_media_id(media_id)
+                            video_key = util.key_for_media_id(media_id, client, snapshot)
                         except util.VideoNotFoundError:
                             pass
                         finally:
@@ -269,7 +727,8 @@ def create_calls(client, creates):
                         # Attempt to find a matching channel for this collection id.
                         # If None found, that's OK.
                         try:
-                            channel_key = util.key_for_collection_id(collection_id)
+                            channel_key = util.key_for_collection_id(
+                                collection_id, client, snapshot)
                         except util.ChannelNotFoundError:
                             pass
                         finally:
@@ -287,20 +746,26 @@ def create_calls(client, creates):
 
             yield do_create
         elif type_ == 'videos_insert':
-            yield lambda delay: log(videos_insert(client, delay, resource))
+            yield lambda delay: log(videos_insert(client, delay, resource, snapshot))
         elif type_ == 'videos_delete':
-            yield lambda delay: log(videos_delete(client, delay, resource))
+            yield lambda delay: log(videos_delete(client, delay, resource, snapshot))
         else:
             LOG.warning('Skipping unknown update type: %s', type_)
 
 
-def update_calls(client, updates):
+def update_calls(client, updates, snapshot=None, image_cache=None):
     """
-    Return an iterator of callables representing the API calls for each update job.
+    Return an iterator of callables representing the API calls for each update job. *snapshot*
+    is as for :py:func:`.videos_insert`. If *image_cache* is not ``None``, it is an
+    :py:class:`~sms2jwplayer.imagecache.ImageCache` used to download each distinct thumbnail
+    once.
     """
-    for update in updates:
-        type_, resource = update.get('type'), update.get('resource', {})
-
+    def call_for(type_, resource):
+        """
+        Return the callable for an update of *type_* to *resource* or ``None`` if *type_* is
+        unknown. Each callable is bound to its own job since calls may be run concurrently
+        while later jobs are read.
+        """
         def log(response):
             return {'job': resource, 'log': response}
 
@@ -309,7 +774,8 @@ def update_calls(client, updates):
             uploads an SMS thumbnail image and, if successful, sets the custom 'image_status'
             parameter to 'loaded'
             """
-            response = util.upload_thumbnail_from_url(client=client, **resource)
+            response = util.upload_thumbnail_from_url(
+                client=client, image_cache=image_cache, **resource)
             if response['status'] == 'ok':
                 time.sleep(delay)
                 update_response = client.videos.update(http_method='POST', **{
@@ -327,85 +793,325 @@ def update_calls(client, updates):
             checks the status of an upload thumbnail image and records this status in the custom
             'image_status' parameter
             """
-            response = client.videos.thumbnails.show(**resource)
-            time.sleep(delay)
-            status = response['thumbnail']['status']
-            update_response = client.videos.update(http_method='POST', **{
-                'video_key': resource['video_key'],
-                'custom.sms_image_status': 'image_status:{}:'.format(status)
-            })
-            return log({'show': response, 'update': update_response})
+            return log(check_image(client, delay, resource, final_poll=True))
+
+        if type_ == 'videos':
+            return lambda delay: log(
+                client.videos.update(http_method='POST', **resource_to_params(resource))
+            )
+        elif type_ == 'channels':
+            return lambda delay: log(
+                client.channels.update(http_method='POST', **resource_to_params(resource))
+            )
+        elif type_ == 'videos_insert':
+            return lambda delay: log(videos_insert(client, delay, resource, snapshot))
+        elif type_ == 'videos_delete':
+            return lambda delay: log(videos_delete(client, delay, resource, snapshot))
+        elif type_ == 'image_load':
+            return image_load
+        elif type_ == 'image_check':
+            return image_check
+
+    for update in updates:
+        type_, resource = update.get('type'), update.get('resource', {})
+        api_call = call_for(type_, resource)
+        if api_call is None:
+            LOG.warning('Skipping unknown update type: %s', type_)
+            continue
 
         try:
-            if type_ == 'videos':
-                yield lambda delay: log(
-                    client.videos.update(http_method='POST', **resource_to_params(resource))
-                )
-            elif type_ == 'channels':
-                yield lambda delay: log(
-                    client.channels.update(http_method='POST', **resource_to_params(resource))
-                )
-            elif type_ == 'videos_insert':
-                yield lambda delay: log(videos_insert(client, delay, resource))
-            elif type_ == 'videos_delete':
-                yield lambda delay: log(videos_delete(client, delay, resource))
-            elif type_ == 'image_load':
-                yield image_load
-            elif type_ == 'image_check':
-                yield image_check
-            else:
-                LOG.warning('Skipping unknown update type: %s', type_)
+            yield api_call
         except JWPlatformRateLimitExceededError as e:
             raise JWPlatformRateLimitExceededError(
                 "{}: {}: {}".format(type_, resource['video_key'], e.message)
             )
 
 
-def delete_calls(client, deletes):
+def check_image(client, delay, resource, final_poll=True):
+    """
+    Checks the status of the uploaded thumbnail for the video in an image_check job *resource*
+    and records the status in the custom 'image_status' parameter if it has changed from the
+    'image_status' in the resource. If jwplayer is still processing the thumbnail, the status is
+    not recorded so that the check is made again by the next update job. In that case, if
+    *final_poll* is ``False``, the returned dictionary has 'pending' set so that the check can
+    be repeated sooner.
+
+    """
+    response = client.videos.thumbnails.show(video_key=resource['video_key'])
+    status = response['thumbnail']['status']
+    result = {'show': response}
+
+    if status in PENDING_THUMBNAIL_STATUSES:
+        if not final_poll:
+            result['pending'] = True
+        return result
+
+    image_status = 'image_status:{}:'.format(status)
+    if image_status != resource.get('image_status'):
+        time.sleep(delay)
+        result['update'] = client.videos.update(http_method='POST', **{
+            'video_key': resource['video_key'],
+            'custom.sms_image_status': image_status
+        })
+    return result
+
+
+def check_images(client, checks, max_polls=1, workers=1, deadline=None, deferred=None,
+                 breaker=None):
+    """
+    Check the thumbnails for each image_check job in *checks* using *workers* concurrent
+    workers. The videos are polled in rounds. Videos whose thumbnails are still being processed
+    are polled again in a later round after a delay which doubles with each poll until they
+    have been polled *max_polls* times. The status is only written to a video when it differs
+    from the one recorded in the job. Returns a list of log entries for each job.
+
+    If *deadline* is not ``None``, no round is started after that value of
+    :py:func:`time.monotonic`. Similarly, no round is started once *breaker*, a
+    :py:class:`~sms2jwplayer.circuitbreaker.CircuitBreaker` shared by the workers, is
+    exhausted. Jobs which have not been completed by then are appended to the list *deferred*.
+
     """
-    Return an iterator of callables representing the API calls for each delete job.
+    log = []
+
+    # Heap of (time of next poll, job index, number of polls so far, resource)
+    pending = [(0., index, 0, check.get('resource', {})) for index, check in enumerate(checks)]
+    while len(pending) > 0:
+        now = time.monotonic()
+        stop = breaker is not None and breaker.exhausted
+        if stop or (deadline is not None and now >= deadline):
+            if deferred is not None:
+                deferred.extend(
+                    {'type': 'image_check', 'resource': resource}
+                    for _, _, _, resource in sorted(pending, key=lambda entry: entry[1]))
+            break
+
+        if pending[0][0] > now:
+            delay = pending[0][0] - now
+            if deadline is not None:
+                delay = min(delay, max(0., deadline - now))
+            time.sleep(delay)
+            continue
+
+        # Poll every video which is due in a single batch
+        batch = []
+        while len(pending) > 0 and pending[0][0] <= now:
+            batch.append(heapq.heappop(pending))
+
+        def poll_call(index, n_polls, resource):
+            def poll(delay):
+                return (index, n_polls + 1, resource, check_image(
+                    client, delay, resource, final_poll=n_polls + 1 >= max_polls))
+            return poll
+
+        for result in execute_api_calls_in_parallel(
+                [poll_call(index, n_polls, resource) for _, index, n_polls, resource in batch],
+                workers, breaker):
+            if not isinstance(result, tuple):
+                log.append(result)
+                continue
+
+            index, n_polls, resource, response = result
+            if response.get('pending'):
+                check_delay = min(MAX_CHECK_DELAY, MIN_CHECK_DELAY * 2 ** (n_polls - 1))
+                heapq.heappush(pending, (now + check_delay, index, n_polls, resource))
+            else:
+                log.append({'job': resource, 'log': response})
+
+    return log
+
+
+def delete_calls(client, deletes, batch_size=1):
     """
+    Return an iterator of callables representing the API calls for each delete job. Consecutive
+    deletions of resources whose type is in :py:data:`.BULK_DELETE_TYPES` are grouped into
+    batches of up to *batch_size* keys which are deleted by a single call. Each callable returns
+    a list with the outcome for each key as returned by :py:func:`.delete_resources`.
+    """
+    batch_type, batch = None, []
+
+    def flush(type_, keys):
+        return lambda delay: delete_resources(client, type_, keys, delay)
+
     for delete in deletes:
         type_, resource = delete.get('type'), delete.get('resource', {})
 
-        if type_ == 'videos':
-            yield lambda delay: client.videos.delete(
-                http_method='POST', **resource_to_params(resource)
-            )
-        else:
+        if type_ not in util.DELETE_KEY_PARAMS:
             LOG.warning('Skipping unknown delete type: %s', type_)
+            continue
+
+        key = resource.get(util.DELETE_KEY_PARAMS[type_])
+        if key is None:
+            LOG.warning('Skipping %s delete without key: %r', type_, resource)
+            continue
+
+        if len(batch) > 0 and (type_ != batch_type or len(batch) >= batch_size):
+            yield flush(batch_type, batch)
+            batch = []
+
+        if type_ in BULK_DELETE_TYPES:
+            batch_type = type_
+            batch.append(key)
+        else:
+            yield flush(type_, [key])
+
+    if len(batch) > 0:
+        yield flush(batch_type, batch)
+
+
+def delete_resources(client, type_, keys, delay):
+    """
+    Delete the resources of *type_* with *keys* in a single API call and return a list of
+    outcomes, one per key. Each outcome is a dictionary with the type and key of the resource
+    and either the API response or an error message. If the call fails permanently and there are
+    several keys, each key is deleted individually so that the keys which failed can be
+    identified. Failures which may succeed if retried are raised.
+
+    """
+    try:
+        response = getattr(client, type_).delete(
+            http_method='POST', **{util.DELETE_KEY_PARAMS[type_]: ','.join(keys)})
+    except JWPlatformError as e:
+        if circuitbreaker.is_transient(e):
+            raise
+        if len(keys) == 1:
+            LOG.warning('Failed to delete %s %s: %s', type_, keys[0], e.message)
+            return [{'type': type_, 'key': keys[0], 'error': e.message}]
+
+        outcomes = []
+        for key in keys:
+            time.sleep(delay)
+            outcomes.extend(delete_resources(client, type_, [key], delay))
+        return outcomes
+
+    return [{'type': type_, 'key': key, 'response': response} for key in keys]
 
 
-def execute_api_calls_respecting_rate_limit(call_iterable):
+def execute_api_calls_respecting_rate_limit(call_iterable, breaker=None):
     """
     A generator which takes an iterable of callables which represent calls to the JWPlatform API
-    and run them one after another. If a JWPlatformRateLimitExceededError is raised by the
-    callable, exponentially back off and retry. Since retries are possible, callables from
-    call_iterable may be called multiple times.
+    and run them one after another. Failed calls are handled according to
+    :py:func:`~sms2jwplayer.circuitbreaker.classify`. If the rate limit is exceeded,
+    exponentially back off and retry up to :py:data:`.MAX_ATTEMPTS` times. Transient failures are
+    retried in the same way up to :py:data:`.MAX_TRANSIENT_ATTEMPTS` times. Permanent failures
+    are not retried. Since retries are possible, callables from call_iterable may be called
+    multiple times.
 
-    Yields the results of calling the update job.
+    If *breaker* is not ``None``, it is a :py:class:`~sms2jwplayer.circuitbreaker.CircuitBreaker`
+    which records the outcome of each call and is waited on before each call.
+
+    Yields the results of calling the update job or a message describing why it failed.
 
     """
+    if breaker is None:
+        breaker = circuitbreaker.CircuitBreaker()
+
     # delay between calls to not hit rate limit
     delay = MIN_DELAY  # seconds
 
     for api_call in call_iterable:
-        error_message = None
+        n_transient_failures = 0
         for _ in range(MAX_ATTEMPTS):
+            breaker.wait()
             try:
-                yield api_call(delay)
-
-                # On a successful call, slightly shorten the delay
-                delay = max(MIN_DELAY, min(MAX_DELAY, delay * 0.2))
-                time.sleep(delay)
-                break
-            except JWPlatformRateLimitExceededError as error:
-                # On a rate limit failure, lengthen the delay
+                result = api_call(delay)
+            except Exception as error:
+                # Any failure, including a malformed job, fails just this call
+                outcome = circuitbreaker.classify(error)
+                failure = '{}: {}'.format(
+                    error.__class__.__name__, getattr(error, 'message', str(error)))
+                if outcome == 'permanent':
+                    LOG.warning('API call failed: %s', failure)
+                    failure = 'FAILED: ' + failure
+                    break
+
+                metrics.REGISTRY.record_retry(outcome)
+                failure = 'MAX_ATTEMPTS: ' + failure
+                if outcome == 'transient':
+                    breaker.record_transient_failure()
+                    n_transient_failures += 1
+                    if n_transient_failures >= MAX_TRANSIENT_ATTEMPTS:
+                        break
+
+                # On a failure which may be retried, lengthen the delay
                 delay = max(MIN_DELAY, min(MAX_DELAY, delay * 8.0))
-                time.sleep(delay)
-                error_message = error.message
-        if error_message:
-            yield "MAX_ATTEMPTS: " + error_message
+                metrics.REGISTRY.sleep(delay)
+            else:
+                failure = None
+                break
+
+        if failure is not None:
+            breaker.record_failed_job()
+            yield failure
+            continue
+
+        breaker.record_success()
+        yield result
+        metrics.REGISTRY.record_job()
+
+        # On a successful call, slightly shorten the delay
+        delay = max(MIN_DELAY, min(MAX_DELAY, delay * 0.2))
+        metrics.REGISTRY.sleep(delay)
+
+
+def execute_api_calls_in_parallel(call_iterable, n_workers, breaker=None):
+    """
+    A generator which runs the callables from *call_iterable* as
+    :py:func:`.execute_api_calls_respecting_rate_limit` does but using *n_workers* threads, each
+    of which backs off independently. All workers share *breaker*. Yields the result of each
+    call as soon as it is received and so in no particular order. If the generator is closed
+    early, no further calls are started.
+
+    If a worker fails, for example because *call_iterable* raises an exception, the failure is
+    charged to the error budget of *breaker* and yielded as a result rather than aborting the
+    run. The results of calls the worker had already made are kept.
+
+    """
+    if breaker is None:
+        breaker = circuitbreaker.CircuitBreaker()
+
+    call_iterator = iter(call_iterable)
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    # Results are passed back to the calling thread with a sentinel from each worker once it
+    # has finished
+    results, finished = queue.Queue(), object()
+
+    def next_calls():
+        while not stopped.is_set():
+            with lock:
+                try:
+                    api_call = next(call_iterator)
+                except StopIteration:
+                    return
+            yield api_call
+
+    def worker():
+        try:
+            for result in execute_api_calls_respecting_rate_limit(next_calls(), breaker):
+                results.put(result)
+        except Exception as error:
+            failure = '{}: {}'.format(
+                error.__class__.__name__, getattr(error, 'message', str(error)))
+            LOG.error('API worker failed: %s', failure)
+            breaker.record_failed_job()
+            results.put('FAILED: ' + failure)
+        finally:
+            results.put(finished)
+
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+        for _ in range(n_workers):
+            executor.submit(worker)
+        try:
+            n_running = n_workers
+            while n_running > 0:
+                result = results.get()
+                if result is finished:
+                    n_running -= 1
+                else:
+                    yield result
+        finally:
+            stopped.set()
 
 
 def resource_to_params(resource):
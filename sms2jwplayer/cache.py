@@ -0,0 +1,113 @@
+"""
+The :py:mod:`~sms2jwplayer.cache` module implements a persistent key-value cache backed by
+SQLite. It is used to remember metadata which rarely changes between runs, such as the SMS ids
+of jwplayer videos, so that consecutive runs need not fetch it again.
+
+Entries expire a fixed time after they were stored and the cache is bounded in size by evicting
+the least recently used entries.
+
+"""
+import json
+import sqlite3
+import threading
+import time
+
+#: Default time in seconds after which cache entries expire
+DEFAULT_TTL = 30 * 24 * 60 * 60
+
+#: Default maximum number of entries in the cache
+DEFAULT_MAX_ENTRIES = 1000000
+
+
+class PersistentCache:
+    """
+    A cache of JSON-serialisable values keyed by string stored in the SQLite database at *path*.
+    Entries older than *ttl* seconds are ignored and removed. If the cache grows beyond
+    *max_entries*, the least recently used entries are evicted. Instances may be used as context
+    managers in which case the database is closed when the context exits.
+
+    """
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        #: Number of keys found in and missing from the cache
+        self.hits, self.misses = 0, 0
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL, '
+                'used_at REAL NOT NULL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS entries_used_at ON entries (used_at)')
+
+            # Expired entries are removed on every lookup and so must be found without a scan
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS entries_stored_at ON entries (stored_at)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def get_many(self, keys, now=None):
+        """
+        Return a dictionary mapping each key in *keys* which has an unexpired entry in the cache
+        to its value. The entries returned are marked as recently used.
+
+        """
+        now = now if now is not None else time.time()
+        keys = list(keys)
+        found = {}
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM entries WHERE stored_at < ?', (now - self.ttl,))
+
+            # Query in chunks to keep below SQLite's limit on the number of parameters
+            for offset in range(0, len(keys), 500):
+                chunk = keys[offset:offset+500]
+                placeholders = ','.join('?' * len(chunk))
+                for key, value in self._connection.execute(
+                        'SELECT key, value FROM entries WHERE key IN ({})'.format(placeholders),
+                        chunk):
+                    found[key] = json.loads(value)
+                self._connection.execute(
+                    'UPDATE entries SET used_at = ? WHERE key IN ({})'.format(placeholders),
+                    [now] + chunk)
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items, now=None):
+        """
+        Store each (key, value) pair from the dictionary *items* in the cache and evict the least
+        recently used entries if the cache has grown too large.
+
+        """
+        now = now if now is not None else time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO entries (key, value, stored_at, used_at) '
+                'VALUES (?, ?, ?, ?)',
+                [(key, json.dumps(value), now, now) for key, value in items.items()])
+
+            n_entries = self._connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            if n_entries > self.max_entries:
+                self._connection.execute(
+                    'DELETE FROM entries WHERE key IN ('
+                    'SELECT key FROM entries ORDER BY used_at LIMIT ?)',
+                    (n_entries - self.max_entries,))
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
@@ -0,0 +1,146 @@
+"""
+The :py:mod:`~sms2jwplayer.circuitbreaker` module decides how failed calls to the jwplayer API
+are handled when applying jobs.
+
+Each failure is classified by :py:func:`.classify` as one of:
+
+- "rate_limit": the API rate limit was exceeded. The call is retried after backing off.
+- "transient": the API or the network failed in a way which may succeed if retried, e.g. an
+  internal error or a timeout. The call is retried a limited number of times.
+- "permanent": the call can never succeed, e.g. because a parameter is invalid or the job itself
+  is malformed. The call is not retried.
+
+A :py:class:`.CircuitBreaker` is shared by all workers applying jobs. If the proportion of recent
+calls which failed transiently spikes, the breaker opens and all workers pause before making
+further calls. If an error budget is set, the breaker records when that many jobs have failed so
+that the run can stop cleanly.
+
+"""
+import collections
+import logging
+import socket
+import threading
+import time
+
+from . import metrics
+
+LOG = logging.getLogger(__name__)
+
+#: Names of jwplatform error classes which indicate a failure which may succeed if retried
+TRANSIENT_JWPLATFORM_ERRORS = {
+    'JWPlatformCallFailedError',
+    'JWPlatformCallUnavailableError',
+    'JWPlatformDatabaseError',
+    'JWPlatformInternalError',
+    'JWPlatformTimestampExpiredError',
+    'JWPlatformUnknownError',
+}
+
+#: Number of most recent calls over which the failure rate is measured
+WINDOW = 20
+
+#: Minimum number of calls in the window before the breaker may open
+MIN_CALLS = 10
+
+#: Proportion of calls in the window which must fail transiently for the breaker to open
+FAILURE_THRESHOLD = 0.5
+
+#: Time in seconds for which the breaker first stays open. This doubles each time the breaker
+#: re-opens without an intervening successful call.
+MIN_COOLDOWN = 10.
+
+#: Maximum time in seconds for which the breaker stays open
+MAX_COOLDOWN = 300.
+
+
+def classify(error):
+    """
+    Return "rate_limit", "transient" or "permanent" according to how the exception *error*
+    raised by an API call should be handled.
+
+    """
+    from jwplatform.errors import JWPlatformError, JWPlatformRateLimitExceededError
+    import requests
+
+    if isinstance(error, JWPlatformRateLimitExceededError):
+        return 'rate_limit'
+    if isinstance(error, JWPlatformError):
+        if error.__class__.__name__ in TRANSIENT_JWPLATFORM_ERRORS:
+            return 'transient'
+        return 'permanent'
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return 'transient'
+    if isinstance(error, (ConnectionError, TimeoutError, socket.timeout)):
+        return 'transient'
+    return 'permanent'
+
+
+def is_transient(error):
+    """Return ``True`` if the exception *error* should cause an API call to be retried."""
+    return classify(error) in {'rate_limit', 'transient'}
+
+
+class CircuitBreaker:
+    """
+    A thread-safe circuit breaker which pauses API calls while they are failing. If
+    *error_budget* is not ``None``, the breaker is :py:attr:`.exhausted` once that many jobs
+    have failed.
+
+    """
+    def __init__(self, error_budget=None):
+        self.error_budget = error_budget
+
+        #: Number of jobs which have failed
+        self.n_failed_jobs = 0
+
+        self._lock = threading.Lock()
+
+        # Outcomes of the most recent calls: True if the call failed transiently
+        self._window = collections.deque(maxlen=WINDOW)
+
+        self._cooldown = MIN_COOLDOWN
+        self._closes_at = 0.
+
+    @property
+    def exhausted(self):
+        """``True`` if the error budget has been used up and no more jobs should be started."""
+        with self._lock:
+            return self.error_budget is not None and self.n_failed_jobs >= self.error_budget
+
+    def wait(self):
+        """Block while the breaker is open."""
+        while True:
+            with self._lock:
+                remaining = self._closes_at - time.monotonic()
+            if remaining <= 0:
+                return
+            metrics.REGISTRY.sleep(remaining)
+
+    def record_success(self):
+        """Record that an API call succeeded."""
+        with self._lock:
+            self._window.append(False)
+            self._cooldown = MIN_COOLDOWN
+
+    def record_transient_failure(self):
+        """Record that an API call failed transiently, opening the breaker if need be."""
+        with self._lock:
+            self._window.append(True)
+            if len(self._window) < MIN_CALLS:
+                return
+            if sum(self._window) / len(self._window) < FAILURE_THRESHOLD:
+                return
+
+            LOG.warning('Circuit breaker open: %s of the last %s API calls failed; pausing for '
+                        '%.0fs', sum(self._window), len(self._window), self._cooldown)
+            metrics.REGISTRY.record_retry('circuit_open')
+            self._closes_at = time.monotonic() + self._cooldown
+            self._cooldown = min(MAX_COOLDOWN, self._cooldown * 2)
+            self._window.clear()
+
+    def record_failed_job(self):
+        """Record that a job has failed and will not be retried."""
+        with self._lock:
+            self.n_failed_jobs += 1
+            if self.error_budget is not None and self.n_failed_jobs == self.error_budget:
+                LOG.error('Error budget of %s failed job(s) exhausted', self.error_budget)
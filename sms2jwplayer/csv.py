@@ -201,6 +201,14 @@ def load(item_type, fobj, skip_header_row=True):
     Any extra columns are ignored.
     The columns are converted by the type defined in item_type._ITEM_TYPES.
 
+    """
+    return list(iter_load(item_type, fobj, skip_header_row))
+
+
+def iter_load(item_type, fobj, skip_header_row=True):
+    """As :py:func:`.load` but return a generator which yields each item_type instance as its
+    row is read so that the whole export need not be held in memory.
+
     """
     reader = csv.reader(fobj)
 
@@ -208,7 +216,5 @@ def load(item_type, fobj, skip_header_row=True):
     if skip_header_row:
         next(reader)
 
-    return [
-        item_type._make([t(v) for t, v in zip(item_type._ITEM_TYPES, row)])
-        for row in reader
-    ]
+    for row in reader:
+        yield item_type._make([t(v) for t, v in zip(item_type._ITEM_TYPES, row)])
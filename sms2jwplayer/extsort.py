@@ -0,0 +1,69 @@
+"""
+The :py:mod:`~sms2jwplayer.extsort` module sorts iterables which may be too large to fit in
+memory. Items are sorted in chunks. If there is more than one chunk, each sorted chunk is
+written to a temporary file and the chunks are then merged in a single streaming pass.
+
+"""
+import heapq
+import itertools
+import logging
+import pickle
+import tempfile
+
+LOG = logging.getLogger(__name__)
+
+#: Default maximum number of items held in memory at once while sorting
+CHUNK_SIZE = 100000
+
+
+def sort_external(iterable, key, chunk_size=CHUNK_SIZE):
+    """
+    A generator which yields the items from *iterable* in ascending order of *key*, a callable
+    which returns the sort key for an item. At most *chunk_size* items are held in memory while
+    sorting. The items and their keys must be picklable. The sort is stable.
+
+    """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunk_size))
+    if len(chunk) < chunk_size:
+        # Everything fits in memory
+        yield from sorted(chunk, key=key)
+        return
+
+    chunk_files = []
+    try:
+        while len(chunk) > 0:
+            chunk_files.append(_write_chunk(len(chunk_files), sorted(chunk, key=key), key))
+            chunk = list(itertools.islice(iterator, chunk_size))
+        LOG.info('Merging %s sorted chunk(s)', len(chunk_files))
+
+        # Records are (key, (chunk index, position), item) and the chunk index and position
+        # are unique so that items themselves are never compared and ties keep input order.
+        for _, _, item in heapq.merge(*(_read_chunk(fobj) for fobj in chunk_files)):
+            yield item
+    finally:
+        for fobj in chunk_files:
+            fobj.close()
+
+
+def _write_chunk(index, items, key):
+    """Write the sorted *items* to a temporary file and return it positioned at the start."""
+    fobj = tempfile.TemporaryFile()
+    pickler = pickle.Pickler(fobj, pickle.HIGHEST_PROTOCOL)
+    for position, item in enumerate(items):
+        pickler.dump((key(item), (index, position), item))
+
+        # The pickler remembers every object it has written unless told otherwise
+        pickler.clear_memo()
+    fobj.seek(0)
+    return fobj
+
+
+def _read_chunk(fobj):
+    """A generator which yields each record written to *fobj* by :py:func:`._write_chunk`."""
+    unpickler = pickle.Unpickler(fobj)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
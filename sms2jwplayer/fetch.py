@@ -1,11 +1,12 @@
 """
 The fetch subcommand fetches metadata on jwplayer videos or channels
-and stores it locally in JSON documents.
+and stores it locally in JSON documents or in a :py:mod:`~sms2jwplayer.snapshot` store.
 
 """
 import json
 import logging
 import sys
+import time
 
 from .util import get_jwplatform_client, JWPlatformClientError, get_data_type
 
@@ -19,12 +20,48 @@ def main(opts):
         LOG.error('jwplatform error: %s', e)
         sys.exit(1)
 
-    current_offset = 0
     _, data_type, _ = get_data_type(opts)
+
+    if opts.get('--snapshot') is not None:
+        fetch_to_snapshot(client, data_type, opts['--snapshot'])
+        return
+
+    for results in fetch_pages(client, data_type):
+        out_pn = opts['--base-name'] + '{:06d}.json'.format(results['offset'])
+        LOG.info('Saving to: %s', out_pn)
+        with open(out_pn, 'w') as fobj:
+            json.dump(results, fobj)
+
+
+def fetch_to_snapshot(client, data_type, path):
+    """
+    Fetch all resources of *data_type* and upsert them into the snapshot store at *path*. Once
+    all resources have been fetched, resources which were not seen are removed from the store.
+
+    """
+    from .snapshot import SnapshotStore
+
+    started_at = time.time()
+    with SnapshotStore(path) as store:
+        for results in fetch_pages(client, data_type):
+            LOG.info('Saving to snapshot: %s', path)
+            store.upsert(data_type, results[data_type], fetched_at=started_at)
+        n_removed = store.delete_fetched_before(data_type, started_at)
+        LOG.info('Removed %s %s no longer in jwplayer from snapshot', n_removed, data_type)
+
+
+def fetch_pages(client, data_type, page_size=1000):
+    """
+    A generator which fetches all resources of *data_type* ('videos' or 'channels') from
+    jwplayer and yields each page of results as returned by the list endpoint. The offset of the
+    first resource in each page is set in the 'offset' key of the page.
+
+    """
+    current_offset = 0
     while True:
         LOG.info('Fetching %s starting from offset: %s', data_type, current_offset)
         results = getattr(client, data_type).list(
-            result_offset=current_offset, result_limit=1000)
+            result_offset=current_offset, result_limit=page_size)
         num_results = len(results[data_type])
         LOG.info('Got information on %s %s', num_results, data_type)
 
@@ -33,9 +70,7 @@ def main(opts):
             LOG.info('Stopping')
             break
 
-        out_pn = opts['--base-name'] + '{:06d}.json'.format(current_offset)
-        LOG.info('Saving to: %s', out_pn)
-        with open(out_pn, 'w') as fobj:
-            json.dump(results, fobj)
+        results['offset'] = current_offset
+        yield results
 
         current_offset += num_results
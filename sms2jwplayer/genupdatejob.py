@@ -3,55 +3,141 @@ The genupdatejob subcommand examines video metadata from jwplayer and the curren
 generates a list of updates which should be applied. See the documentation for
 :py:mod:`.applyupdatejob` for a description of the update job format.
 
+With --merge-join, the SMS export and jwplayer metadata are each sorted on SMS id, spilling to
+temporary files if they are too large, and matched by :py:func:`.merge_join_job_creator` in a
+single streaming pass. Jobs are written as they are generated and so memory use is bounded
+however large the library.
+
+Managed jwplayer resources whose SMS id matches no SMS entity are "unmatched". With
+--unmatched-report, the key and SMS id of each is written to a CSV file. With
+--delete-unmatched, a job to delete each is added to the "delete" section of the job description
+so that they are cleaned up in the same pass. As a safeguard, if there would be more than
+--max-deletes, by default :py:data:`.MAX_DELETES`, such jobs an error is logged and none are
+generated.
+
 """
+import contextlib
+import csv
+import heapq
+import itertools
 import json
 import logging
+import operator
 import re
+import tempfile
 import urllib.parse
 import dateutil.parser
 
 from sms2jwplayer.institutions import INSTIDS
 from . import csv as smscsv
-from .util import output_stream, get_key_path, parse_custom_prop, get_data_type
+from .extsort import sort_external
+from .profiling import stage
+from .snapshot import load_resources, load_sorted_resources
+from .util import (
+    output_stream, get_key_path, parse_custom_prop, get_data_type, decode_id_set,
+    encode_id_list, DELETE_KEY_PARAMS)
 
 LOG = logging.getLogger(__name__)
 
+#: Default maximum number of delete jobs generated by --delete-unmatched
+MAX_DELETES = 100
+
+#: Name of the SMS id on which SMS entities and jwplayer resources are matched by each sub
+#: command
+ID_NAMES = {'videos': 'media', 'channels': 'collection', 'videos_in_channels': 'collection'}
+
 
 def main(opts):
 
     sub_cmd, data_type, item_type = get_data_type(opts)
 
-    metadata = []
-    for metadata_fn in opts['<metadata>']:
-        with open(metadata_fn) as f:
-            metadata.extend(json.load(f).get(data_type, []))
-    LOG.info('Loaded metadata for %s %s', len(metadata), data_type)
-
-    with open(opts['<csv>']) as f:
+    if opts.get('--merge-join'):
+        id_name = ID_NAMES[sub_cmd]
+        metadata = load_sorted_resources(opts, data_type, id_name)
+        with open(opts['<csv>']) as f, output_stream(opts) as fobj, \
+                unmatched_report_stream(opts) as report:
+            items = sort_external(
+                smscsv.iter_load(item_type, f), operator.attrgetter(id_name + '_id'))
+            globals()['process_' + sub_cmd](
+                opts, fobj, items, metadata, merge_join=True, report=report)
+        return
+
+    with stage('metadata load'):
+        metadata, n_metadata = load_resources(opts, data_type)
+    LOG.info('Loaded metadata for %s %s', n_metadata, data_type)
+
+    with stage('CSV load'), open(opts['<csv>']) as f:
         items = smscsv.load(item_type, f)
     LOG.info('Loaded %s %s item(s) from export', len(items), item_type.__name__)
 
-    with output_stream(opts) as fobj:
-        globals()['process_' + sub_cmd](opts, fobj, items, metadata)
+    with output_stream(opts) as fobj, unmatched_report_stream(opts) as report:
+        globals()['process_' + sub_cmd](opts, fobj, items, metadata, report=report)
+
+
+@contextlib.contextmanager
+def unmatched_report_stream(opts):
+    """
+    Context manager which opens the file given by --unmatched-report for writing or yields
+    ``None`` if the option is not set.
+
+    """
+    if opts.get('--unmatched-report') is None:
+        yield None
+        return
+    with open(opts['--unmatched-report'], 'w') as report:
+        yield report
+
 
+def unmatched_options(opts, data_type, report):
+    """
+    Return a dictionary of the keyword arguments to :py:func:`.generic_job_creator` or
+    :py:func:`.merge_join_job_creator` which handle unmatched resources of *data_type* as
+    specified by *opts*. *report* is the file object to write the unmatched resource report to
+    or ``None``.
 
-def generic_job_creator(fobj, id_name, sms_entities, jw_resources, create, update):
+    """
+    options = {'report': report}
+    if opts.get('--delete-unmatched'):
+        def delete(jw_resource):
+            """Return a single job to delete the unmatched JWPlatform resource."""
+            return [{
+                'type': data_type,
+                'resource': {DELETE_KEY_PARAMS[data_type]: jw_resource['key']},
+            }]
+
+        options['delete'] = delete
+        max_deletes = opts.get('--max-deletes')
+        options['max_deletes'] = int(max_deletes) if max_deletes is not None else MAX_DELETES
+    return options
+
+
+def generic_job_creator(fobj, id_name, sms_entities, jw_resources, create, update, delete=None,
+                        max_deletes=None, report=None, excluded_ids=frozenset()):
     """
     Generic method that generates a set of create/update jobs for the purpose of synchronising
     an aspect of a set of JWPlatform resources (channels or videos) with a set of
     SMS entities (collections or items). The aspect to be synchronised is defined by the
-    create/update callables. These jobs are written to file as JSON document.
+    create/update callables. These jobs are written to file as JSON document and returned.
 
-    :param fobj: file to write the create/update jobs to
+    :param fobj: file to write the create/update jobs to. If ``None``, the jobs are only returned.
     :param id_name: the name of the SMS entity id to use ('collection' or 'clip')
     :param sms_entities: a list of SMS entities
     :param jw_resources: a list of JWPlatform resources
     :param create: a callable that returns a list of create jobs
     :param update: a callable that returns a list of update jobs
+    :param delete: if not ``None``, a callable that returns a list of delete jobs for an
+        unmatched JWPlatform resource. The jobs are added as a "delete" section.
+    :param max_deletes: if not ``None``, the maximum number of delete jobs. If there would be
+        more, an error is logged and the "delete" section is left empty.
+    :param report: if not ``None``, a file to write the unmatched resource report to
+    :param excluded_ids: a container of ids of SMS entities which are in the export but were
+        left out of *sms_entities*. JWPlatform resources with these ids are left alone rather
+        than being treated as unmatched.
+    :return: the job description as a dictionary
 
     """
     # Statistics we record
-    n_skipped = 0
+    n_skipped, n_excluded = 0, 0
 
     # The list of create and update jobs which need to be performed.
     creates, updates = [], []
@@ -74,53 +160,230 @@ def generic_job_creator(fobj, id_name, sms_entities, jw_resources, create, updat
     new_sms_entity_ids = set(sms_entities_by_id.keys())
 
     # Match JWPlatform resources to SMS entities
-    for jw_resource in jw_resources:
-        # Find an existing SMS entity id
-        sms_entity_id_prop = get_key_path(jw_resource, 'custom.sms_' + id_name + '_id')
-        if sms_entity_id_prop is None:
-            n_skipped += 1
-            continue
-
-        # Retrieve the matching SMS entity (or record the inability to do so)
-        try:
-            sms_entity = sms_entities_by_id[
-                int(parse_custom_prop(id_name, sms_entity_id_prop))
-            ]
-        except KeyError:
-            unmatched_jw_resources.append(jw_resource)
-            continue
-
-        # Remove matched entity id from the new_sms_entity_ids set
-        new_sms_entity_ids -= {getattr(sms_entity, id_name + '_id')}
-
-        # We now have a match between a JWPlatform resource and SMS entity. Record the match.
-        associations.append((sms_entity, jw_resource))
-
-    # Generate updates for existing JWPlatform resources.
-    for sms_entity, jw_resource in associations:
-        updates.extend(update(sms_entity, jw_resource))
-
-    # Generate creates for new JWPlatform resources.
-    for sms_entity in (sms_entities_by_id[sms_entity_id] for sms_entity_id in new_sms_entity_ids):
-        creates.extend(create(sms_entity))
+    with stage('matching'):
+        for jw_resource in jw_resources:
+            # Find an existing SMS entity id
+            sms_entity_id_prop = get_key_path(jw_resource, 'custom.sms_' + id_name + '_id')
+            if sms_entity_id_prop is None:
+                n_skipped += 1
+                continue
+
+            # Retrieve the matching SMS entity (or record the inability to do so)
+            sms_entity_id = int(parse_custom_prop(id_name, sms_entity_id_prop))
+            try:
+                sms_entity = sms_entities_by_id[sms_entity_id]
+            except KeyError:
+                if sms_entity_id in excluded_ids:
+                    n_excluded += 1
+                else:
+                    unmatched_jw_resources.append(jw_resource)
+                continue
+
+            # Remove matched entity id from the new_sms_entity_ids set
+            new_sms_entity_ids -= {getattr(sms_entity, id_name + '_id')}
+
+            # We now have a match between a JWPlatform resource and SMS entity. Record the match.
+            associations.append((sms_entity, jw_resource))
+
+    with stage('job generation'):
+        # Generate updates for existing JWPlatform resources.
+        for sms_entity, jw_resource in associations:
+            updates.extend(update(sms_entity, jw_resource))
+
+        # Generate creates for new JWPlatform resources.
+        for sms_entity in (sms_entities_by_id[sms_entity_id]
+                           for sms_entity_id in new_sms_entity_ids):
+            creates.extend(create(sms_entity))
 
     LOG.info('Number of JWPlatform resources matched to SMS entities: %s', len(associations))
     LOG.info('Number of SMS entities with no existing JWPlatform resource: %s',
              len(new_sms_entity_ids))
     LOG.info('Number of managed JWPlatform resources not matched to SMS entities: %s',
              len(unmatched_jw_resources))
+    LOG.info('Number of JWPlatform resources for SMS entities left out of the export: %s',
+             n_excluded)
     LOG.info('Number of JWPlatform resources not managed by sms2jwplayer: %s', n_skipped)
     LOG.info('Number of creation jobs: %s', len(creates))
     LOG.info('Number of update jobs: %s', len(updates))
 
-    json.dump({'create': creates, 'update': updates}, fobj)
+    jobs = {'create': creates, 'update': updates}
+
+    if report is not None:
+        write_unmatched = unmatched_report_writer(report, id_name)
+        for jw_resource in unmatched_jw_resources:
+            write_unmatched(jw_resource)
+
+    if delete is not None:
+        deletes = []
+        for jw_resource in unmatched_jw_resources:
+            deletes.extend(delete(jw_resource))
+        jobs['delete'] = deletes if within_max_deletes(len(deletes), max_deletes) else []
+    if fobj is not None:
+        with stage('serialisation'):
+            json.dump(jobs, fobj)
+    return jobs
+
+
+def unmatched_report_writer(report, id_name):
+    """
+    Start the unmatched resource report in the file object *report* and return a callable which
+    adds an unmatched JWPlatform resource to it. The report is a CSV file with a header row
+    followed by a row giving the key and SMS id of each resource.
+
+    """
+    prop_name = 'sms_' + id_name + '_id'
+    writer = csv.writer(report)
+    writer.writerow(['key', prop_name])
+
+    def write(jw_resource):
+        writer.writerow([
+            jw_resource.get('key'),
+            parse_custom_prop(id_name, get_key_path(jw_resource, 'custom.' + prop_name)),
+        ])
+
+    return write
+
+
+def within_max_deletes(n_deletes, max_deletes):
+    """
+    Return ``True`` if *n_deletes* delete jobs may be generated. If there are more than
+    *max_deletes*, an error is logged and ``False`` is returned. If *max_deletes* is ``None``,
+    there is no maximum.
+
+    """
+    LOG.info('Number of delete jobs: %s', n_deletes)
+    if max_deletes is not None and n_deletes > max_deletes:
+        LOG.error('Not deleting %s unmatched resource(s) since this is more than the maximum '
+                  'of %s', n_deletes, max_deletes)
+        return False
+    return True
 
 
-def process_channels(_, fobj, collections, channels):
+def merge_join_job_creator(fobj, id_name, sms_entities, jw_resources, create, update,
+                           delete=None, max_deletes=None, report=None, excluded_ids=frozenset()):
     """
-    Uses generic_job_creator to generate a set of create/update jobs for the purpose of
-    synchronising the title, description, & custom parameters of a set of JWPlatform channels with
-    a set of SMS collections.
+    As :py:func:`.generic_job_creator` but *sms_entities* and *jw_resources* must be iterables
+    sorted in ascending order of SMS id. Resources with no SMS id may appear anywhere in
+    *jw_resources*. The two are matched in a single pass and each job is written to *fobj* as it
+    is generated rather than being held in memory. Update jobs are written first. Creation and
+    delete jobs are spooled to temporary files until all updates have been written.
+
+    *excluded_ids* may be added to while *sms_entities* is consumed so long as each id is added
+    before any greater id is taken from *sms_entities*.
+
+    :param fobj: file to write the create/update/delete jobs to
+    :return: a dictionary giving the number of "create", "update" and, if *delete* is not
+        ``None``, "delete" jobs generated
+
+    """
+    # Statistics we record
+    n_skipped, n_matched, n_new, n_unmatched, n_excluded = 0, 0, 0, 0, 0
+    n_jobs = {'create': 0, 'update': 0, 'delete': 0}
+
+    write_unmatched = unmatched_report_writer(report, id_name) if report is not None else None
+
+    def keyed_resources():
+        nonlocal n_skipped
+        for jw_resource in jw_resources:
+            sms_entity_id_prop = get_key_path(jw_resource, 'custom.sms_' + id_name + '_id')
+            if sms_entity_id_prop is None:
+                n_skipped += 1
+                continue
+            yield int(parse_custom_prop(id_name, sms_entity_id_prop)), jw_resource
+
+    # Merge the two sorted streams into one of (id, source, position, object) tuples. Within an
+    # id, SMS entities come before JWPlatform resources. The position is unique so that the
+    # objects themselves are never compared.
+    sms_stream = (
+        (getattr(sms_entity, id_name + '_id'), 0, position, sms_entity)
+        for position, sms_entity in enumerate(sms_entities)
+    )
+    jw_stream = (
+        (sms_entity_id, 1, position, jw_resource)
+        for position, (sms_entity_id, jw_resource) in enumerate(keyed_resources())
+    )
+
+    def write_jobs(out, jobs, kind):
+        for job in jobs:
+            if n_jobs[kind] > 0:
+                out.write(', ')
+            json.dump(job, out)
+            n_jobs[kind] += 1
+
+    with stage('matching'), tempfile.TemporaryFile('w+') as creates_fobj, \
+            tempfile.TemporaryFile('w+') as deletes_fobj:
+        fobj.write('{"update": [')
+        merged = heapq.merge(sms_stream, jw_stream)
+        for sms_entity_id, group in itertools.groupby(merged, key=operator.itemgetter(0)):
+            sms_entity, matched_jw_resources = None, []
+            for _, source, _, obj in group:
+                if source == 0:
+                    # As with generic_job_creator, the last SMS entity with a given id wins
+                    sms_entity = obj
+                else:
+                    matched_jw_resources.append(obj)
+
+            if sms_entity is None and sms_entity_id in excluded_ids:
+                n_excluded += len(matched_jw_resources)
+            elif sms_entity is None:
+                n_unmatched += len(matched_jw_resources)
+                for jw_resource in matched_jw_resources:
+                    if write_unmatched is not None:
+                        write_unmatched(jw_resource)
+                    if delete is not None:
+                        write_jobs(deletes_fobj, delete(jw_resource), 'delete')
+            elif len(matched_jw_resources) == 0:
+                n_new += 1
+                write_jobs(creates_fobj, create(sms_entity), 'create')
+            else:
+                for jw_resource in matched_jw_resources:
+                    n_matched += 1
+                    write_jobs(fobj, update(sms_entity, jw_resource), 'update')
+
+        fobj.write('], "create": [')
+        _copy_spool(creates_fobj, fobj)
+        fobj.write(']')
+
+        if delete is not None:
+            fobj.write(', "delete": [')
+            if within_max_deletes(n_jobs['delete'], max_deletes):
+                _copy_spool(deletes_fobj, fobj)
+            else:
+                n_jobs['delete'] = 0
+            fobj.write(']')
+        fobj.write('}')
+
+    LOG.info('Number of JWPlatform resources matched to SMS entities: %s', n_matched)
+    LOG.info('Number of SMS entities with no existing JWPlatform resource: %s', n_new)
+    LOG.info('Number of managed JWPlatform resources not matched to SMS entities: %s',
+             n_unmatched)
+    LOG.info('Number of JWPlatform resources for SMS entities left out of the export: %s',
+             n_excluded)
+    LOG.info('Number of JWPlatform resources not managed by sms2jwplayer: %s', n_skipped)
+    LOG.info('Number of creation jobs: %s', n_jobs['create'])
+    LOG.info('Number of update jobs: %s', n_jobs['update'])
+
+    if delete is None:
+        del n_jobs['delete']
+    return n_jobs
+
+
+def _copy_spool(spool, fobj):
+    """Copy the contents of the temporary file *spool* to *fobj*."""
+    spool.seek(0)
+    while True:
+        chunk = spool.read(65536)
+        if chunk == '':
+            break
+        fobj.write(chunk)
+
+
+def process_channels(opts, fobj, collections, channels, merge_join=False, report=None):
+    """
+    Uses generic_job_creator, or merge_join_job_creator if *merge_join* is ``True``, to
+    generate a set of create/update jobs for the purpose of synchronising the title,
+    description, & custom parameters of a set of JWPlatform channels with a set of SMS
+    collections.
 
     """
     def create(collection):
@@ -144,20 +407,28 @@ def process_channels(_, fobj, collections, channels):
             # in the channel resource returned by /channels/list as 'key'.
             the_update = {'channel_key': channel['key']}
             the_update.update(delta)
+
+            # Always identify the collection so that applyupdatejob --shard places the update in
+            # the same shard as the videos_insert/videos_delete jobs for the channel
+            the_update.setdefault('custom', {})['sms_collection_id'] = (
+                expected_channel['custom']['sms_collection_id'])
             return [{
                 'type': 'channels',
                 'resource': the_update,
             }]
         return []
 
-    generic_job_creator(fobj, 'collection', collections, channels, create, update)
+    job_creator = merge_join_job_creator if merge_join else generic_job_creator
+    return job_creator(fobj, 'collection', collections, channels, create, update,
+                       **unmatched_options(opts, 'channels', report))
 
 
-def process_videos_in_channels(_, fobj, collections, channels):
+def process_videos_in_channels(opts, fobj, collections, channels, merge_join=False,
+                               report=None):
     """
-    Uses generic_job_creator to generate a set of create/update jobs for the purpose of
-    synchronising the videos contains by a set of JWPlayer channels with media items contains by
-    a set of SMS collections.
+    Uses generic_job_creator, or merge_join_job_creator if *merge_join* is ``True``, to
+    generate a set of create/update jobs for the purpose of synchronising the videos contains by
+    a set of JWPlayer channels with media items contains by a set of SMS collections.
 
     """
     def create(collection):
@@ -172,27 +443,30 @@ def process_videos_in_channels(_, fobj, collections, channels):
         updates = []
 
         def get_media_ids(prop_name):
-            """Gets either media_ids or failed_media_ids"""
+            """Gets either media_ids or failed_media_ids as a set of ints"""
             media_ids_prop = get_key_path(channel, 'custom.sms_' + prop_name)
             if not media_ids_prop:
-                return []
-            media_ids_list = parse_custom_prop(prop_name, media_ids_prop).strip()
-            return media_ids_list.split(',') if media_ids_list != '' else []
+                return set()
+            return decode_id_set(parse_custom_prop(prop_name, media_ids_prop))
+
+        media_ids = get_media_ids('media_ids')
+        media_ids |= get_media_ids('failed_media_ids')
 
-        media_ids = set(get_media_ids('media_ids'))
-        media_ids |= set(get_media_ids('failed_media_ids'))
+        collection_media_ids = {int(media_id) for media_id in collection.media_ids}
 
-        insert = set(collection.media_ids) - media_ids
+        insert = collection_media_ids - media_ids
         if insert:
             updates.extend(make_videos_in_channels_jobs(collection, 'videos_insert', insert))
 
-        delete = media_ids - set(collection.media_ids)
+        delete = media_ids - collection_media_ids
         if delete:
             updates.extend(make_videos_in_channels_jobs(collection, 'videos_delete', delete))
 
         return updates
 
-    generic_job_creator(fobj, 'collection', collections, channels, create, update)
+    job_creator = merge_join_job_creator if merge_join else generic_job_creator
+    return job_creator(fobj, 'collection', collections, channels, create, update,
+                       **unmatched_options(opts, 'channels', report))
 
 
 def make_videos_in_channels_jobs(collection, job_type, media_ids):
@@ -203,15 +477,20 @@ def make_videos_in_channels_jobs(collection, job_type, media_ids):
     } for media_id in media_ids]
 
 
-def process_videos(opts, fobj, items, videos):
+def process_videos(opts, fobj, items, videos, merge_join=False, report=None):
     """
-    Uses generic_job_creator to generate a set of create/update jobs for the purpose of
-    synchronising the content, title, description, custom parameters, & thumbnail of a set of
-    JWPlatform videos with a set of SMS items.
+    Uses generic_job_creator, or merge_join_job_creator if *merge_join* is ``True``, to
+    generate a set of create/update jobs for the purpose of synchronising the content, title,
+    description, custom parameters, & thumbnail of a set of JWPlatform videos with a set of SMS
+    items.
 
     """
 
-    items = choose_media_format(items)
+    with stage('format selection'):
+        # Media items with no usable format are still in the export and so their videos are
+        # not unmatched
+        skipped_media_ids = set()
+        items = choose_media_format(items, presorted=merge_join, skipped=skipped_media_ids)
 
     # Load items keyed by stripped path
     strip_from = int(opts['--strip-leading'])
@@ -265,24 +544,50 @@ def process_videos(opts, fobj, items, videos):
                 updates.append({
                     'type': 'image_load',
                     'resource': {
-                        'video_key': video['key'], 'image_url': image_url(opts, item)
+                        'video_key': video['key'], 'image_url': image_url(opts, item),
+                        'image_md5': item.image_md5,
                     },
                 })
 
         # decision on creating image_check job
         if item.image_md5 and video['custom'].get('sms_image_status') == 'image_status:loaded:':
             # there is an SMS image and the image has been loaded but needs to be checked
-            updates.append({'type': 'image_check', 'resource': {'video_key': video['key']}})
+            updates.append({'type': 'image_check', 'resource': {
+                'video_key': video['key'], 'image_status': video['custom']['sms_image_status'],
+            }})
 
         return updates
 
-    generic_job_creator(fobj, 'media', items, videos, create, update)
+    job_creator = merge_join_job_creator if merge_join else generic_job_creator
+    return job_creator(fobj, 'media', items, videos, create, update,
+                       excluded_ids=skipped_media_ids,
+                       **unmatched_options(opts, 'videos', report))
 
 
-def choose_media_format(items):
+def choose_media_format(items, presorted=False, skipped=None):
     """Accepts a list of media items. For each media_id the list can contain a VIDEO item or
     an AUDIO item or both. The list is returned with only one item per media_id -
-    if both VIDEO & MEDIA items are present only the VIDEO item is returned. """
+    if both VIDEO & MEDIA items are present only the VIDEO item is returned.
+
+    If *presorted* is ``True``, *items* may be any iterable sorted by media_id and a generator
+    is returned which only holds the items for one media_id in memory at a time.
+
+    If *skipped* is not ``None``, it is a set to which the media_id of each item with no usable
+    format is added. Ids are added as soon as they are known to be skipped.
+
+    """
+    def choose(media_items):
+        best_item = _choose_media_item(media_items)
+        if best_item is None and skipped is not None:
+            skipped.add(media_items[0].media_id)
+        return best_item
+
+    if presorted:
+        groups = (
+            list(media_items) for _, media_items in
+            itertools.groupby(items, key=operator.attrgetter('media_id'))
+        )
+        return (item for item in (choose(g) for g in groups) if item is not None)
 
     items_by_media_id = {}
     for item in items:
@@ -291,55 +596,59 @@ def choose_media_format(items):
         items_by_media_id[item.media_id] = media_items
 
     pruned_items = []
-
-    # Desired format in descending order
-    desired_formats = [
-        (smscsv.MediaFormat.VIDEO, smscsv.MediaQuality.HIGH),
-        (smscsv.MediaFormat.MPEG4, smscsv.MediaQuality.HIGH),
-        (smscsv.MediaFormat.MPEG4, smscsv.MediaQuality.HIGH_RES),
-        (smscsv.MediaFormat.MPEG4, smscsv.MediaQuality.LOW_RES),
-        (smscsv.MediaFormat.WMV, smscsv.MediaQuality.HIGH),
-        (smscsv.MediaFormat.FLV, smscsv.MediaQuality.HIGH),
-        (smscsv.MediaFormat.FLV, smscsv.MediaQuality.MEDIUM),
-        (smscsv.MediaFormat.FLV, smscsv.MediaQuality.LOW),
-        (smscsv.MediaFormat.IPOD, smscsv.MediaQuality.HIGH),
-        (smscsv.MediaFormat.IPOD, smscsv.MediaQuality.MEDIUM),
-        (smscsv.MediaFormat.IPOD, smscsv.MediaQuality.LOW),
-        (smscsv.MediaFormat.AUDIO, smscsv.MediaQuality.HIGH),
-        (smscsv.MediaFormat.AAC, smscsv.MediaQuality.HIGH),
-        (smscsv.MediaFormat.MP3, smscsv.MediaQuality.HIGH),
-        (smscsv.MediaFormat.AAC, smscsv.MediaQuality.MEDIUM),
-        (smscsv.MediaFormat.MP3, smscsv.MediaQuality.MEDIUM),
-        (smscsv.MediaFormat.AAC, smscsv.MediaQuality.LOW),
-        (smscsv.MediaFormat.MP3, smscsv.MediaQuality.LOW),
-    ]
-
     for media_items in items_by_media_id.values():
-        if set(item.filename for item in media_items) == {''}:
-            LOG.warning(
-                'Skipping item media_id=%s since it has no files at all', media_items[0].media_id)
-            continue
-
-        format_quality_pairs = {(item.format, item.quality): item for item in media_items}
-
-        best_item = None
-        for f in desired_formats:
-            item = format_quality_pairs.get(f)
-            if item is not None and item.filename != '':
-                best_item = item
-                break
-
+        best_item = choose(media_items)
         if best_item is not None:
             pruned_items.append(best_item)
-        else:
-            LOG.warning('Could not find format for item: media_id=%s', media_items[0].media_id)
-            LOG.warning('Formats and filenames:')
-            for item in media_items:
-                LOG.warning('    %s', repr([(item.format, item.quality, item.filename)]))
 
     return pruned_items
 
 
+# Desired format in descending order
+DESIRED_FORMATS = [
+    (smscsv.MediaFormat.VIDEO, smscsv.MediaQuality.HIGH),
+    (smscsv.MediaFormat.MPEG4, smscsv.MediaQuality.HIGH),
+    (smscsv.MediaFormat.MPEG4, smscsv.MediaQuality.HIGH_RES),
+    (smscsv.MediaFormat.MPEG4, smscsv.MediaQuality.LOW_RES),
+    (smscsv.MediaFormat.WMV, smscsv.MediaQuality.HIGH),
+    (smscsv.MediaFormat.FLV, smscsv.MediaQuality.HIGH),
+    (smscsv.MediaFormat.FLV, smscsv.MediaQuality.MEDIUM),
+    (smscsv.MediaFormat.FLV, smscsv.MediaQuality.LOW),
+    (smscsv.MediaFormat.IPOD, smscsv.MediaQuality.HIGH),
+    (smscsv.MediaFormat.IPOD, smscsv.MediaQuality.MEDIUM),
+    (smscsv.MediaFormat.IPOD, smscsv.MediaQuality.LOW),
+    (smscsv.MediaFormat.AUDIO, smscsv.MediaQuality.HIGH),
+    (smscsv.MediaFormat.AAC, smscsv.MediaQuality.HIGH),
+    (smscsv.MediaFormat.MP3, smscsv.MediaQuality.HIGH),
+    (smscsv.MediaFormat.AAC, smscsv.MediaQuality.MEDIUM),
+    (smscsv.MediaFormat.MP3, smscsv.MediaQuality.MEDIUM),
+    (smscsv.MediaFormat.AAC, smscsv.MediaQuality.LOW),
+    (smscsv.MediaFormat.MP3, smscsv.MediaQuality.LOW),
+]
+
+
+def _choose_media_item(media_items):
+    """Return the item in the best format from *media_items*, a list of items sharing a
+    media_id, or ``None`` if none has a usable format."""
+    if set(item.filename for item in media_items) == {''}:
+        LOG.warning(
+            'Skipping item media_id=%s since it has no files at all', media_items[0].media_id)
+        return None
+
+    format_quality_pairs = {(item.format, item.quality): item for item in media_items}
+
+    for f in DESIRED_FORMATS:
+        item = format_quality_pairs.get(f)
+        if item is not None and item.filename != '':
+            return item
+
+    LOG.warning('Could not find format for item: media_id=%s', media_items[0].media_id)
+    LOG.warning('Formats and filenames:')
+    for item in media_items:
+        LOG.warning('    %s', repr([(item.format, item.quality, item.filename)]))
+    return None
+
+
 def updated_keys(source, target):
     """Return a dict which is the delta between source and target. Keys in target which have
     different values or do not exist in source are returned.
@@ -448,9 +757,9 @@ def make_resource_for_channel(collection):
             ),
             'sms_updated_by': 'updated_by:{}:'.format(collection.updated_by),
             # This field holds the media ids of what should be in the collection irrespective of
-            # how we've synchronised it so far.
+            # how we've synchronised it so far, in the order given by SMS.
             'sms_collection_media_ids': 'collection_media_ids:{}:'.format(
-                ','.join(str(mid) for mid in collection.media_ids)),
+                encode_id_list(collection.media_ids)),
         },
     }
 
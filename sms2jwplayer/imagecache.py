@@ -0,0 +1,227 @@
+"""
+The :py:mod:`~sms2jwplayer.imagecache` module implements an on-disk cache of thumbnail images
+addressed by the MD5 hash of their content. Many SMS media items share a thumbnail and so the
+cache allows each distinct image to be downloaded once and then uploaded for every video which
+uses it.
+
+The cache is bounded in size by evicting the least recently used images which are not in use.
+
+"""
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+
+LOG = logging.getLogger(__name__)
+
+#: Default maximum total size in bytes of the images in the cache
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+#: Number of bytes downloaded at a time
+CHUNK_SIZE = 64 * 1024
+
+#: Format of an MD5 hash as used in file names
+MD5_RE = re.compile(r'^[0-9a-f]{32}$')
+
+#: Leading bytes of common image formats and their content types
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF8', 'image/gif'),
+)
+
+#: An image in the cache. If temporary is True, the image is not stored in the cache and the
+#: file at path should be removed once used.
+CachedImage = collections.namedtuple('CachedImage', 'path size content_type temporary')
+
+
+class ImageTooLargeError(Exception):
+    """Raised if an image is larger than the maximum size which may be downloaded."""
+
+
+class ImageCache:
+    """
+    A cache of images stored in *directory* which is created if it does not exist. If the total
+    size of the images exceeds *max_bytes*, the least recently used images which are not in use
+    are removed.
+
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        #: Number of images found in and missing from the cache
+        self.hits, self.misses = 0, 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Map from MD5 to size of each image in order of last use
+        self._sizes = collections.OrderedDict()
+        entries = sorted(
+            (entry for entry in os.scandir(directory) if MD5_RE.match(entry.name)),
+            key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            self._sizes[entry.name] = entry.stat().st_size
+
+        self._lock = threading.Lock()
+
+        # Number of users of each image which is in use. Images in use are never evicted.
+        self._in_use = collections.Counter()
+
+        # Map from MD5 to an event set once the image being downloaded has been stored
+        self._downloading = {}
+
+    @contextlib.contextmanager
+    def open(self, image_md5, image_url, session, max_size=None):
+        """
+        Context manager which yields a :py:class:`.CachedImage` for the image with MD5 hash
+        *image_md5*. If the image is not in the cache, it is downloaded from *image_url* using
+        *session*, a :py:class:`requests.Session`. Concurrent requests for the same image
+        download it once. The image is not evicted until the context exits.
+
+        If the downloaded image does not match *image_md5*, it is not cached and the yielded
+        image is marked as temporary and removed when the context exits.
+
+        Raises :py:exc:`.ImageTooLargeError` if the image is larger than *max_size* bytes or
+        than the cache itself.
+
+        """
+        image_md5 = image_md5.lower()
+        if not MD5_RE.match(image_md5):
+            raise ValueError('Invalid MD5: {}'.format(image_md5))
+
+        image = self._acquire(image_md5, image_url, session, max_size)
+        try:
+            yield image
+        finally:
+            if image.temporary:
+                os.remove(image.path)
+            else:
+                with self._lock:
+                    self._in_use[image_md5] -= 1
+                    if self._in_use[image_md5] == 0:
+                        del self._in_use[image_md5]
+                    self._evict()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sizes)
+
+    def _acquire(self, image_md5, image_url, session, max_size):
+        """
+        Return a :py:class:`.CachedImage` for *image_md5*, downloading it if need be. Unless it
+        is temporary, the image is marked as in use.
+
+        """
+        path = os.path.join(self.directory, image_md5)
+        while True:
+            with self._lock:
+                size = self._sizes.get(image_md5)
+                if size is not None:
+                    self._sizes.move_to_end(image_md5)
+                    self._in_use[image_md5] += 1
+                    self.hits += 1
+                    break
+
+                download = self._downloading.get(image_md5)
+                if download is None:
+                    download = self._downloading[image_md5] = threading.Event()
+                    self.misses += 1
+                    break
+
+            # Another worker is downloading the image so wait for it and look again
+            download.wait()
+
+        if size is not None:
+            # Record the use so that the order of use survives between runs
+            os.utime(path)
+            return CachedImage(path, size, _content_type(path), False)
+
+        try:
+            limit = self.max_bytes if max_size is None else min(max_size, self.max_bytes)
+            tmp_path, size, actual_md5 = self._download(image_url, session, limit)
+
+            if actual_md5 != image_md5:
+                LOG.warning('Image at %s has MD5 %s not %s; not caching',
+                            image_url, actual_md5, image_md5)
+                return CachedImage(tmp_path, size, _content_type(tmp_path), True)
+
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._sizes[image_md5] = size
+                self._in_use[image_md5] += 1
+                self._evict()
+            return CachedImage(path, size, _content_type(path), False)
+        finally:
+            with self._lock:
+                del self._downloading[image_md5]
+            download.set()
+
+    def _download(self, image_url, session, limit):
+        """
+        Download *image_url* to a temporary file in the cache directory and return its path,
+        size and MD5 hash. Raise :py:exc:`.ImageTooLargeError` if it is larger than *limit*
+        bytes.
+
+        """
+        from . import util
+
+        md5, size = hashlib.md5(), 0
+        response = session.get(image_url, stream=True, timeout=util.THUMBNAIL_TIMEOUT)
+        try:
+            response.raise_for_status()
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp',
+                                             delete=False) as fobj:
+                try:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        md5.update(chunk)
+                        size += len(chunk)
+                        if size > limit:
+                            raise ImageTooLargeError(
+                                'Image at {} is larger than {} bytes'.format(image_url, limit))
+                        fobj.write(chunk)
+                except Exception:
+                    os.remove(fobj.name)
+                    raise
+        finally:
+            response.close()
+        return fobj.name, size, md5.hexdigest()
+
+    def _evict(self):
+        # Must be called with the lock held
+        total = sum(self._sizes.values())
+        for image_md5, size in list(self._sizes.items()):
+            if total <= self.max_bytes:
+                break
+            if self._in_use[image_md5] > 0:
+                continue
+            del self._sizes[image_md5]
+            try:
+                os.remove(os.path.join(self.directory, image_md5))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    """A generator which yields the contents of the file at *path* in chunks."""
+    with open(path, 'rb') as fobj:
+        while True:
+            chunk = fobj.read(chunk_size)
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+
+def _content_type(path):
+    """Return the content type of the image at *path* guessed from its leading bytes."""
+    with open(path, 'rb') as fobj:
+        head = fobj.read(8)
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return 'application/octet-stream'
@@ -0,0 +1,183 @@
+"""
+The mergejobs subcommand combines one or more job descriptions as generated by genupdatejob or
+tidy into a single normalised job description which makes as few API calls as possible. The
+same normalisation is applied by applyupdatejob before any jobs are applied.
+
+Normalisation is performed as follows:
+
+- Updates to the same video or channel are merged into a single update. Where updates conflict,
+  later ones take precedence.
+
+- Creates of a video or channel for the same SMS id are merged into a single create.
+
+- Only the last thumbnail upload and thumbnail check for each video are kept.
+
+- An insert of a media item into a collection and a deletion of the same media item from the
+  same collection in the same list of jobs cancel each other out. Repeated inserts or deletions
+  are made once.
+
+- Deletions of the same resource are made once and updates to resources which are to be deleted
+  are dropped.
+
+- Updates which would not change anything are dropped.
+
+The merged jobs are placed at the position of the first job they were merged from.
+
+"""
+import collections
+import copy
+import json
+import logging
+
+from . import util
+
+LOG = logging.getLogger(__name__)
+
+#: Parameter identifying the resource changed by each type of update job and the jwplayer data
+#: type of that resource
+UPDATE_KEY_PARAMS = {
+    'videos': ('videos', 'video_key'),
+    'channels': ('channels', 'channel_key'),
+    'image_load': ('videos', 'video_key'),
+    'image_check': ('videos', 'video_key'),
+}
+
+#: Custom property identifying the SMS entity for each type of create job
+CREATE_ID_PROPS = {'videos': 'sms_media_id', 'channels': 'sms_collection_id'}
+
+#: Types of job which change the videos in a channel mapped to the type which undoes them
+MEMBERSHIP_INVERSES = {'videos_insert': 'videos_delete', 'videos_delete': 'videos_insert'}
+
+
+def main(opts):
+    job_descriptions = []
+    for path in opts['<job>']:
+        with open(path) as f:
+            job_descriptions.append(json.load(f))
+
+    jobs = merge_jobs(job_descriptions)
+
+    with util.output_stream(opts) as fobj:
+        json.dump(jobs, fobj)
+
+
+def merge_jobs(job_descriptions):
+    """
+    Return a single normalised job description combining each job description in
+    *job_descriptions*. The job descriptions are not modified.
+
+    """
+    creates, updates, deletes = [], [], []
+    for jobs in job_descriptions:
+        creates.extend(jobs.get('create', []))
+        updates.extend(jobs.get('update', []))
+        deletes.extend(jobs.get('delete', []))
+
+    # Set of (data type, key) tuples for each resource which is deleted
+    deleted = set()
+    merged_deletes = []
+    for delete in deletes:
+        type_, resource = delete.get('type'), delete.get('resource', {})
+        key = resource.get(util.DELETE_KEY_PARAMS.get(type_))
+        if key is not None:
+            if (type_, key) in deleted:
+                continue
+            deleted.add((type_, key))
+        merged_deletes.append(delete)
+
+    merged = {
+        'create': _merge(creates, _create_identity, deleted),
+        'update': [
+            job for job in _merge(updates, _update_identity, deleted) if not _is_noop(job)
+        ],
+        'delete': merged_deletes,
+    }
+
+    n_before = len(creates) + len(updates) + len(deletes)
+    n_after = sum(len(merged_jobs) for merged_jobs in merged.values())
+    LOG.info('Normalised %s job(s) to %s job(s)', n_before, n_after)
+
+    return merged
+
+
+def _merge(jobs, identity, deleted):
+    """
+    Return a list of the create or update jobs from *jobs* merged as described in the module
+    documentation. *identity* is a callable taking the type and resource of a job which returns
+    a tuple of the (data type, key) of the resource changed by the job, or ``None`` if it is not
+    known, and a hashable identity shared by jobs which may be merged, or ``None`` if the job
+    should be left alone. Jobs changing resources in *deleted* are dropped.
+
+    """
+    # Map from identity to merged job
+    merged = collections.OrderedDict()
+
+    for index, job in enumerate(jobs):
+        type_, resource = job.get('type'), job.get('resource', {})
+        target, job_identity = identity(type_, resource)
+
+        if target in deleted:
+            continue
+
+        if job_identity is None:
+            merged[('unmerged', index)] = job
+            continue
+
+        existing = merged.get(job_identity)
+        if existing is None:
+            merged[job_identity] = job
+        elif type_ in MEMBERSHIP_INVERSES:
+            # Repeated changes are made once and opposing changes cancel each other out
+            if existing.get('type') == MEMBERSHIP_INVERSES[type_]:
+                del merged[job_identity]
+        elif type_ in {'image_load', 'image_check'}:
+            merged[job_identity] = job
+        else:
+            merged_job = copy.deepcopy(existing)
+            _merge_resource(merged_job.setdefault('resource', {}), resource)
+            merged[job_identity] = merged_job
+
+    return list(merged.values())
+
+
+def _create_identity(type_, resource):
+    if type_ in MEMBERSHIP_INVERSES:
+        return None, ('membership', resource.get('collection_id'), resource.get('media_id'))
+
+    sms_id = util.get_key_path(resource, 'custom.' + CREATE_ID_PROPS.get(type_, ''))
+    if sms_id is None:
+        return None, None
+    return None, ('create', type_, sms_id)
+
+
+def _update_identity(type_, resource):
+    if type_ in MEMBERSHIP_INVERSES:
+        return None, ('membership', resource.get('collection_id'), resource.get('media_id'))
+
+    if type_ not in UPDATE_KEY_PARAMS:
+        return None, None
+
+    data_type, key_param = UPDATE_KEY_PARAMS[type_]
+    key = resource.get(key_param)
+    if key is None:
+        return None, None
+    return (data_type, key), ('update', type_, key)
+
+
+def _merge_resource(target, source):
+    """Recursively update the resource dictionary *target* with the properties in *source*."""
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_resource(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def _is_noop(job):
+    """Return ``True`` if *job* is an update to a video or channel which changes nothing."""
+    type_, resource = job.get('type'), job.get('resource', {})
+    if type_ not in {'videos', 'channels'}:
+        return False
+    _, key_param = UPDATE_KEY_PARAMS[type_]
+    return key_param in resource and all(
+        value == {} for key, value in resource.items() if key != key_param)
@@ -0,0 +1,94 @@
+"""
+The mergelogs subcommand combines the log files written by several runs of applyupdatejob into
+a single log file of the same format. This is useful when jobs have been applied by several
+processes or hosts each working on a shard of the jobs. The responses in each log are
+concatenated and the deferred jobs are merged as described in :py:mod:`~sms2jwplayer.mergejobs`.
+
+Journals written via --journal may be merged in the same way as logs.
+
+If the logs record that they are from a sharded run, a warning is logged if any shard is missing
+or appears in more than one file. A journal appended to by several runs of the same shard
+records that shard once.
+
+"""
+import collections
+import json
+import logging
+
+from . import mergejobs
+from . import util
+
+LOG = logging.getLogger(__name__)
+
+#: Keys of the lists of responses in an applyupdatejob log
+RESPONSE_KEYS = ('create_responses', 'update_responses', 'delete_responses')
+
+
+def main(opts):
+    logs, shards = [], []
+    for path in opts['<log>']:
+        with open(path) as f:
+            file_logs = load_logs(f)
+        logs.extend(file_logs)
+        shards.extend(distinct_shards(file_logs))
+
+    merged = merge_logs(logs)
+    check_shards(shards)
+
+    with util.output_stream(opts) as fobj:
+        json.dump(merged, fobj)
+
+
+def load_logs(fobj):
+    """
+    Return a list of the logs in the file-like object *fobj* which is either a single JSON
+    document or, for a journal, one JSON document per line.
+
+    """
+    content = fobj.read()
+    try:
+        return [json.loads(content)]
+    except ValueError:
+        return [json.loads(line) for line in content.splitlines() if line.strip() != '']
+
+
+def merge_logs(logs):
+    """Return a single log combining each applyupdatejob log in *logs*."""
+    merged = {key: [] for key in RESPONSE_KEYS}
+    for log in logs:
+        for key in RESPONSE_KEYS:
+            merged[key].extend(log.get(key, []))
+    merged['deferred'] = mergejobs.merge_jobs([log.get('deferred', {}) for log in logs])
+    return merged
+
+
+def distinct_shards(logs):
+    """Return a list of the distinct shards recorded by the logs in *logs*."""
+    shards = []
+    for log in logs:
+        if 'shard' in log and log['shard'] not in shards:
+            shards.append(log['shard'])
+    return shards
+
+
+def check_shards(shards):
+    """
+    Log a warning unless the shards described by *shards*, a list of dictionaries with the
+    "index" and "count" of each shard, include every shard exactly once.
+
+    """
+    if len(shards) == 0:
+        return
+
+    counts = {shard['count'] for shard in shards}
+    if len(counts) > 1:
+        LOG.warning('Logs are from runs with different numbers of shards: %s', sorted(counts))
+        return
+
+    indices = collections.Counter(shard['index'] for shard in shards)
+    missing = sorted(set(range(counts.pop())) - set(indices))
+    repeated = sorted(index for index, count in indices.items() if count > 1)
+    if len(missing) > 0:
+        LOG.warning('Logs are missing shard(s): %s', ', '.join(str(i) for i in missing))
+    if len(repeated) > 0:
+        LOG.warning('Logs repeat shard(s): %s', ', '.join(str(i) for i in repeated))
@@ -0,0 +1,224 @@
+"""
+The :py:mod:`~sms2jwplayer.metrics` module records metrics about the calls made to the jwplayer
+APIs: the latency and outcome of each call by endpoint, the number of calls retried and why,
+the time spent sleeping to respect rate limits and the number of jobs completed.
+
+Metrics are recorded in :py:data:`.REGISTRY`. Backoff and job metrics are always recorded. Per
+endpoint metrics for the jwplatform client are only recorded once the registry is enabled since
+clients returned by :py:func:`sms2jwplayer.util.get_jwplatform_client` are then wrapped in an
+:py:class:`.InstrumentedClient`.
+
+The metrics may be written in the Prometheus text exposition format, suitable for the textfile
+collector of the node exporter, or as a JSON summary.
+
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+#: Upper bounds in seconds of the buckets of the API call latency histograms
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+#: Prefix of the name of each exported metric
+METRIC_PREFIX = 'sms2jwplayer_'
+
+
+class Metrics:
+    """
+    A thread-safe registry of metrics. If *enabled* is ``True``, jwplatform clients are
+    instrumented.
+
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Discard all recorded metrics."""
+        with self._lock:
+            self.started_at = time.monotonic()
+
+            # Map from endpoint to list of counts per bucket plus the sum and count of latencies
+            self._latencies = {}
+
+            # Map from (endpoint, outcome) to number of calls
+            self._calls = {}
+
+            # Map from reason to number of retries
+            self._retries = {}
+
+            self._sleep_seconds = 0.
+            self._jobs = 0
+
+    @contextlib.contextmanager
+    def time_call(self, endpoint):
+        """
+        Context manager which records the latency of an API call to *endpoint* made within the
+        context. The outcome is "ok" unless an exception is raised in which case it is the name
+        of the exception's class.
+
+        """
+        outcome = 'ok'
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            outcome = e.__class__.__name__
+            raise
+        finally:
+            self.record_call(endpoint, time.monotonic() - start, outcome)
+
+    def record_call(self, endpoint, seconds, outcome='ok'):
+        """Record an API call to *endpoint* which took *seconds* and had *outcome*."""
+        with self._lock:
+            histogram = self._latencies.setdefault(endpoint, [0] * len(LATENCY_BUCKETS) + [0., 0])
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+            self._calls[(endpoint, outcome)] = self._calls.get((endpoint, outcome), 0) + 1
+
+    def record_retry(self, reason):
+        """Record that a call was retried because of *reason*, e.g. "rate_limit"."""
+        with self._lock:
+            self._retries[reason] = self._retries.get(reason, 0) + 1
+
+    def record_job(self, count=1):
+        """Record that *count* jobs have been completed."""
+        with self._lock:
+            self._jobs += count
+
+    def sleep(self, seconds):
+        """Sleep for *seconds* and record the time spent sleeping."""
+        time.sleep(seconds)
+        with self._lock:
+            self._sleep_seconds += seconds
+
+    def summary(self):
+        """Return a JSON-serialisable dictionary summarising the metrics."""
+        with self._lock:
+            elapsed = time.monotonic() - self.started_at
+            endpoints = {}
+            for endpoint, histogram in sorted(self._latencies.items()):
+                endpoints[endpoint] = {
+                    'count': histogram[-1],
+                    'mean_seconds': histogram[-2] / histogram[-1],
+                    'outcomes': {
+                        outcome: count for (call_endpoint, outcome), count in self._calls.items()
+                        if call_endpoint == endpoint
+                    },
+                }
+            return {
+                'elapsed_seconds': elapsed,
+                'endpoints': endpoints,
+                'retries': dict(self._retries),
+                'rate_limit_hits': self._retries.get('rate_limit', 0),
+                'sleep_seconds': self._sleep_seconds,
+                'jobs': self._jobs,
+                'jobs_per_second': self._jobs / elapsed if elapsed > 0 else 0.,
+            }
+
+    def prometheus_text(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        summary = self.summary()
+        with self._lock:
+            latencies = sorted(self._latencies.items())
+            calls = sorted(self._calls.items())
+            retries = sorted(self._retries.items())
+
+        lines = []
+
+        def metric(name, type_, help_text):
+            lines.append('# HELP {}{} {}'.format(METRIC_PREFIX, name, help_text))
+            lines.append('# TYPE {}{} {}'.format(METRIC_PREFIX, name, type_))
+
+        def sample(name, value, **labels):
+            label_text = ','.join(
+                '{}="{}"'.format(k, _escape(v)) for k, v in sorted(labels.items()))
+            lines.append('{}{}{} {}'.format(
+                METRIC_PREFIX, name, '{' + label_text + '}' if label_text else '', value))
+
+        metric('api_request_duration_seconds', 'histogram', 'Latency of jwplayer API calls.')
+        for endpoint, histogram in latencies:
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                sample('api_request_duration_seconds_bucket', count, endpoint=endpoint,
+                       le=repr(bound))
+            sample('api_request_duration_seconds_bucket', histogram[-1], endpoint=endpoint,
+                   le='+Inf')
+            sample('api_request_duration_seconds_sum', histogram[-2], endpoint=endpoint)
+            sample('api_request_duration_seconds_count', histogram[-1], endpoint=endpoint)
+
+        metric('api_requests_total', 'counter', 'Number of jwplayer API calls by outcome.')
+        for (endpoint, outcome), count in calls:
+            sample('api_requests_total', count, endpoint=endpoint, outcome=outcome)
+
+        metric('api_retries_total', 'counter', 'Number of retried API calls by reason.')
+        for reason, count in retries:
+            sample('api_retries_total', count, reason=reason)
+
+        metric('backoff_sleep_seconds_total', 'counter', 'Time spent backing off.')
+        sample('backoff_sleep_seconds_total', summary['sleep_seconds'])
+
+        metric('jobs_total', 'counter', 'Number of jobs completed.')
+        sample('jobs_total', summary['jobs'])
+
+        metric('jobs_per_second', 'gauge', 'Mean rate at which jobs were completed.')
+        sample('jobs_per_second', summary['jobs_per_second'])
+
+        metric('run_duration_seconds', 'gauge', 'Time since metrics were reset.')
+        sample('run_duration_seconds', summary['elapsed_seconds'])
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """
+        Write the metrics in the Prometheus text format to *path*. The file is written to a
+        temporary file and renamed so that collectors never see a partial file.
+
+        """
+        _write_atomically(path, self.prometheus_text())
+
+    def write_json(self, path):
+        """Write the JSON summary of the metrics to *path*."""
+        _write_atomically(path, json.dumps(self.summary(), indent=2, sort_keys=True))
+
+
+class InstrumentedClient:
+    """
+    A wrapper around a jwplatform client which records the latency and outcome of each API call
+    in *metrics*, a :py:class:`.Metrics` instance. Resources are accessed as for the wrapped
+    client, e.g. ``client.videos.show(video_key=...)`` is recorded against the endpoint
+    "videos/show".
+
+    """
+    def __init__(self, client, metrics, path=()):
+        self._client = client
+        self._metrics = metrics
+        self._path = path
+
+    def __getattr__(self, name):
+        return InstrumentedClient(getattr(self._client, name), self._metrics,
+                                  self._path + (name,))
+
+    def __call__(self, *args, **kwargs):
+        with self._metrics.time_call('/'.join(self._path)):
+            return self._client(*args, **kwargs)
+
+
+#: The registry in which metrics are recorded
+REGISTRY = Metrics()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomically(path, content):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fobj:
+        fobj.write(content)
+    os.replace(tmp_path, path)
@@ -0,0 +1,150 @@
+"""
+The :py:mod:`~sms2jwplayer.profiling` module provides hooks to find out where time and memory go
+when running a subcommand.
+
+A whole subcommand may be profiled by :py:func:`.profile` either deterministically using
+:py:mod:`cProfile` or by periodically sampling the stacks of all threads. The latter has a far
+lower overhead and so is better suited to long-running jobs.
+
+Subcommands wrap each of their stages in :py:func:`.stage`. If stage tracing has been enabled
+via :py:func:`.enable_stage_tracing`, the wall time and peak memory allocated by Python during
+each stage are logged.
+
+"""
+import collections
+import contextlib
+import logging
+import os
+import sys
+import time
+
+LOG = logging.getLogger(__name__)
+
+#: Interval in seconds of CPU time between samples when profiling by sampling
+SAMPLE_INTERVAL = 0.005
+
+#: Profiling modes supported by profile()
+PROFILE_MODES = ('deterministic', 'sampling')
+
+# Whether stage() should log wall time and memory
+_trace_stages = False
+
+
+def enable_stage_tracing():
+    """
+    Start tracing memory allocations and cause :py:func:`.stage` to log each stage. Stages are
+    logged at the INFO level whatever the verbosity of the other logs.
+
+    """
+    import tracemalloc
+
+    global _trace_stages
+    tracemalloc.start()
+    LOG.setLevel(logging.INFO)
+    _trace_stages = True
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Context manager which marks the code run within it as the stage *name*. If stage tracing is
+    enabled, the wall time and peak traced memory of the stage are logged when the context
+    exits. Otherwise this does nothing.
+
+    """
+    if not _trace_stages:
+        yield
+        return
+
+    import tracemalloc
+
+    # Peak memory can only be measured per stage if the peak can be reset
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start
+        current, peak = tracemalloc.get_traced_memory()
+        LOG.info('Stage "%s": %.3fs wall time, %.1f MiB peak, %.1f MiB current', name,
+                 elapsed, peak / (1024 * 1024), current / (1024 * 1024))
+
+
+@contextlib.contextmanager
+def profile(path, mode='deterministic'):
+    """
+    Context manager which profiles the code run within it and writes the profile to *path* when
+    the context exits. If *mode* is "deterministic", :py:mod:`cProfile` is used and the profile
+    is written in the :py:mod:`pstats` format. If *mode* is "sampling", the stacks of all threads
+    are sampled every :py:data:`.SAMPLE_INTERVAL` seconds of CPU time and written in the
+    "folded" format used by flame graph tools: one line per distinct stack giving the frames
+    separated by semicolons and the number of samples.
+
+    """
+    if mode == 'deterministic':
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+    elif mode == 'sampling':
+        sampler = StackSampler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.write(path)
+    else:
+        raise ValueError('Unknown profile mode: {}'.format(mode))
+
+
+class StackSampler:
+    """
+    Samples the stacks of all threads each time the process has used *interval* seconds of CPU
+    time. Sampling is driven by the SIGPROF timer signal and so is only available on Unix and
+    must be started from the main thread.
+
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+
+        #: Counter of stacks, each a tuple of frame descriptions from outermost to innermost
+        self.samples = collections.Counter()
+
+    def start(self):
+        import signal
+
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        import signal
+
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write(self, path):
+        """Write the samples to *path* in the folded stack format."""
+        with open(path, 'w') as fobj:
+            for stack, count in self.samples.most_common():
+                fobj.write('{} {}\n'.format(';'.join(stack), count))
+
+    def _sample(self, signum, current_frame):
+        for thread_id, frame in sys._current_frames().items():
+            # The handler itself is running in the main thread so sample the interrupted frame
+            if frame.f_code is self._sample.__func__.__code__:
+                frame = current_frame
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            self.samples[tuple(reversed(stack))] += 1
@@ -0,0 +1,248 @@
+"""
+The :py:mod:`~sms2jwplayer.snapshot` module implements an on-disk store for jwplayer video and
+channel metadata backed by SQLite. It is an alternative to the loose JSON pages written by the
+fetch subcommand.
+
+Each resource is stored as its raw JSON representation alongside indexed columns holding its key
+and the SMS ids parsed from its custom properties. This allows consumers to look up resources by
+key or SMS id without loading the entire library into memory.
+
+"""
+import json
+import sqlite3
+import threading
+import time
+
+from . import extsort
+from .util import get_key_path, parse_custom_prop
+
+#: jwplayer data types which may be stored
+DATA_TYPES = ('videos', 'channels')
+
+#: SMS id columns stored for each resource. Each is a tuple of column name and the type name
+#: used in the custom prop.
+ID_COLUMNS = (
+    ('sms_media_id', 'media'),
+    ('sms_clip_id', 'clip'),
+    ('sms_collection_id', 'collection'),
+)
+
+#: Number of rows fetched from the database at a time when iterating over resources
+FETCH_SIZE = 1000
+
+
+class SnapshotStore:
+    """
+    A snapshot of jwplayer metadata stored in the SQLite database at *path*. The database is
+    created if it does not exist. Instances may be used as context managers in which case the
+    database is closed when the context exits.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        with self._lock, self._connection:
+            for data_type in DATA_TYPES:
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS {} ('
+                    'key TEXT PRIMARY KEY, sms_media_id INTEGER, sms_clip_id INTEGER, '
+                    'sms_collection_id INTEGER, fetched_at REAL, json TEXT NOT NULL)'.format(
+                        data_type))
+                for column, _ in ID_COLUMNS:
+                    self._connection.execute(
+                        'CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})'.format(
+                            data_type, column))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def upsert(self, data_type, resources, fetched_at=None):
+        """
+        Insert or replace *resources* of *data_type* ('videos' or 'channels') in the store.
+        *fetched_at* is a timestamp recorded alongside each resource which defaults to the
+        current time.
+
+        """
+        fetched_at = fetched_at if fetched_at is not None else time.time()
+        rows = [
+            (resource['key'],) + tuple(_entity_id(resource, column, id_type)
+                                       for column, id_type in ID_COLUMNS)
+            + (fetched_at, json.dumps(resource))
+            for resource in resources
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO {} (key, sms_media_id, sms_clip_id, sms_collection_id, '
+                'fetched_at, json) VALUES (?, ?, ?, ?, ?, ?)'.format(_table(data_type)), rows)
+
+    def delete_fetched_before(self, data_type, fetched_at):
+        """
+        Remove resources of *data_type* which were last fetched before *fetched_at*. Used after
+        a complete fetch to remove resources which no longer exist in jwplayer.
+
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                'DELETE FROM {} WHERE fetched_at < ?'.format(_table(data_type)), (fetched_at,))
+        return cursor.rowcount
+
+    def count(self, data_type):
+        """Return the number of resources of *data_type* in the store."""
+        return self._query_one('SELECT COUNT(*) FROM {}'.format(_table(data_type)))[0]
+
+    def resources(self, data_type):
+        """A generator which yields every resource of *data_type* in the store."""
+        return self._query_resources('SELECT json FROM {}'.format(_table(data_type)))
+
+    def by_key(self, data_type, key):
+        """Return the resource of *data_type* with *key* or ``None`` if there is none."""
+        row = self._query_one(
+            'SELECT json FROM {} WHERE key = ?'.format(_table(data_type)), (key,))
+        return json.loads(row[0]) if row is not None else None
+
+    def by_keys(self, data_type, keys, fetched_after=None):
+        """
+        Return a dictionary mapping keys to resources of *data_type* for each key in *keys*
+        which is present in the store. If *fetched_after* is not ``None``, only resources fetched
+        after that timestamp are returned.
+
+        """
+        keys = list(keys)
+        found = {}
+
+        # Query in chunks to keep below SQLite's limit on the number of parameters
+        for offset in range(0, len(keys), 500):
+            chunk = keys[offset:offset+500]
+            query = 'SELECT json FROM {} WHERE key IN ({})'.format(
+                _table(data_type), ','.join('?' * len(chunk)))
+            params = list(chunk)
+            if fetched_after is not None:
+                query += ' AND fetched_at > ?'
+                params.append(fetched_after)
+            for resource in self._query_resources(query, params):
+                found[resource['key']] = resource
+        return found
+
+    def by_entity_id(self, data_type, entity_type, entity_id):
+        """
+        Return a list of resources of *data_type* whose sms_<entity_type>_id custom prop
+        matches *entity_id*.
+
+        """
+        return list(self._query_resources(
+            'SELECT json FROM {} WHERE {} = ?'.format(
+                _table(data_type), _id_column(entity_type)),
+            (entity_id,)))
+
+    def with_duplicate_entity_ids(self, data_type, entity_type):
+        """
+        A generator which yields every resource of *data_type* which shares its
+        sms_<entity_type>_id with at least one other resource.
+
+        """
+        column = _id_column(entity_type)
+        return self._query_resources(
+            'SELECT json FROM {0} WHERE {1} IN ('
+            'SELECT {1} FROM {0} WHERE {1} IS NOT NULL GROUP BY {1} HAVING COUNT(*) > 1'
+            ') ORDER BY {1}'.format(_table(data_type), column))
+
+    def sorted_by_entity_id(self, data_type, entity_type):
+        """
+        A generator which yields every resource of *data_type* in ascending order of its
+        sms_<entity_type>_id. Resources with no such id are yielded first.
+
+        """
+        return self._query_resources(
+            'SELECT json FROM {0} ORDER BY {1}'.format(
+                _table(data_type), _id_column(entity_type)))
+
+    def _query_one(self, query, params=()):
+        with self._lock:
+            return self._connection.execute(query, params).fetchone()
+
+    def _query_resources(self, query, params=()):
+        # Use a dedicated cursor so that iteration may be interleaved with other queries
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute(query, params)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(FETCH_SIZE)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield json.loads(row[0])
+
+
+def load_resources(opts, data_type):
+    """
+    Given the docopt options dictionary, return an iterable of jwplayer resources of *data_type*
+    and the number of resources. If the --snapshot option is set, the resources are read lazily
+    from the snapshot store. Otherwise they are loaded from the JSON files in <metadata>.
+
+    """
+    if opts.get('--snapshot') is not None:
+        store = SnapshotStore(opts['--snapshot'])
+        return store.resources(data_type), store.count(data_type)
+
+    resources = []
+    for metadata_fn in opts['<metadata>']:
+        with open(metadata_fn) as f:
+            resources.extend(json.load(f).get(data_type, []))
+    return resources, len(resources)
+
+
+def load_sorted_resources(opts, data_type, entity_type):
+    """
+    Given the docopt options dictionary, return an iterable of jwplayer resources of *data_type*
+    in ascending order of their sms_<entity_type>_id with resources with no such id first. The
+    resources are never all held in memory: those in the JSON files in <metadata> are sorted
+    with :py:func:`~.extsort.sort_external`.
+
+    """
+    if opts.get('--snapshot') is not None:
+        return SnapshotStore(opts['--snapshot']).sorted_by_entity_id(data_type, entity_type)
+
+    def resources():
+        for metadata_fn in opts['<metadata>']:
+            with open(metadata_fn) as f:
+                yield from json.load(f).get(data_type, [])
+
+    column = _id_column(entity_type)
+
+    def sort_key(resource):
+        entity_id = _entity_id(resource, column, entity_type)
+        return (0, 0) if entity_id is None else (1, entity_id)
+
+    return extsort.sort_external(resources(), sort_key)
+
+
+def _table(data_type):
+    if data_type not in DATA_TYPES:
+        raise ValueError('Unknown data type: {}'.format(data_type))
+    return data_type
+
+
+def _id_column(entity_type):
+    column = 'sms_{}_id'.format(entity_type)
+    if column not in dict(ID_COLUMNS):
+        raise ValueError('Unknown entity type: {}'.format(entity_type))
+    return column
+
+
+def _entity_id(resource, column, id_type):
+    """Return the integer SMS id stored in custom prop *column* of *resource* or ``None``."""
+    prop = get_key_path(resource, 'custom.' + column)
+    if prop is None:
+        return None
+    try:
+        return int(parse_custom_prop(id_type, prop))
+    except ValueError:
+        return None
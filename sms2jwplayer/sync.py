@@ -0,0 +1,153 @@
+"""
+The sync subcommand runs the entire synchronisation pipeline in a single process. It is
+equivalent to running:
+
+.. code:: console
+
+    $ sms2jwplayer fetch videos --base-name=videos_
+    $ sms2jwplayer fetch channels --base-name=channels_
+    $ sms2jwplayer genupdatejob videos --output=videos_job.json ... <media_csv> videos_*.json
+    $ sms2jwplayer genupdatejob channels --output=channels_job.json \\
+        <collection_csv> channels_*.json
+    $ sms2jwplayer genupdatejob videos_in_channels --output=videos_in_channels_job.json \\
+        <collection_csv> channels_*.json
+    $ sms2jwplayer applyupdatejob videos_job.json
+    $ sms2jwplayer applyupdatejob channels_job.json
+    $ sms2jwplayer applyupdatejob videos_in_channels_job.json
+
+except that metadata and jobs are passed between stages in memory rather than via JSON files.
+Job generation runs in a background thread and each job description is applied as soon as it
+has been generated, so that generation of later jobs overlaps with the application of earlier
+ones.
+
+If a checkpoint directory is given, the fetched metadata and generated jobs are additionally
+written there in the same format used by the individual subcommands.
+
+"""
+import concurrent.futures
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+
+from . import applyupdatejob
+from . import csv as smscsv
+from . import fetch
+from . import genupdatejob
+from . import profiling
+from . import util
+
+LOG = logging.getLogger(__name__)
+
+#: The job generation stages in the order in which they are applied. Each stage is a tuple of
+#: the genupdatejob sub command, the jwplayer data type and the SMS export it is generated from.
+STAGES = [
+    ('videos', 'videos', '<media_csv>'),
+    ('channels', 'channels', '<collection_csv>'),
+    ('videos_in_channels', 'channels', '<collection_csv>'),
+]
+
+
+def main(opts):
+    try:
+        client = util.get_jwplatform_client()
+    except util.JWPlatformClientError as e:
+        LOG.error('jwplatform error: %s', e)
+        sys.exit(1)
+
+    checkpoint_dir = opts['--checkpoint-dir']
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    # Fetch videos and channels concurrently, each with their own client.
+    with profiling.stage('metadata load'), concurrent.futures.ThreadPoolExecutor(2) as executor:
+        futures = {
+            data_type: executor.submit(fetch_all, data_type)
+            for data_type in ('videos', 'channels')
+        }
+        metadata = {data_type: future.result() for data_type, future in futures.items()}
+
+    for data_type, resources in metadata.items():
+        LOG.info('Fetched metadata for %s %s', len(resources), data_type)
+        write_checkpoint(checkpoint_dir, data_type + '.json', {data_type: resources})
+
+    with profiling.stage('CSV load'):
+        with open(opts['<media_csv>']) as f:
+            items = smscsv.load(smscsv.MediaItem, f)
+        with open(opts['<collection_csv>']) as f:
+            collections = smscsv.load(smscsv.CollectionItem, f)
+    LOG.info('Loaded %s media item(s) and %s collection(s) from export',
+             len(items), len(collections))
+    exports = {'<media_csv>': items, '<collection_csv>': collections}
+
+    jobs_queue = queue.Queue()
+    producer = JobProducer(opts, exports, metadata, jobs_queue)
+    producer.start()
+
+    log = {}
+    while True:
+        stage = jobs_queue.get()
+        if stage is None:
+            break
+        sub_cmd, jobs = stage
+        write_checkpoint(checkpoint_dir, sub_cmd + '_job.json', jobs)
+        LOG.info('Applying %s jobs', sub_cmd)
+        with profiling.stage('API application ({})'.format(sub_cmd)):
+            log[sub_cmd] = applyupdatejob.apply_jobs(client, jobs, progress=opts['--verbose'])
+
+    producer.join()
+    if producer.error is not None:
+        raise producer.error
+
+    if opts['--log-file'] is not None:
+        with util.output_stream(opts, '--log-file') as f:
+            json.dump(log, f)
+
+
+def fetch_all(data_type):
+    """Return a list of all jwplayer resources of the given type."""
+    resources = []
+    for page in fetch.fetch_pages(util.get_jwplatform_client(), data_type):
+        resources.extend(page[data_type])
+    return resources
+
+
+class JobProducer(threading.Thread):
+    """
+    A thread which generates the job description for each stage in :py:data:`.STAGES` and puts
+    (sub_cmd, jobs) tuples on *jobs_queue* as they become available. ``None`` is put on the queue
+    once all stages are generated or if generation fails. In the latter case, the exception is
+    recorded in the :py:attr:`.error` attribute.
+
+    """
+    def __init__(self, opts, exports, metadata, jobs_queue):
+        super().__init__(daemon=True)
+        self.opts = opts
+        self.exports = exports
+        self.metadata = metadata
+        self.jobs_queue = jobs_queue
+        self.error = None
+
+    def run(self):
+        try:
+            for sub_cmd, data_type, export in STAGES:
+                LOG.info('Generating %s jobs', sub_cmd)
+                process = getattr(genupdatejob, 'process_' + sub_cmd)
+                jobs = process(self.opts, None, self.exports[export], self.metadata[data_type])
+                self.jobs_queue.put((sub_cmd, jobs))
+        except Exception as e:
+            self.error = e
+        finally:
+            self.jobs_queue.put(None)
+
+
+def write_checkpoint(checkpoint_dir, name, document):
+    """Write *document* as JSON to *name* within *checkpoint_dir* if it is not ``None``."""
+    if checkpoint_dir is None:
+        return
+    path = os.path.join(checkpoint_dir, name)
+    LOG.info('Writing checkpoint: %s', path)
+    with open(path, 'w') as f:
+        json.dump(document, f)
@@ -0,0 +1,484 @@
+"""
+A self-contained local stand-in for the JWPlatform API which can be used to exercise the
+sms2jwplayer subcommands end-to-end without network access. It implements the subset of the v1
+API used by sms2jwplayer (videos, channels, channel videos and thumbnails) along with the v2
+analytics query endpoint.
+
+The server keeps all state in memory and supports configurable per-request latency, a simple
+requests-per-second rate limit and random error injection so that the retry and backoff
+behaviour of the tool can be measured.
+
+To point sms2jwplayer at a running server, set the JWPLAYER_API_URL environment variable to the
+base URL of the server. For example:
+
+.. code:: console
+
+    $ python -m sms2jwplayer.test.fakeapi --port=8080 --latency=0.05 videos_*.json &
+    $ JWPLAYER_API_URL=http://127.0.0.1:8080 sms2jwplayer fetch videos
+
+Usage:
+    fakeapi [--host=HOST] [--port=PORT] [--latency=SECONDS] [--rate-limit=N]
+        [--error-rate=P] [--seed=N] [<metadata>...]
+
+Options:
+    --host=HOST         Interface to listen on. [default: 127.0.0.1]
+    --port=PORT         Port to listen on. [default: 8080]
+    --latency=SECONDS   Delay added to each request. [default: 0]
+    --rate-limit=N      Maximum number of requests per second. 0 means no limit. [default: 0]
+    --error-rate=P      Probability of a request failing with an internal error. [default: 0]
+    --seed=N            Seed for the random number generator used for error injection
+                        and key generation. [default: 0]
+
+    <metadata>          JSON files as written by "sms2jwplayer fetch" used to populate the
+                        initial state of the server.
+
+"""
+import contextlib
+import http.server
+import json
+import logging
+import random
+import string
+import threading
+import time
+import urllib.parse
+
+LOG = logging.getLogger(__name__)
+
+#: Maximum number of results returned by a single list call
+MAX_RESULT_LIMIT = 1000
+
+#: Default number of results returned by a list call
+DEFAULT_RESULT_LIMIT = 50
+
+
+class FakeAPIError(Exception):
+    """
+    An error which is reported to the client using the JWPlatform v1 error format.
+
+    """
+    def __init__(self, http_status, code, message):
+        super().__init__(message)
+        self.http_status = http_status
+        self.code = code
+        self.message = message
+
+
+def not_found(message):
+    return FakeAPIError(404, 'NotFound', message)
+
+
+class FakeJWPlatform:
+    """
+    In-memory model of the JWPlatform resources manipulated by sms2jwplayer. All public methods
+    are thread-safe.
+
+    :param seed: seed for the random number generator used to generate resource keys
+    :param thumbnail_delay: number of seconds after upload for which a thumbnail reports itself
+        as "processing" rather than "ready"
+
+    """
+    def __init__(self, seed=0, thumbnail_delay=0):
+        self.videos = {}
+        self.channels = {}
+        self.channel_videos = {}
+        self.thumbnails = {}
+
+        #: Map from date string to a list of (media_id, country_code, plays) tuples
+        self.analytics = {}
+
+        #: If not None, the maximum number of rows returned per page of analytics
+        self.analytics_max_page_length = None
+
+        self.thumbnail_delay = thumbnail_delay
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+    def load_metadata(self, metadata):
+        """Add resources from a document as returned by /videos/list or /channels/list."""
+        with self._lock:
+            for video in metadata.get('videos', []):
+                self.videos[video['key']] = dict(video)
+            for channel in metadata.get('channels', []):
+                self.channels[channel['key']] = dict(channel)
+                self.channel_videos.setdefault(channel['key'], [])
+
+    def new_key(self):
+        while True:
+            key = ''.join(self._random.choice(string.ascii_letters + string.digits)
+                          for _ in range(8))
+            if key not in self.videos and key not in self.channels:
+                return key
+
+    def call(self, path, params):
+        """
+        Dispatch a v1 API call. *path* is the path relative to /v1/ e.g. "videos/list". Returns
+        the response body as a dictionary or raises :py:class:`.FakeAPIError`.
+
+        """
+        method = getattr(self, 'api_' + path.strip('/').replace('/', '_'), None)
+        if method is None:
+            raise FakeAPIError(404, 'NotFound', 'API method not found: ' + path)
+        with self._lock:
+            response = method(params)
+        response['status'] = 'ok'
+        return response
+
+    # Videos
+
+    def api_videos_list(self, params):
+        return self._list('videos', self.videos, params)
+
+    def api_videos_show(self, params):
+        return {'video': self._get(self.videos, params, 'video_key')}
+
+    def api_videos_create(self, params):
+        key = self.new_key()
+        video = {
+            'key': key, 'mediatype': 'video', 'status': 'ready', 'custom': {},
+            'updated': int(time.time()),
+        }
+        _update_resource(video, params, ignore={'download_url'})
+        self.videos[key] = video
+        return {'video': {'key': key}}
+
+    def api_videos_update(self, params):
+        video = self._get(self.videos, params, 'video_key')
+        _update_resource(video, params, ignore={'video_key'})
+        video['updated'] = int(time.time())
+        return {}
+
+    def api_videos_delete(self, params):
+        # Multiple keys may be specified as a comma separated list
+        keys = _required(params, 'video_key').split(',')
+        missing = [key for key in keys if key not in self.videos]
+        if len(missing) > 0:
+            raise not_found('Video not found: ' + ','.join(missing))
+        for key in keys:
+            del self.videos[key]
+            self.thumbnails.pop(key, None)
+            for video_keys in self.channel_videos.values():
+                if key in video_keys:
+                    video_keys.remove(key)
+        return {}
+
+    def api_videos_thumbnails_update(self, params):
+        video = self._get(self.videos, params, 'video_key')
+        token = '{:032x}'.format(self._random.getrandbits(128))
+        return {'link': {
+            'protocol': 'http', 'address': params['_address'], 'path': '/v1/videos/upload',
+            'query': {'key': video['key'], 'token': token},
+        }}
+
+    def api_videos_thumbnails_show(self, params):
+        key = self._get(self.videos, params, 'video_key')['key']
+        uploaded_at = self.thumbnails.get(key)
+        if uploaded_at is None:
+            status = 'not build'
+        elif time.time() - uploaded_at < self.thumbnail_delay:
+            status = 'processing'
+        else:
+            status = 'ready'
+        return {'thumbnail': {'status': status}}
+
+    def api_videos_upload(self, params):
+        key = _required(params, 'key')
+        if key not in self.videos:
+            raise not_found('Video not found: ' + key)
+        self.thumbnails[key] = time.time()
+        return {'media': {'key': key}}
+
+    # Channels
+
+    def api_channels_list(self, params):
+        return self._list('channels', self.channels, params)
+
+    def api_channels_show(self, params):
+        return {'channel': self._get(self.channels, params, 'channel_key')}
+
+    def api_channels_create(self, params):
+        key = self.new_key()
+        channel = {'key': key, 'type': params.get('type', 'manual'), 'custom': {}, 'videos': {}}
+        _update_resource(channel, params, ignore={'type'})
+        self.channels[key] = channel
+        self.channel_videos[key] = []
+        return {'channel': {'key': key}}
+
+    def api_channels_update(self, params):
+        channel = self._get(self.channels, params, 'channel_key')
+        _update_resource(channel, params, ignore={'channel_key'})
+        return {}
+
+    def api_channels_delete(self, params):
+        key = self._get(self.channels, params, 'channel_key')['key']
+        del self.channels[key]
+        del self.channel_videos[key]
+        return {}
+
+    def api_channels_videos_list(self, params):
+        key = self._get(self.channels, params, 'channel_key')['key']
+        return {'videos': [self.videos[k] for k in self.channel_videos[key] if k in self.videos]}
+
+    def api_channels_videos_create(self, params):
+        channel_key = self._get(self.channels, params, 'channel_key')['key']
+        video_key = self._get(self.videos, params, 'video_key')['key']
+        if video_key in self.channel_videos[channel_key]:
+            raise FakeAPIError(409, 'ItemAlreadyExists', 'Video already in channel')
+        self.channel_videos[channel_key].append(video_key)
+        return {}
+
+    def api_channels_videos_delete(self, params):
+        channel_key = self._get(self.channels, params, 'channel_key')['key']
+        video_key = _required(params, 'video_key')
+        try:
+            self.channel_videos[channel_key].remove(video_key)
+        except ValueError:
+            raise not_found('Video not in channel: ' + video_key)
+        return {}
+
+    # Analytics
+
+    def analytics_query(self, payload):
+        """
+        Answer a v2 analytics query. Only queries of the form made by :py:mod:`.analytics` are
+        supported: the sum of plays by media_id and country_code over a single day.
+
+        """
+        with self._lock:
+            rows = sorted(self.analytics.get(payload.get('start_date'), []),
+                          key=lambda row: row[2], reverse=True)
+        page, page_length = int(payload.get('page', 0)), int(payload.get('page_length', 10))
+        if self.analytics_max_page_length is not None:
+            page_length = min(page_length, self.analytics_max_page_length)
+        return {
+            'metadata': {'column_headers': {
+                'dimensions': [{'field': 'media_id'}, {'field': 'country_code'}],
+                'metrics': [{'field': 'plays', 'operation': 'sum'}],
+            }},
+            'data': {'rows': [list(row) for row in
+                              rows[page * page_length:(page + 1) * page_length]]},
+        }
+
+    def _list(self, name, resources, params):
+        offset = int(params.get('result_offset', 0))
+        limit = min(MAX_RESULT_LIMIT, int(params.get('result_limit', DEFAULT_RESULT_LIMIT)))
+
+        # Searches of the form "search:custom.<name>=<value>" match on substrings of custom props
+        searches = [
+            (key[len('search:custom.'):], value) for key, value in params.items()
+            if key.startswith('search:custom.')
+        ]
+        matching = [
+            resource for resource in resources.values()
+            if all(value in resource.get('custom', {}).get(prop, '') for prop, value in searches)
+        ]
+
+        return {
+            name: [dict(resource) for resource in matching[offset:offset+limit]],
+            'offset': offset, 'limit': limit, 'total': len(matching),
+        }
+
+    def _get(self, resources, params, key_name):
+        key = _required(params, key_name)
+        try:
+            return resources[key]
+        except KeyError:
+            raise not_found('Resource not found: ' + key)
+
+
+def _required(params, name):
+    try:
+        return params[name]
+    except KeyError:
+        raise FakeAPIError(400, 'ParameterMissing', 'Missing parameter: ' + name)
+
+
+def _update_resource(resource, params, ignore=frozenset()):
+    """Update a resource from flattened "a.b" parameters, ignoring API and private parameters."""
+    for name, value in params.items():
+        if name.startswith('api_') or name.startswith('_') or name in ignore:
+            continue
+        if name.startswith('custom.'):
+            resource.setdefault('custom', {})[name[len('custom.'):]] = value
+        else:
+            resource[name] = value
+
+
+class RateLimiter:
+    """
+    A token bucket which allows *rate* requests per second. A *rate* of zero disables limiting.
+
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Return True if the request may proceed, False if it should be rejected."""
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class FakeAPIServer(http.server.ThreadingHTTPServer):
+    """
+    HTTP server exposing a :py:class:`.FakeJWPlatform` instance.
+
+    :param address: (host, port) tuple to listen on. A port of 0 picks a free port.
+    :param platform: the :py:class:`.FakeJWPlatform` to serve. If ``None``, a new empty one is
+        created.
+    :param latency: number of seconds to delay each request by
+    :param rate_limit: maximum number of requests per second before HTTP 429 responses are
+        returned. Zero means no limit.
+    :param error_rate: probability that a request fails with an HTTP 500 internal error
+    :param seed: seed for the error injection random number generator
+
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), platform=None, latency=0, rate_limit=0,
+                 error_rate=0, seed=0):
+        super().__init__(address, FakeAPIRequestHandler)
+        self.platform = platform if platform is not None else FakeJWPlatform(seed=seed)
+        self.latency = latency
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.error_rate = error_rate
+
+        #: Map from request path to number of requests received
+        self.request_counts = {}
+
+        self._random = random.Random(seed)
+        self._stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        """Base URL of the server suitable for the JWPLAYER_API_URL environment variable."""
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def record_request(self, path):
+        with self._stats_lock:
+            self.request_counts[path] = self.request_counts.get(path, 0) + 1
+
+    def should_fail(self):
+        with self._stats_lock:
+            return self._random.random() < self.error_rate
+
+
+class FakeAPIRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler for :py:class:`.FakeAPIServer`."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_api_request()
+
+    def do_POST(self):
+        self.handle_api_request()
+
+    def handle_api_request(self):
+        url = urllib.parse.urlsplit(self.path)
+        body = self.read_body()
+        self.server.record_request(url.path)
+
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+        try:
+            if not self.server.rate_limiter.acquire():
+                raise FakeAPIError(429, 'RateLimitExceeded', 'Rate limit exceeded')
+            if self.server.should_fail():
+                raise FakeAPIError(500, 'InternalError', 'Injected internal error')
+
+            if url.path.startswith('/v2/'):
+                response = self.server.platform.analytics_query(json.loads(body.decode('utf8')))
+            elif url.path.startswith('/v1/'):
+                params = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+                if self.headers.get('Content-Type', '').startswith(
+                        'application/x-www-form-urlencoded'):
+                    params.update(urllib.parse.parse_qsl(
+                        body.decode('utf8'), keep_blank_values=True))
+                params['_address'] = self.headers.get('Host', '')
+                response = self.server.platform.call(url.path[len('/v1/'):], params)
+            else:
+                raise FakeAPIError(404, 'NotFound', 'Unknown path: ' + url.path)
+        except FakeAPIError as e:
+            self.send_json(e.http_status, {
+                'status': 'error', 'code': e.code, 'message': e.message,
+            })
+        else:
+            self.send_json(200, response)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if size == 0:
+                    return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send_json(self, status, body):
+        encoded = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        LOG.debug(format, *args)
+
+
+@contextlib.contextmanager
+def running_server(**kwargs):
+    """
+    Context manager which starts a :py:class:`.FakeAPIServer` in a background thread and yields
+    it. Keyword arguments are passed to the server's constructor. The server is shut down when
+    the context exits.
+
+    """
+    server = FakeAPIServer(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05},
+                              daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def main():
+    import docopt
+
+    opts = docopt.docopt(__doc__)
+    logging.basicConfig(level=logging.INFO)
+
+    platform = FakeJWPlatform(seed=int(opts['--seed']))
+    for metadata_fn in opts['<metadata>']:
+        with open(metadata_fn) as f:
+            platform.load_metadata(json.load(f))
+
+    server = FakeAPIServer(
+        (opts['--host'], int(opts['--port'])), platform=platform,
+        latency=float(opts['--latency']), rate_limit=float(opts['--rate-limit']),
+        error_rate=float(opts['--error-rate']), seed=int(opts['--seed']))
+    LOG.info('Serving fake JWPlatform API at %s', server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import csv
+import io
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from jwplatform.errors import JWPlatformNotFoundError
+
+from sms2jwplayer.analytics import (
+    AnalyticsRow, Rollups, VideoResolver, write_output, get_analytics)
+from sms2jwplayer.cache import PersistentCache
+from sms2jwplayer.snapshot import SnapshotStore
+
+from .test_fakeapi import FakeAPITestCase, run
+from .util import JWPlatformTestCase
+
+VIDEO_FIXTURE = {
+    'key': 'abc', 'mediatype': 'video',
+    'custom': {
+        'sms_clip_id': 'clip:2:', 'sms_media_id': 'media:1:',
+        'sms_collection_id': 'collection:3:', 'sms_instid': 'instid:UIS:',
+    },
+}
+
+ROWS_FIXTURE = [
+    AnalyticsRow(media_id='abc', country_code='GB', plays=10),
+    AnalyticsRow(media_id='abc', country_code='US', plays=5),
+    AnalyticsRow(media_id='gone', country_code='GB', plays=2),
+    AnalyticsRow(media_id='abc', country_code='FR', plays=1),
+]
+
+
+class WriteOutputTests(JWPlatformTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch_and_start('time.sleep')
+
+        def show(video_key):
+            if video_key != 'abc':
+                raise JWPlatformNotFoundError('not found')
+            return {'status': 'ok', 'video': VIDEO_FIXTURE}
+        self.client.videos.show.side_effect = show
+
+    def test_one_call_per_video(self):
+        """Each distinct video is fetched once and rows for missing videos are skipped."""
+        rows = self.write_output(VideoResolver(self.client))
+        self.assertEqual(self.client.videos.show.call_count, 2)
+        self.assertEqual([(r['country'], r['num_hits']) for r in rows],
+                         [('GB', '10'), ('US', '5'), ('FR', '1')])
+        self.assertEqual(rows[0]['clip_id'], '2')
+        self.assertEqual(rows[0]['collection_id'], '3')
+        self.assertEqual(rows[0]['instid'], 'UIS')
+        self.assertEqual(rows[0]['format'], 'mp4')
+
+    def test_snapshot(self):
+        """Videos in the snapshot are not fetched from the API."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with SnapshotStore(os.path.join(tmp_dir, 'snapshot.sqlite')) as snapshot:
+                snapshot.upsert('videos', [VIDEO_FIXTURE])
+                resolver = VideoResolver(self.client, snapshot)
+                rows = self.write_output(resolver)
+        self.client.videos.show.assert_called_once_with(video_key='gone')
+        self.assertEqual(len(rows), 3)
+
+    def test_resolver_caches(self):
+        """Repeated resolution of the same keys does not make further API calls."""
+        resolver = VideoResolver(self.client)
+        resolver.resolve(['abc', 'gone'])
+        self.assertEqual(resolver.resolve(['abc', 'gone']), {'abc': VIDEO_FIXTURE})
+        self.assertEqual(resolver.api_calls, 2)
+
+    def test_persistent_cache(self):
+        """Videos fetched in one run are not fetched again in the next."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_fn = os.path.join(tmp_dir, 'cache.sqlite')
+            with PersistentCache(cache_fn) as cache:
+                self.write_output(VideoResolver(self.client, cache=cache))
+            self.assertEqual(self.client.videos.show.call_count, 2)
+
+            with PersistentCache(cache_fn) as cache:
+                rows = self.write_output(VideoResolver(self.client, cache=cache))
+
+        # Only the missing video is looked up again
+        self.assertEqual(self.client.videos.show.call_count, 3)
+        self.assertEqual(rows[0]['clip_id'], '2')
+
+    def test_streaming(self):
+        """Rows are written batch by batch without consuming all the input first."""
+        fobj = io.StringIO()
+        written = []
+
+        def rows():
+            for row in ROWS_FIXTURE:
+                # Record the number of lines written before each row is consumed
+                written.append(fobj.getvalue().count('\n'))
+                yield row
+
+        resolver = VideoResolver(self.client)
+        with mock.patch.object(resolver, 'resolve', wraps=resolver.resolve) as resolve:
+            write_output(fobj, resolver, rows(), batch_size=2)
+        self.assertEqual(resolve.call_count, 2)
+
+        # Header only, then header plus first batch
+        self.assertEqual(written, [1, 1, 3, 3])
+        self.assertEqual(len(fobj.getvalue().splitlines()), 4)
+
+    def test_rollups(self):
+        """Total hits are computed per media item, collection, institution and country."""
+        rollups = Rollups()
+        write_output(io.StringIO(), VideoResolver(self.client), ROWS_FIXTURE, rollups=rollups)
+        self.assertEqual(rollups.counters['media_id'], {'1': 16})
+        self.assertEqual(rollups.counters['collection_id'], {'3': 16})
+        self.assertEqual(rollups.counters['instid'], {'UIS': 16})
+        self.assertEqual(rollups.counters['country'], {'GB': 10, 'US': 5, 'FR': 1})
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rollups.write(os.path.join(tmp_dir, '2018-01-01'))
+            with open(os.path.join(tmp_dir, '2018-01-01-country.csv')) as f:
+                self.assertEqual(list(csv.reader(f)), [
+                    ['country', 'num_hits'], ['FR', '1'], ['GB', '10'], ['US', '5']])
+
+    def write_output(self, resolver):
+        fobj = io.StringIO()
+        write_output(fobj, resolver, ROWS_FIXTURE)
+        return list(csv.DictReader(io.StringIO(fobj.getvalue())))
+
+
+class GetAnalyticsTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retries(self):
+        """Rate limit and server errors are retried with increasing delay."""
+        responses = [mock.Mock(status_code=code) for code in (429, 503, 200)]
+        responses[-1].json.return_value = {'data': {'rows': []}}
+        with mock.patch('requests.post', side_effect=responses) as post:
+            self.assertEqual(get_analytics('key', 'secret', {}), {'data': {'rows': []}})
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual([c[0][0] for c in self.sleep.call_args_list], [1., 2.])
+
+    def test_client_error_not_retried(self):
+        """Other errors are raised immediately."""
+        response = mock.Mock(status_code=400)
+        response.raise_for_status.side_effect = RuntimeError('bad request')
+        with mock.patch('requests.post', return_value=response) as post:
+            with self.assertRaises(RuntimeError):
+                get_analytics('key', 'secret', {})
+        self.assertEqual(post.call_count, 1)
+
+
+class AnalyticsRangeTests(FakeAPITestCase):
+    def test_date_range(self):
+        """A range of dates is written to one file per day, fetching multiple pages."""
+        self.platform.analytics['2018-01-01'] = [('abc', 'GB', 3), ('def', 'US', 5)]
+        self.platform.analytics['2018-01-03'] = [('abc', 'FR', n) for n in range(5)]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run('analytics', '--from=2018-01-01', '--to=2018-01-03', '--page-length=2',
+                '--jobs=2', '--output-dir=' + tmp_dir)
+            self.assertEqual(sorted(os.listdir(tmp_dir)), [
+                '2018-01-01.csv', '2018-01-02.csv', '2018-01-03.csv'])
+            rows = {}
+            for fn in os.listdir(tmp_dir):
+                with open(os.path.join(tmp_dir, fn)) as f:
+                    rows[fn] = list(csv.DictReader(f))
+
+        self.assertEqual([(r['country'], r['num_hits']) for r in rows['2018-01-01.csv']],
+                         [('US', '5'), ('GB', '3')])
+        self.assertEqual(rows['2018-01-02.csv'], [])
+        self.assertEqual(len(rows['2018-01-03.csv']), 5)
+
+    def test_capped_page_length(self):
+        """All rows are fetched if the API returns fewer rows per page than asked for."""
+        self.platform.analytics['2018-01-01'] = [('abc', 'FR', n) for n in range(5)]
+        self.platform.analytics_max_page_length = 2
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run('analytics', '--from=2018-01-01', '--to=2018-01-01', '--page-length=3',
+                '--output-dir=' + tmp_dir)
+            with open(os.path.join(tmp_dir, '2018-01-01.csv')) as f:
+                rows = list(csv.DictReader(f))
+
+        self.assertEqual(len(rows), 5)
@@ -1,12 +1,24 @@
+import io
 import json
 import logging
 import os
 import tempfile
+import time
+import unittest
 import unittest.mock as mock
 
+from jwplatform.errors import JWPlatformInternalError, JWPlatformParameterInvalidError
+
 from sms2jwplayer import main
-from sms2jwplayer.applyupdatejob import resource_to_params
+from sms2jwplayer.applyupdatejob import (
+    apply_jobs, execute_api_calls_in_parallel, get_media_ids_from_channel, parse_shard,
+    resource_to_params, select_shard, update_media_ids)
+from sms2jwplayer.circuitbreaker import CircuitBreaker
+from sms2jwplayer.snapshot import SnapshotStore
+from sms2jwplayer.util import encode_id_set
 
+from .fakeapi import FakeAPIError
+from .test_fakeapi import FakeAPITestCase
 from .util import JWPlatformTestCase
 
 LOG = logging.getLogger(__name__)
@@ -38,6 +50,18 @@ class ApplyUpdateJobTests(JWPlatformTestCase):
                          'http_method': 'POST'}),
         ], any_order=True)
 
+    def test_delete(self):
+        applyupdatejob({
+            'delete': [
+                {'type': 'videos', 'resource': {'video_key': 'abc'}},
+                {'type': 'channels', 'resource': {'channel_key': 'def'}},
+            ]
+        })
+
+        self.client.videos.delete.assert_called_once_with(video_key='abc', http_method='POST')
+        self.client.channels.delete.assert_called_once_with(
+            channel_key='def', http_method='POST')
+
     def test_image_load(self):
         upload_thumbnail_from_url = self.patch_and_start(
             'sms2jwplayer.util.upload_thumbnail_from_url'
@@ -54,6 +78,7 @@ class ApplyUpdateJobTests(JWPlatformTestCase):
 
         upload_thumbnail_from_url.assert_called_with(
             client=self.client,
+            image_cache=None,
             image_url='https://sms.cam.ac.uk/image/1393664',
             video_key='3Kgs63f3',
         )
@@ -65,6 +90,24 @@ class ApplyUpdateJobTests(JWPlatformTestCase):
             }
         )
 
+    def test_parallel_image_load(self):
+        """Concurrent thumbnail uploads each update and log their own video."""
+        upload_thumbnail_from_url = self.patch_and_start(
+            'sms2jwplayer.util.upload_thumbnail_from_url'
+        )
+        upload_thumbnail_from_url.return_value = {'status': 'ok'}
+        keys = 'ABCDEFGH'
+
+        log = apply_jobs(self.client, {'update': [
+            {'type': 'image_load', 'resource': {'video_key': key, 'image_url': 'x/' + key}}
+            for key in keys
+        ]}, upload_workers=4)
+
+        self.assertCountEqual(
+            [c[1]['video_key'] for c in self.client.videos.update.call_args_list], keys)
+        self.assertCountEqual(
+            [response['job']['video_key'] for response in log['update_responses']], keys)
+
     def test_image_check(self):
 
         self.client.videos.thumbnails.show.return_value = {'thumbnail': {'status': 'ready'}}
@@ -82,12 +125,341 @@ class ApplyUpdateJobTests(JWPlatformTestCase):
             }
         )
 
+    def test_image_check_polls(self):
+        """Thumbnails which are being processed are polled again."""
+        self.patch_and_start('sms2jwplayer.applyupdatejob.MIN_CHECK_DELAY', 0.)
+        self.client.videos.thumbnails.show.side_effect = [
+            {'thumbnail': {'status': 'processing'}},
+            {'thumbnail': {'status': 'ready'}},
+        ]
+
+        log = apply_jobs(self.client, {'update': [{'type': 'image_check', 'resource': {
+            'video_key': '3Kgs63f3', 'image_status': 'image_status:loaded:'}}]},
+            image_check_polls=3)
+
+        self.assertEqual(self.client.videos.thumbnails.show.call_count, 2)
+        self.client.videos.update.assert_called_once_with(
+            http_method='POST', **{
+                'video_key': '3Kgs63f3',
+                'custom.sms_image_status': 'image_status:ready:'
+            }
+        )
+        self.assertEqual(len(log['update_responses']), 1)
+
+    def test_image_check_unchanged(self):
+        """The status is not written if it is unchanged or still processing."""
+        self.client.videos.thumbnails.show.side_effect = [
+            {'thumbnail': {'status': 'ready'}},
+            {'thumbnail': {'status': 'processing'}},
+        ]
+
+        applyupdatejob({'update': [
+            {'type': 'image_check', 'resource': {
+                'video_key': 'abc', 'image_status': 'image_status:ready:'}},
+            {'type': 'image_check', 'resource': {
+                'video_key': 'def', 'image_status': 'image_status:loaded:'}},
+        ]})
+
+        self.assertEqual(self.client.videos.thumbnails.show.call_count, 2)
+        self.client.videos.update.assert_not_called()
+
+    def test_priority_order(self):
+        """ACL changes are applied first and thumbnails last whatever the order in the file."""
+        upload_thumbnail_from_url = self.patch_and_start(
+            'sms2jwplayer.util.upload_thumbnail_from_url'
+        )
+        upload_thumbnail_from_url.return_value = {'status': 'ok'}
+
+        apply_jobs(self.client, {
+            'create': [{'type': 'videos', 'resource': {'title': 'new'}}],
+            'update': [
+                {'type': 'image_load', 'resource': {
+                    'video_key': 'img', 'image_url': 'http://sms/image/1'}},
+                {'type': 'videos', 'resource': {'video_key': 'title', 'title': 'fixed'}},
+                {'type': 'videos', 'resource': {
+                    'video_key': 'acl', 'custom': {'sms_acl': 'acl:WORLD:'}}},
+            ],
+        })
+
+        self.assertEqual([(name, kwargs.get('video_key'))
+                          for name, _, kwargs in self.client.method_calls], [
+            ('videos.update', 'acl'),
+            ('videos.create', None),
+            ('videos.update', 'title'),
+            ('videos.update', 'img'),
+        ])
+
+    def test_time_budget(self):
+        """Jobs which are not started within the time budget are deferred."""
+        jobs = {
+            'create': [{'type': 'videos', 'resource': {'title': 'new'}}],
+            'update': [
+                {'type': 'videos', 'resource': {'video_key': 'abc', 'title': 'fixed'}},
+                {'type': 'image_check', 'resource': {'video_key': 'abc'}},
+            ],
+            'delete': [{'type': 'videos', 'resource': {'video_key': 'def'}}],
+        }
+
+        log = apply_jobs(self.client, jobs, time_budget=0)
+
+        self.assertEqual(self.client.method_calls, [])
+        self.assertEqual(log['deferred'], jobs)
+
+    def test_journal(self):
+        """Responses are written to the journal as they are received."""
+        self.client.videos.update.return_value = {'status': 'ok'}
+        journal = io.StringIO()
+
+        log = apply_jobs(self.client, {'update': [
+            {'type': 'videos', 'resource': {'video_key': 'abc', 'title': 'x'}},
+            {'type': 'videos', 'resource': {'video_key': 'def', 'title': 'y'}},
+        ]}, journal=journal)
+
+        lines = [json.loads(line) for line in journal.getvalue().splitlines()]
+        self.assertEqual(lines, [
+            {'update_responses': [response]} for response in log['update_responses']])
+
+    def test_parallel_journal(self):
+        """Responses to parallel jobs are journaled before the rest of the class has finished."""
+        journal = io.StringIO()
+        journaled = []
+
+        def delete(video_key, **kwargs):
+            if video_key == 'def':
+                # Stand in for the run being killed here by noting what has been journaled
+                deadline = time.monotonic() + 5
+                while 'abc' not in journal.getvalue() and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                journaled.extend(journal.getvalue().splitlines())
+            return {'status': 'ok'}
+        self.client.videos.delete.side_effect = delete
+
+        apply_jobs(self.client, {'delete': [
+            {'type': 'videos', 'resource': {'video_key': 'abc'}},
+            {'type': 'videos', 'resource': {'video_key': 'def'}},
+        ]}, delete_workers=1, journal=journal)
+
+        self.assertEqual(len(journaled), 1)
+        self.assertEqual(json.loads(journaled[0])['delete_responses'][0]['key'], 'abc')
+
+    def test_transient_failure(self):
+        """Transient failures are retried."""
+        self.client.videos.update.side_effect = [
+            JWPlatformInternalError('Internal error'), {'status': 'ok'}]
+
+        log = apply_jobs(self.client, {'update': [
+            {'type': 'videos', 'resource': {'video_key': 'abc', 'title': 'x'}},
+        ]})
+
+        self.assertEqual(self.client.videos.update.call_count, 2)
+        self.assertEqual(log['update_responses'][0]['log'], {'status': 'ok'})
+
+    def test_error_budget(self):
+        """Permanent failures are not retried and jobs are deferred once the budget is spent."""
+        self.client.videos.update.side_effect = JWPlatformParameterInvalidError('Bad title')
+        jobs = {'update': [
+            {'type': 'videos', 'resource': {'video_key': 'abc', 'title': 'x'}},
+            {'type': 'videos', 'resource': {'video_key': 'def', 'title': 'y'}},
+        ]}
+
+        log = apply_jobs(self.client, jobs, error_budget=1)
+
+        self.assertEqual(self.client.videos.update.call_count, 1)
+        self.assertEqual(log['update_responses'], [
+            'FAILED: JWPlatformParameterInvalidError: Bad title'])
+        self.assertEqual(log['deferred']['update'], jobs['update'][1:])
+
+    def test_media_ids(self):
+        """Channel media ids are read in either encoding and written compactly."""
+        for prop in ['media_ids:3,1,2:', 'media_ids:{}:'.format(encode_id_set([1, 2, 3]))]:
+            self.assertEqual(
+                get_media_ids_from_channel({'custom': {'sms_media_ids': prop}}), {1, 2, 3})
+        self.assertEqual(get_media_ids_from_channel({}), set())
+
+        update_media_ids(self.client, 'abc', {1, 2, 3})
+        self.client.channels.update.assert_called_once_with(http_method='POST', **{
+            'channel_key': 'abc',
+            'custom.sms_media_ids': 'media_ids:{}:'.format(encode_id_set([1, 2, 3])),
+        })
+
     def test_resource_to_params(self):
         self.assertEquals(resource_to_params(
             {'a': {'x': 1, 'y': 2}, 'b': 3}), {'a.x': 1, 'a.y': 2, 'b': 3}
         )
 
 
+class ShardTests(unittest.TestCase):
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('2/4'), (2, 4))
+        for spec in ['4/4', '1', '-1/2', 'a/b']:
+            with self.assertRaises(ValueError):
+                parse_shard(spec)
+
+    def test_partition(self):
+        """Each job is in exactly one shard and jobs for the same resource share a shard."""
+        jobs = {
+            'create': [
+                {'type': 'channels', 'resource': {
+                    'custom': {'sms_collection_id': 'collection:1:'}}},
+                {'type': 'videos_insert', 'resource': {'collection_id': 1, 'media_id': 1}},
+            ],
+            'update': [
+                {'type': 'videos_insert', 'resource': {'collection_id': 1, 'media_id': 2}},
+                {'type': 'videos_delete', 'resource': {'collection_id': 1, 'media_id': 3}},
+                {'type': 'channels', 'resource': {
+                    'channel_key': 'xyz', 'custom': {
+                        'sms_collection_id': 'collection:1:', 'sms_collection_media_ids': ''}}},
+            ] + [
+                {'type': 'videos', 'resource': {'video_key': str(key)}} for key in range(20)
+            ] + [
+                {'type': 'image_check', 'resource': {'video_key': str(key)}} for key in range(20)
+            ],
+            'delete': [{'type': 'videos', 'resource': {'video_key': 'abc'}}],
+        }
+
+        shards = [select_shard(jobs, index, 3) for index in range(3)]
+
+        for kind in ['create', 'update', 'delete']:
+            selected = [job for shard in shards for job in shard[kind]]
+            self.assertEqual(len(selected), len(jobs[kind]))
+            self.assertCountEqual(
+                [json.dumps(job, sort_keys=True) for job in selected],
+                [json.dumps(job, sort_keys=True) for job in jobs[kind]])
+
+        # Every job for collection 1 and for each video is in one shard
+        for shard in shards:
+            in_shard = {json.dumps(job, sort_keys=True)
+                        for kind in ['create', 'update'] for job in shard[kind]}
+            collection_jobs = jobs['create'] + jobs['update'][:3]
+            self.assertIn(
+                sum(json.dumps(job, sort_keys=True) in in_shard for job in collection_jobs),
+                {0, len(collection_jobs)})
+            video_keys = [job['resource']['video_key'] for job in shard['update']
+                          if job['type'] == 'videos']
+            image_keys = [job['resource']['video_key'] for job in shard['update']
+                          if job['type'] == 'image_check']
+            self.assertEqual(video_keys, image_keys)
+
+
+class ParallelTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('sms2jwplayer.metrics.REGISTRY.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unexpected_errors(self):
+        """Any exception fails only its call and network errors are retried."""
+        attempts = []
+
+        def flaky(delay):
+            attempts.append(delay)
+            if len(attempts) == 1:
+                raise ConnectionResetError('reset')
+            return 'ok'
+
+        def bad_job(delay):
+            raise ValueError('bad job')
+
+        breaker = CircuitBreaker()
+        results = list(execute_api_calls_in_parallel([flaky, bad_job], 2, breaker))
+
+        self.assertCountEqual(results, ['ok', 'FAILED: ValueError: bad job'])
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(breaker.n_failed_jobs, 1)
+
+    def test_failing_worker(self):
+        """A worker which fails is charged to the error budget and other results are kept."""
+        def calls():
+            yield lambda delay: 'ok'
+            raise KeyError('resource')
+
+        breaker = CircuitBreaker()
+        results = list(execute_api_calls_in_parallel(calls(), 1, breaker))
+
+        self.assertEqual(results, ['ok', "FAILED: KeyError: 'resource'"])
+        self.assertEqual(breaker.n_failed_jobs, 1)
+
+
+class BulkDeleteTests(FakeAPITestCase):
+    def test_batched_delete(self):
+        """Videos are deleted in batches and the outcome for each key is logged."""
+        deletes = [
+            {'type': 'videos', 'resource': {'video_key': key}}
+            for key in ['abc', 'missing', 'def', 'ghi']
+        ]
+        log = apply_jobs(
+            self.client, {'delete': deletes}, delete_batch_size=2, delete_workers=2)
+
+        self.assertEqual(self.platform.videos, {})
+        outcomes = {outcome['key']: outcome for outcome in log['delete_responses']}
+        self.assertEqual(set(outcomes), {'abc', 'missing', 'def', 'ghi'})
+        self.assertIn('error', outcomes['missing'])
+        self.assertEqual(outcomes['ghi']['response']['status'], 'ok')
+
+        # One call for each batch plus one call for each key in the failed batch
+        self.assertEqual(self.server.request_counts['/v1/videos/delete'], 4)
+
+
+class VerifyTests(FakeAPITestCase):
+    UPDATES = [
+        {'type': 'videos', 'resource': {
+            'video_key': 'abc', 'custom': {'sms_media_id': 'media:1:'}}},
+        {'type': 'videos', 'resource': {
+            'video_key': 'def', 'title': 'new', 'custom': {'sms_media_id': 'media:2:'}}},
+        {'type': 'videos', 'resource': {'video_key': 'missing', 'title': 'new'}},
+    ]
+
+    def test_verify(self):
+        """Updates are recomputed against the current resources and satisfied ones dropped."""
+        log = apply_jobs(self.client, {'update': self.UPDATES}, verify=True)
+
+        # Few videos are updated so each is fetched individually
+        self.assertEqual(self.server.request_counts['/v1/videos/show'], 3)
+        self.assertNotIn('/v1/videos/list', self.server.request_counts)
+        self.assert_verified(log)
+
+    def test_verify_by_listing(self):
+        """Many updated resources are fetched a page at a time."""
+        with mock.patch('sms2jwplayer.applyupdatejob.VERIFY_SHOW_LIMIT', 0):
+            log = apply_jobs(self.client, {'update': self.UPDATES}, verify=True)
+
+        # The missing video means that the library is listed until the empty last page
+        self.assertEqual(self.server.request_counts['/v1/videos/list'], 2)
+        self.assertNotIn('/v1/videos/show', self.server.request_counts)
+        self.assert_verified(log)
+
+    def test_verify_outside_error_budget(self):
+        """Failing to list resources for verification does not use up the error budget."""
+        list_error = FakeAPIError(400, 'ParameterInvalid', 'Bad offset')
+        with mock.patch('sms2jwplayer.applyupdatejob.VERIFY_SHOW_LIMIT', 0), \
+                mock.patch.object(self.platform, 'api_videos_list', side_effect=list_error):
+            log = apply_jobs(self.client, {'update': self.UPDATES}, verify=True, error_budget=1)
+
+        # No update could be verified so all are attempted
+        self.assertEqual(self.server.request_counts['/v1/videos/update'], 3)
+        self.assertEqual(log['deferred']['update'], [])
+
+    def test_verify_from_snapshot(self):
+        """Recently fetched resources in the snapshot are not fetched again."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with SnapshotStore(os.path.join(tmp_dir, 'snapshot.sqlite')) as snapshot:
+                snapshot.upsert('videos', list(self.platform.videos.values()))
+                log = apply_jobs(self.client, {'update': self.UPDATES}, snapshot=snapshot,
+                                 verify=True)
+
+        # Only the video missing from the snapshot is fetched
+        self.assertEqual(self.server.request_counts['/v1/videos/show'], 1)
+        self.assert_verified(log)
+
+    def assert_verified(self, log):
+        self.assertEqual(self.server.request_counts['/v1/videos/update'], 2)
+        self.assertEqual(
+            [response['job'] for response in log['update_responses']
+             if isinstance(response, dict)],
+            [{'video_key': 'def', 'title': 'new'}])
+        self.assertEqual(self.platform.videos['def']['title'], 'new')
+
+
 def applyupdatejob(jobfile_content):
     """Call the applyupdatejob command as if from command line."""
     with tempfile.TemporaryDirectory() as tmp_dir:
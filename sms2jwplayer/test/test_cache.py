@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+from sms2jwplayer.cache import PersistentCache
+
+
+class PersistentCacheTests(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'cache.sqlite')
+
+    def test_persists(self):
+        """Entries are available after the cache is re-opened."""
+        with PersistentCache(self.path) as cache:
+            cache.put_many({'a': {'x': 1}, 'b': [2]})
+        with PersistentCache(self.path) as cache:
+            self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': {'x': 1}, 'b': [2]})
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_ttl(self):
+        """Expired entries are not returned and are removed."""
+        with PersistentCache(self.path, ttl=10) as cache:
+            cache.put_many({'a': 1}, now=100)
+            cache.put_many({'b': 2}, now=105)
+            self.assertEqual(cache.get_many(['a', 'b'], now=112), {'b': 2})
+            self.assertEqual(len(cache), 1)
+
+    def test_expiry_indexed(self):
+        """Expired entries are found without scanning the whole cache."""
+        with PersistentCache(self.path) as cache:
+            plan = cache._connection.execute(
+                'EXPLAIN QUERY PLAN DELETE FROM entries WHERE stored_at < ?', (0,)).fetchall()
+        self.assertIn('entries_stored_at', ' '.join(str(row[-1]) for row in plan))
+
+    def test_eviction(self):
+        """The least recently used entries are evicted when the cache is full."""
+        with PersistentCache(self.path, max_entries=2) as cache:
+            cache.put_many({'a': 1}, now=100)
+            cache.put_many({'b': 2}, now=101)
+            cache.get_many(['a'], now=102)
+            cache.put_many({'c': 3}, now=103)
+            self.assertEqual(cache.get_many(['a', 'b', 'c'], now=104), {'a': 1, 'c': 3})
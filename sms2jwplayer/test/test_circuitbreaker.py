@@ -0,0 +1,62 @@
+import unittest
+import unittest.mock as mock
+
+import requests
+from jwplatform.errors import (
+    JWPlatformInternalError, JWPlatformNotFoundError, JWPlatformRateLimitExceededError)
+
+from sms2jwplayer import circuitbreaker
+
+
+class ClassifyTests(unittest.TestCase):
+    def test_classify(self):
+        self.assertEqual(
+            circuitbreaker.classify(JWPlatformRateLimitExceededError('x')), 'rate_limit')
+        self.assertEqual(circuitbreaker.classify(JWPlatformInternalError('x')), 'transient')
+        self.assertEqual(circuitbreaker.classify(requests.Timeout()), 'transient')
+        self.assertEqual(circuitbreaker.classify(JWPlatformNotFoundError('x')), 'permanent')
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        # A fake clock which is advanced by sleeping
+        self.now = 0.
+
+        def sleep(seconds):
+            self.now += seconds
+
+        patcher = mock.patch('sms2jwplayer.metrics.REGISTRY.sleep', side_effect=sleep)
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_opens(self):
+        """The breaker opens when most recent calls fail and closes after a cooldown."""
+        breaker = circuitbreaker.CircuitBreaker()
+        for _ in range(circuitbreaker.MIN_CALLS):
+            breaker.record_success()
+        for _ in range(circuitbreaker.MIN_CALLS - 1):
+            breaker.record_transient_failure()
+        breaker.wait()
+        self.sleep.assert_not_called()
+
+        breaker.record_transient_failure()
+        breaker.wait()
+        self.sleep.assert_called_once_with(circuitbreaker.MIN_COOLDOWN)
+
+        # The cooldown doubles if the breaker re-opens before a call succeeds
+        for _ in range(circuitbreaker.MIN_CALLS):
+            breaker.record_transient_failure()
+        breaker.wait()
+        self.sleep.assert_called_with(2 * circuitbreaker.MIN_COOLDOWN)
+
+    def test_error_budget(self):
+        """The breaker is exhausted once the error budget is used up."""
+        breaker = circuitbreaker.CircuitBreaker(error_budget=2)
+        breaker.record_failed_job()
+        self.assertFalse(breaker.exhausted)
+        breaker.record_failed_job()
+        self.assertTrue(breaker.exhausted)
+        self.assertFalse(circuitbreaker.CircuitBreaker().exhausted)
@@ -0,0 +1,28 @@
+import random
+import unittest
+
+from sms2jwplayer.extsort import sort_external
+
+
+class SortExternalTests(unittest.TestCase):
+    def test_in_memory(self):
+        """Input smaller than a chunk is sorted."""
+        self.assertEqual(list(sort_external([3, 1, 2], key=lambda x: x, chunk_size=10)), [1, 2, 3])
+
+    def test_spills_chunks(self):
+        """Input larger than a chunk is sorted via temporary files."""
+        items = list(range(1000))
+        random.Random(0).shuffle(items)
+        self.assertEqual(list(sort_external(items, key=lambda x: x, chunk_size=64)),
+                         list(range(1000)))
+
+    def test_stable(self):
+        """Items with equal keys keep their input order across chunks."""
+        items = [(index % 3, index) for index in range(50)]
+        self.assertEqual(
+            list(sort_external(items, key=lambda item: item[0], chunk_size=7)),
+            sorted(items, key=lambda item: item[0]))
+
+    def test_empty(self):
+        """Empty input yields nothing."""
+        self.assertEqual(list(sort_external([], key=lambda x: x, chunk_size=0)), [])
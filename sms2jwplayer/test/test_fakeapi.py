@@ -0,0 +1,114 @@
+import glob
+import json
+import logging
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from jwplatform.errors import JWPlatformNotFoundError, JWPlatformRateLimitExceededError
+
+from sms2jwplayer import main
+from sms2jwplayer.analytics import get_analytics
+from sms2jwplayer.util import get_jwplatform_client
+
+from .fakeapi import running_server, FakeJWPlatform
+
+LOG = logging.getLogger(__name__)
+
+VIDEOS_FIXTURE = {'videos': [
+    {'key': 'abc', 'mediatype': 'video', 'custom': {'sms_media_id': 'media:1:'}},
+    {'key': 'def', 'mediatype': 'audio', 'custom': {'sms_media_id': 'media:2:'}},
+    {'key': 'ghi', 'mediatype': 'video', 'custom': {'sms_media_id': 'media:12:'}},
+]}
+
+
+class FakeAPITestCase(unittest.TestCase):
+    """
+    A test case which starts a fake JWPlatform API server and points the client at it.
+
+    """
+    server_kwargs = {}
+
+    def setUp(self):
+        self.platform = FakeJWPlatform()
+        self.platform.load_metadata(VIDEOS_FIXTURE)
+
+        server_cm = running_server(platform=self.platform, **self.server_kwargs)
+        self.server = server_cm.__enter__()
+        self.addCleanup(server_cm.__exit__, None, None, None)
+
+        patcher = mock.patch('os.environ', {
+            'JWPLAYER_API_KEY': 'xxx', 'JWPLAYER_API_SECRET': 'yyy',
+            'JWPLAYER_API_ANALYTICS_SECRET': 'zzz', 'JWPLAYER_API_URL': self.server.url,
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client = get_jwplatform_client()
+
+
+class FakeAPITests(FakeAPITestCase):
+    def test_list_search(self):
+        """Searching on custom props matches substrings."""
+        response = self.client.videos.list(**{'search:custom.sms_media_id': 'media:1'})
+        self.assertEqual(set(v['key'] for v in response['videos']), {'abc', 'ghi'})
+
+    def test_not_found(self):
+        """Unknown resources raise the appropriate jwplatform error."""
+        with self.assertRaises(JWPlatformNotFoundError):
+            self.client.videos.show(video_key='nope')
+
+    def test_fetch(self):
+        """The fetch subcommand retrieves all videos from the server."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run('fetch', 'videos', '--base-name=' + os.path.join(tmp_dir, 'videos_'))
+            videos = []
+            for path in glob.glob(os.path.join(tmp_dir, 'videos_*.json')):
+                with open(path) as f:
+                    videos.extend(json.load(f)['videos'])
+        self.assertEqual(set(v['key'] for v in videos), {'abc', 'def', 'ghi'})
+
+    def test_applyupdatejob(self):
+        """Create and update jobs are applied to the server's state."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            jobfile = os.path.join(tmp_dir, 'job.json')
+            with open(jobfile, 'w') as f:
+                json.dump({
+                    'create': [{'type': 'videos', 'resource': {
+                        'title': 'new', 'custom': {'sms_media_id': 'media:3:'}}}],
+                    'update': [{'type': 'videos', 'resource': {
+                        'video_key': 'abc', 'title': 'changed'}}],
+                }, f)
+            run('applyupdatejob', jobfile)
+
+        self.assertEqual(self.platform.videos['abc']['title'], 'changed')
+        self.assertIn('new', [v.get('title') for v in self.platform.videos.values()])
+
+    def test_analytics(self):
+        """Analytics queries are paged."""
+        self.platform.analytics['2018-01-01'] = [('abc', 'GB', 3), ('def', 'US', 5)]
+        response = get_analytics('xxx', 'zzz', {
+            'start_date': '2018-01-01', 'end_date': '2018-01-01', 'page': 0, 'page_length': 1,
+        })
+        self.assertEqual(response['data']['rows'], [['def', 'US', 5]])
+        self.assertEqual(self.server.request_counts, {'/v2/sites/xxx/analytics/queries/': 1})
+
+
+class FakeAPIRateLimitTests(FakeAPITestCase):
+    server_kwargs = {'rate_limit': 1}
+
+    def test_rate_limit(self):
+        """Exceeding the rate limit raises the rate limit error."""
+        with self.assertRaises(JWPlatformRateLimitExceededError):
+            for _ in range(5):
+                self.client.videos.show(video_key='abc')
+
+
+def run(*args):
+    """Call sms2jwplayer as if from command line."""
+    argv = ['sms2jwplayer']
+    argv.extend(args)
+    LOG.info('calling with argv: %r', argv)
+    with mock.patch('sys.argv', argv):
+        main()
@@ -1,9 +1,15 @@
+import json
 import logging
+import os
+import tempfile
 import unittest
 from testfixtures import LogCapture
 
 from sms2jwplayer.genupdatejob import convert_acl
 
+from .io import open_data
+from .test_fakeapi import run
+
 LOG = logging.getLogger(__name__)
 
 
@@ -98,3 +104,93 @@ class ConvertAclTests(unittest.TestCase):
             )
             log.check(('sms2jwplayer.genupdatejob', 'WARNING',
                        'The ACE "hpcr" cannot be resolved'))
+
+
+class GenUpdateJobTestCase(unittest.TestCase):
+    """ Runs genupdatejob videos on an export and metadata with matched and unmatched videos """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+        # An export with media items 20, 8 and 3, each in two formats, in no particular order
+        with open_data('export_example.csv') as f:
+            header, *rows = f.read().splitlines()
+        self.csv_path = os.path.join(self.tmp_dir, 'export.csv')
+        with open(self.csv_path, 'w') as f:
+            f.write(header + '\n')
+            for media_id in (20, 8, 3):
+                for row in rows:
+                    f.write('{},{}\n'.format(media_id, row.split(',', 1)[1]))
+
+            # Media item 7 is only available in a format which is never chosen
+            f.write('7,{}\n'.format(rows[0].split(',', 1)[1].replace('archive-h264', 'webm')))
+
+        self.metadata_path = os.path.join(self.tmp_dir, 'metadata.json')
+        with open(self.metadata_path, 'w') as f:
+            json.dump({'videos': [
+                {'key': 'abc', 'custom': {'sms_media_id': 'media:20:'}},
+                {'key': 'def', 'custom': {}},
+                {'key': 'ghi', 'custom': {'sms_media_id': 'media:5:'}},
+                {'key': 'jkl', 'custom': {'sms_media_id': 'media:3:'}},
+                {'key': 'mno', 'custom': {'sms_media_id': 'media:7:'}},
+            ]}, f)
+
+    def generate(self, *args):
+        output = os.path.join(self.tmp_dir, 'jobs.json')
+        run('genupdatejob', 'videos', '--base=http://sms.invalid/',
+            '--base-image-url=http://sms.invalid/images/', '--output=' + output, *args,
+            self.csv_path, self.metadata_path)
+        with open(output) as f:
+            return json.load(f)
+
+
+class MergeJoinTests(GenUpdateJobTestCase):
+    """ Tests for the --merge-join mode of genupdatejob """
+
+    def test_same_jobs(self):
+        """The merge join generates the same jobs as matching in memory."""
+        def normalised(jobs):
+            return {
+                kind: sorted(json.dumps(job, sort_keys=True) for job in jobs[kind])
+                for kind in ('create', 'update')
+            }
+
+        expected = self.generate()
+        self.assertEqual(len(expected['create']), 1)
+        self.assertEqual(normalised(self.generate('--merge-join')), normalised(expected))
+
+
+class UnmatchedTests(GenUpdateJobTestCase):
+    """ Tests for the handling of unmatched resources by genupdatejob """
+
+    def test_no_deletes_by_default(self):
+        """No delete section is generated without --delete-unmatched."""
+        self.assertNotIn('delete', self.generate())
+
+    def test_delete_and_report(self):
+        """Unmatched videos are reported and deleted in both matching modes."""
+        report_path = os.path.join(self.tmp_dir, 'unmatched.csv')
+        for args in [(), ('--merge-join',)]:
+            jobs = self.generate(
+                '--delete-unmatched', '--unmatched-report=' + report_path, *args)
+            self.assertEqual(
+                jobs['delete'], [{'type': 'videos', 'resource': {'video_key': 'ghi'}}])
+            with open(report_path) as f:
+                self.assertEqual(f.read().splitlines(), ['key,sms_media_id', 'ghi,5'])
+
+    def test_max_deletes(self):
+        """No delete jobs are generated if there would be more than --max-deletes."""
+        for args in [(), ('--merge-join',)]:
+            with LogCapture() as log:
+                jobs = self.generate('--delete-unmatched', '--max-deletes=0', *args)
+            self.assertEqual(jobs['delete'], [])
+            self.assertIn('ERROR', [record.levelname for record in log.records])
+
+    def test_unusable_format_not_unmatched(self):
+        """Videos of media items in the export with no usable format are not deleted."""
+        for args in [(), ('--merge-join',)]:
+            jobs = self.generate('--delete-unmatched', *args)
+            self.assertNotIn(
+                'mno', [job['resource']['video_key'] for job in jobs['delete']])
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from sms2jwplayer.imagecache import ImageCache, ImageTooLargeError, read_chunks
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'x' * 100
+PNG_MD5 = hashlib.md5(PNG).hexdigest()
+
+
+class ImageCacheTests(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.directory = tmp_dir.name
+
+        self.session = mock.Mock()
+        self.session.get.return_value.iter_content.side_effect = lambda size: [PNG[:50], PNG[50:]]
+
+    def test_downloads_once(self):
+        """Each distinct image is downloaded once."""
+        cache = ImageCache(self.directory)
+        for _ in range(3):
+            with cache.open(PNG_MD5, 'http://sms/image/1', self.session) as image:
+                self.assertEqual(b''.join(read_chunks(image.path)), PNG)
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertEqual(image.content_type, 'image/png')
+        self.assertFalse(image.temporary)
+
+    def test_persistent(self):
+        """Images are remembered between instances."""
+        for _ in range(2):
+            with ImageCache(self.directory).open(PNG_MD5, 'http://sms/image/1', self.session):
+                pass
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_md5_mismatch(self):
+        """Images which do not match their MD5 are not cached and are removed after use."""
+        cache = ImageCache(self.directory)
+        with cache.open('0' * 32, 'http://sms/image/1', self.session) as image:
+            self.assertTrue(image.temporary)
+            self.assertTrue(os.path.exists(image.path))
+        self.assertFalse(os.path.exists(image.path))
+        self.assertEqual(len(cache), 0)
+
+    def test_eviction(self):
+        """The least recently used images are evicted when the cache is full."""
+        cache = ImageCache(self.directory, max_bytes=len(PNG))
+        other = b'GIF8' + b'y' * 10
+        with cache.open(PNG_MD5, 'http://sms/image/1', self.session):
+            pass
+        self.session.get.return_value.iter_content.side_effect = lambda size: [other]
+        with cache.open(hashlib.md5(other).hexdigest(), 'http://sms/image/2', self.session):
+            pass
+        self.assertEqual(len(cache), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, PNG_MD5)))
+
+    def test_in_use_not_evicted(self):
+        """Images in use are not evicted and evicted images are downloaded again."""
+        cache = ImageCache(self.directory, max_bytes=len(PNG))
+        other = b'GIF8' + b'y' * 10
+        other_md5 = hashlib.md5(other).hexdigest()
+        with cache.open(PNG_MD5, 'http://sms/image/1', self.session) as image:
+            self.session.get.return_value.iter_content.side_effect = lambda size: [other]
+            with cache.open(other_md5, 'http://sms/image/2', self.session) as other_image:
+                self.assertTrue(os.path.exists(image.path))
+                self.assertTrue(os.path.exists(other_image.path))
+
+            # The other image is the only one not in use and so is evicted
+            self.assertTrue(os.path.exists(image.path))
+            self.assertFalse(os.path.exists(other_image.path))
+
+        with cache.open(other_md5, 'http://sms/image/2', self.session) as other_image:
+            self.assertEqual(b''.join(read_chunks(other_image.path)), other)
+        self.assertEqual(self.session.get.call_count, 3)
+
+    def test_too_large(self):
+        """Images larger than the maximum size are not downloaded in full."""
+        cache = ImageCache(self.directory)
+        with self.assertRaises(ImageTooLargeError):
+            with cache.open(PNG_MD5, 'http://sms/image/1', self.session, max_size=60):
+                pass
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+        # Concurrent downloads are no longer tracked
+        self.assertEqual(cache._downloading, {})
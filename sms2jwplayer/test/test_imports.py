@@ -0,0 +1,55 @@
+import subprocess
+import sys
+import unittest
+
+#: Modules which are slow to import and should not be loaded by lightweight subcommands
+HEAVYWEIGHT_MODULES = {'jwplatform', 'requests', 'dateutil', 'tqdm'}
+
+#: Budget in microseconds for the cumulative import time of a lightweight module. This is
+#: deliberately generous to avoid spurious failures on slow machines but is far below the time
+#: taken to import the HTTP stack.
+IMPORT_TIME_BUDGET = 50000
+
+
+class ImportTimeTests(unittest.TestCase):
+    """
+    Check that subcommands which do not need the jwplayer API do not pay for importing it.
+
+    """
+    def test_main_module(self):
+        """Importing the CLI entry point, as done for --help, is lightweight."""
+        self.assert_lightweight('sms2jwplayer')
+
+    def test_util(self):
+        """The util module, imported by every subcommand, is lightweight."""
+        self.assert_lightweight('sms2jwplayer.util')
+
+    def test_tidy(self):
+        """The tidy subcommand is lightweight."""
+        self.assert_lightweight('sms2jwplayer.tidy')
+
+    def assert_lightweight(self, module):
+        timings = import_times(module)
+        loaded = set(name.split('.')[0] for name in timings)
+        self.assertEqual(loaded & HEAVYWEIGHT_MODULES, set())
+        self.assertLess(timings[module], IMPORT_TIME_BUDGET)
+
+
+def import_times(module):
+    """
+    Import *module* in a fresh interpreter with "-X importtime" and return a dictionary mapping
+    each imported module name to its cumulative import time in microseconds.
+
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stderr=subprocess.PIPE, check=True, universal_newlines=True)
+
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            timings[name.strip()] = int(cumulative)
+    return timings
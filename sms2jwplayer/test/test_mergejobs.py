@@ -0,0 +1,100 @@
+import copy
+import json
+import os
+import tempfile
+import unittest
+
+from sms2jwplayer.mergejobs import merge_jobs
+
+from .test_fakeapi import run
+
+
+class MergeJobsTests(unittest.TestCase):
+    def test_merge_updates(self):
+        """Updates to the same video are merged with later updates taking precedence."""
+        jobs = {'update': [
+            {'type': 'videos', 'resource': {
+                'video_key': 'abc', 'title': 'old', 'custom': {'sms_acl': 'acl:WORLD:'}}},
+            {'type': 'channels', 'resource': {'channel_key': 'def', 'title': 'channel'}},
+            {'type': 'videos', 'resource': {
+                'video_key': 'abc', 'title': 'new', 'custom': {'sms_media_id': 'media:1:'}}},
+        ]}
+        original = copy.deepcopy(jobs)
+
+        merged = merge_jobs([jobs])
+
+        self.assertEqual(merged['update'], [
+            {'type': 'videos', 'resource': {
+                'video_key': 'abc', 'title': 'new',
+                'custom': {'sms_acl': 'acl:WORLD:', 'sms_media_id': 'media:1:'}}},
+            {'type': 'channels', 'resource': {'channel_key': 'def', 'title': 'channel'}},
+        ])
+        self.assertEqual(jobs, original)
+
+    def test_membership(self):
+        """Opposing inserts and deletes cancel and repeated ones are made once."""
+        def job(type_, media_id):
+            return {'type': type_, 'resource': {'collection_id': 1, 'media_id': media_id}}
+
+        merged = merge_jobs([{'update': [
+            job('videos_insert', 1), job('videos_insert', 2), job('videos_delete', 1),
+            job('videos_insert', 2),
+        ]}])
+
+        self.assertEqual(merged['update'], [job('videos_insert', 2)])
+
+    def test_deletes(self):
+        """Repeated deletes are made once and updates to deleted videos are dropped."""
+        merged = merge_jobs([
+            {'update': [
+                {'type': 'videos', 'resource': {'video_key': 'abc', 'title': 'x'}},
+                {'type': 'image_check', 'resource': {'video_key': 'abc'}},
+                {'type': 'image_check', 'resource': {'video_key': 'def'}},
+            ]},
+            {'delete': [
+                {'type': 'videos', 'resource': {'video_key': 'abc'}},
+                {'type': 'videos', 'resource': {'video_key': 'abc'}},
+            ]},
+        ])
+
+        self.assertEqual(merged, {
+            'create': [],
+            'update': [{'type': 'image_check', 'resource': {'video_key': 'def'}}],
+            'delete': [{'type': 'videos', 'resource': {'video_key': 'abc'}}],
+        })
+
+    def test_noop_and_creates(self):
+        """No-op updates are dropped and creates for the same SMS id are merged."""
+        merged = merge_jobs([{
+            'create': [
+                {'type': 'videos', 'resource': {'title': 'a', 'custom': {'sms_media_id': 'm:1:'}}},
+                {'type': 'videos', 'resource': {'title': 'b', 'custom': {'sms_media_id': 'm:1:'}}},
+            ],
+            'update': [{'type': 'videos', 'resource': {'video_key': 'abc', 'custom': {}}}],
+        }])
+
+        self.assertEqual(merged['create'], [
+            {'type': 'videos', 'resource': {'title': 'b', 'custom': {'sms_media_id': 'm:1:'}}},
+        ])
+        self.assertEqual(merged['update'], [])
+
+    def test_command(self):
+        """The mergejobs command combines several job files."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for index, title in enumerate(['one', 'two']):
+                paths.append(os.path.join(tmp_dir, 'job{}.json'.format(index)))
+                with open(paths[-1], 'w') as f:
+                    json.dump({'update': [
+                        {'type': 'videos', 'resource': {'video_key': 'abc', 'title': title}},
+                    ]}, f)
+            output = os.path.join(tmp_dir, 'merged.json')
+
+            run('mergejobs', '--output=' + output, *paths)
+
+            with open(output) as f:
+                merged = json.load(f)
+
+        self.assertEqual(merged['update'], [
+            {'type': 'videos', 'resource': {'video_key': 'abc', 'title': 'two'}},
+        ])
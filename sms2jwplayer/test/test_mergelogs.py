@@ -0,0 +1,62 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from testfixtures import LogCapture
+
+from sms2jwplayer import mergelogs
+
+from .test_fakeapi import run
+
+
+class MergeLogsTests(unittest.TestCase):
+    def test_merge(self):
+        """Responses are concatenated and deferred jobs merged."""
+        job = {'type': 'videos', 'resource': {'video_key': 'abc', 'title': 'x'}}
+        merged = mergelogs.merge_logs([
+            {'update_responses': [1], 'shard': {'index': 0, 'count': 2}},
+            {'update_responses': [2], 'delete_responses': [3],
+             'deferred': {'update': [job]}, 'shard': {'index': 1, 'count': 2}},
+        ])
+
+        self.assertEqual(merged, {
+            'create_responses': [],
+            'update_responses': [1, 2],
+            'delete_responses': [3],
+            'deferred': {'create': [], 'update': [job], 'delete': []},
+        })
+
+    def test_missing_shards(self):
+        """Missing and repeated shards are warned about."""
+        with self.assertLogs(mergelogs.LOG, 'WARNING') as logs:
+            mergelogs.check_shards([
+                {'index': 0, 'count': 3}, {'index': 0, 'count': 3}, {'index': 2, 'count': 3},
+            ])
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('missing shard(s): 1', logs.output[0])
+        self.assertIn('repeat shard(s): 0', logs.output[1])
+
+    def test_load_journal(self):
+        """Journals are loaded one log per line."""
+        lines = [{'shard': {'index': 0, 'count': 1}}, {'update_responses': [1]}]
+        logs = mergelogs.load_logs(io.StringIO(''.join(json.dumps(line) + '\n' for line in lines)))
+        self.assertEqual(logs, lines)
+
+    def test_appended_journal(self):
+        """A journal appended to by several runs of one shard is not a repeated shard."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            journal = os.path.join(tmp_dir, 'journal')
+            with open(journal, 'w') as f:
+                for responses in ([1], [2]):
+                    f.write(json.dumps({'shard': {'index': 0, 'count': 1}}) + '\n')
+                    f.write(json.dumps({'update_responses': responses}) + '\n')
+            output = os.path.join(tmp_dir, 'merged.json')
+
+            with LogCapture() as log:
+                run('mergelogs', '--output=' + output, journal)
+            with open(output) as f:
+                merged = json.load(f)
+
+        self.assertEqual(merged['update_responses'], [1, 2])
+        self.assertNotIn('WARNING', [record.levelname for record in log.records])
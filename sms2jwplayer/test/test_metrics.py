@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+import unittest
+
+from sms2jwplayer import metrics
+
+from .test_fakeapi import FakeAPITestCase, run
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+
+    def test_summary(self):
+        """Calls, retries, sleeps and jobs are summarised."""
+        self.metrics.record_call('videos/show', 0.2)
+        self.metrics.record_call('videos/show', 0.4, 'JWPlatformNotFoundError')
+        self.metrics.record_retry('rate_limit')
+        self.metrics.record_job(3)
+        self.metrics.sleep(0)
+
+        summary = self.metrics.summary()
+        self.assertEqual(summary['endpoints']['videos/show']['count'], 2)
+        self.assertAlmostEqual(summary['endpoints']['videos/show']['mean_seconds'], 0.3)
+        self.assertEqual(summary['endpoints']['videos/show']['outcomes'], {
+            'ok': 1, 'JWPlatformNotFoundError': 1})
+        self.assertEqual(summary['rate_limit_hits'], 1)
+        self.assertEqual(summary['jobs'], 3)
+
+    def test_prometheus_text(self):
+        """Latencies are exported as cumulative histograms."""
+        self.metrics.record_call('videos/show', 0.2)
+        self.metrics.record_call('videos/show', 100)
+
+        lines = self.metrics.prometheus_text().splitlines()
+        self.assertIn(
+            'sms2jwplayer_api_request_duration_seconds_bucket'
+            '{endpoint="videos/show",le="0.1"} 0', lines)
+        self.assertIn(
+            'sms2jwplayer_api_request_duration_seconds_bucket'
+            '{endpoint="videos/show",le="0.25"} 1', lines)
+        self.assertIn(
+            'sms2jwplayer_api_request_duration_seconds_bucket'
+            '{endpoint="videos/show",le="+Inf"} 2', lines)
+        self.assertIn(
+            'sms2jwplayer_api_requests_total{endpoint="videos/show",outcome="ok"} 2', lines)
+
+
+class ExportTests(FakeAPITestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.REGISTRY.reset()
+        self.addCleanup(setattr, metrics.REGISTRY, 'enabled', False)
+
+    def test_export(self):
+        """API calls made by a subcommand are exported when it exits."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            textfile = os.path.join(tmp_dir, 'metrics.prom')
+            json_file = os.path.join(tmp_dir, 'metrics.json')
+            run('fetch', 'videos', '--base-name=' + os.path.join(tmp_dir, 'videos_'),
+                '--metrics-textfile=' + textfile, '--metrics-json=' + json_file)
+
+            with open(json_file) as f:
+                summary = json.load(f)
+            with open(textfile) as f:
+                text = f.read()
+
+        self.assertGreater(summary['endpoints']['videos/list']['outcomes']['ok'], 0)
+        self.assertIn('endpoint="videos/list"', text)
@@ -0,0 +1,69 @@
+import os
+import pstats
+import sys
+import tempfile
+import tracemalloc
+import unittest
+
+from sms2jwplayer import profiling
+
+
+class StageTests(unittest.TestCase):
+    def test_disabled(self):
+        """Stages are not logged unless tracing is enabled."""
+        with self.assertLogs(profiling.LOG, 'INFO') as logs:
+            with profiling.stage('matching'):
+                pass
+            profiling.LOG.info('sentinel')
+        self.assertEqual(len(logs.output), 1)
+
+    def test_enabled(self):
+        """Wall time and memory are logged for each stage once tracing is enabled."""
+        level = profiling.LOG.level
+        self.addCleanup(profiling.LOG.setLevel, level)
+        self.addCleanup(tracemalloc.stop)
+        self.addCleanup(setattr, profiling, '_trace_stages', False)
+        profiling.enable_stage_tracing()
+
+        with self.assertLogs(profiling.LOG, 'INFO') as logs:
+            with profiling.stage('matching'):
+                [0] * 1000
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Stage "matching"', logs.output[0])
+        self.assertIn('MiB peak', logs.output[0])
+
+
+class ProfileTests(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'profile.out')
+
+    def test_deterministic(self):
+        """Deterministic profiles are written in the pstats format."""
+        with profiling.profile(self.path, 'deterministic'):
+            sorted(range(1000))
+        stats = pstats.Stats(self.path)
+        self.assertTrue(any(func[2] == "<built-in method builtins.sorted>"
+                            for func in stats.stats))
+
+    def test_sampling(self):
+        """Sampled stacks are written in the folded format."""
+        sampler = profiling.StackSampler()
+        sampler._sample(None, sys._getframe())
+        sampler._sample(None, sys._getframe())
+        sampler.write(self.path)
+
+        # Other threads may be running so look for the stack of this one
+        with open(self.path) as f:
+            samples = dict(line.rsplit(' ', 1) for line in f.read().splitlines())
+        stacks = [stack for stack in samples
+                  if stack.split(';')[-1].startswith('test_sampling (test_profiling.py:')]
+        self.assertEqual(len(stacks), 1)
+        self.assertEqual(samples[stacks[0]], '2')
+
+    def test_unknown_mode(self):
+        """Unknown profile modes are rejected."""
+        with self.assertRaises(ValueError):
+            with profiling.profile(self.path, 'magic'):
+                pass
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+
+from sms2jwplayer.snapshot import SnapshotStore
+
+from .test_fakeapi import FakeAPITestCase, VIDEOS_FIXTURE, run
+
+
+class SnapshotStoreTests(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.store = SnapshotStore(os.path.join(tmp_dir.name, 'snapshot.sqlite'))
+        self.addCleanup(self.store.close)
+        self.store.upsert('videos', VIDEOS_FIXTURE['videos'])
+
+    def test_resources(self):
+        """All resources can be retrieved."""
+        self.assertEqual(self.store.count('videos'), 3)
+        self.assertEqual(
+            sorted(v['key'] for v in self.store.resources('videos')), ['abc', 'def', 'ghi'])
+        self.assertEqual(self.store.count('channels'), 0)
+
+    def test_lookups(self):
+        """Resources can be looked up by key and SMS id."""
+        self.assertEqual(self.store.by_key('videos', 'def'), VIDEOS_FIXTURE['videos'][1])
+        self.assertIsNone(self.store.by_key('videos', 'xyz'))
+        self.assertEqual(set(self.store.by_keys('videos', ['abc', 'ghi', 'xyz'])), {'abc', 'ghi'})
+        self.assertEqual(
+            [v['key'] for v in self.store.by_entity_id('videos', 'media', 12)], ['ghi'])
+
+    def test_sorted_by_entity_id(self):
+        """Resources can be iterated in order of SMS id with unmanaged resources first."""
+        self.store.upsert('videos', [
+            {'key': 'jkl', 'custom': {'sms_media_id': 'media:0:'}}, {'key': 'mno', 'custom': {}},
+        ])
+        self.assertEqual(
+            [v['key'] for v in self.store.sorted_by_entity_id('videos', 'media')],
+            ['mno', 'jkl', 'abc', 'def', 'ghi'])
+
+    def test_upsert_replaces(self):
+        """Upserting a resource with an existing key replaces it."""
+        self.store.upsert('videos', [
+            {'key': 'abc', 'custom': {'sms_media_id': 'media:2:'}},
+        ])
+        self.assertEqual(self.store.count('videos'), 3)
+        self.assertEqual(self.store.by_entity_id('videos', 'media', 1), [])
+        self.assertEqual(
+            sorted(v['key'] for v in self.store.with_duplicate_entity_ids('videos', 'media')),
+            ['abc', 'def'])
+
+    def test_delete_fetched_before(self):
+        """Resources not refreshed by a fetch can be removed."""
+        self.store.upsert('videos', VIDEOS_FIXTURE['videos'][:1], fetched_at=1e12)
+        self.assertEqual(self.store.delete_fetched_before('videos', 1e12), 2)
+        self.assertEqual([v['key'] for v in self.store.resources('videos')], ['abc'])
+
+
+class FetchSnapshotTests(FakeAPITestCase):
+    def test_fetch_to_snapshot(self):
+        """Fetch can write to a snapshot instead of JSON files."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_fn = os.path.join(tmp_dir, 'snapshot.sqlite')
+            run('fetch', 'videos', '--snapshot=' + snapshot_fn)
+            with SnapshotStore(snapshot_fn) as store:
+                self.assertEqual(store.count('videos'), 3)
@@ -0,0 +1,53 @@
+import json
+import logging
+import os
+import tempfile
+import unittest.mock as mock
+
+from sms2jwplayer import main
+
+from .io import data_path
+from .test_fakeapi import FakeAPITestCase
+
+LOG = logging.getLogger(__name__)
+
+
+class SyncTests(FakeAPITestCase):
+    """
+    Test the sync subcommand against the fake JWPlatform API.
+
+    """
+    def test_sync(self):
+        """Videos are updated, channels created and videos inserted into channels."""
+        self.platform.videos['abc']['custom']['sms_media_id'] = 'media:8:'
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sync('--checkpoint-dir=' + tmp_dir)
+            self.assertEqual(set(os.listdir(tmp_dir)), {
+                'videos.json', 'channels.json', 'videos_job.json', 'channels_job.json',
+                'videos_in_channels_job.json',
+            })
+            with open(os.path.join(tmp_dir, 'videos.json')) as f:
+                self.assertEqual(len(json.load(f)['videos']), 3)
+
+        # The existing video for media id 8 was updated from the export
+        self.assertEqual(self.platform.videos['abc']['title'], 'foo')
+
+        # A channel was created for the collection and the video inserted into it
+        channels = list(self.platform.channels.values())
+        self.assertEqual(len(channels), 1)
+        self.assertEqual(channels[0]['custom']['sms_collection_id'], 'collection:12:')
+        self.assertEqual(self.platform.channel_videos[channels[0]['key']], ['abc'])
+
+
+def sync(*args):
+    """Call the sync command as if from command line."""
+    argv = [
+        'sms2jwplayer', 'sync', '--base=https://sms.example.com/',
+        '--base-image-url=https://sms.example.com/image/',
+        data_path('export_example.csv'), data_path('collection_export_example.csv'),
+    ]
+    argv.extend(args)
+    LOG.info('calling with argv: %r', argv)
+    with mock.patch('sys.argv', argv):
+        main()
@@ -0,0 +1,113 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from sms2jwplayer.tidy import duplicate_deletes, video_rank, write_delete_job
+
+from .test_fakeapi import run
+
+VIDEOS_FIXTURE = [
+    {'key': 'a1', 'mediatype': 'audio', 'custom': {'sms_media_id': 'media:1:'}},
+    {'key': 'v1', 'mediatype': 'video', 'custom': {'sms_media_id': 'media:1:'}},
+    {'key': 'w1', 'mediatype': 'video', 'custom': {'sms_media_id': 'media:1:'}},
+    {'key': 'i2', 'mediatype': 'image', 'custom': {'sms_media_id': 'media:2:'}},
+    {'key': 'j2', 'mediatype': 'image', 'custom': {'sms_media_id': 'media:2:'}},
+    {'key': 'i3', 'mediatype': 'image', 'custom': {'sms_media_id': 'media:3:'}},
+    {'key': 'a3', 'mediatype': 'audio', 'custom': {'sms_media_id': 'media:3:'}},
+    {'key': 'x', 'mediatype': 'video', 'custom': {}},
+    {'key': 'z', 'mediatype': 'video', 'custom': {'sms_clip_id': 'clip:4:'}},
+]
+
+CHANNELS_FIXTURE = [
+    {'key': 'c1', 'custom': {'sms_collection_id': 'collection:1:'}},
+    {'key': 'd1', 'custom': {'sms_collection_id': 'collection:1:'}},
+    {'key': 'c2', 'custom': {'sms_collection_id': 'collection:2:'}},
+    {'key': 'y', 'custom': {}},
+]
+
+
+class DuplicateDeletesTests(unittest.TestCase):
+    def test_videos(self):
+        """The preferred video for each media id is kept."""
+        deletes = duplicate_deletes(VIDEOS_FIXTURE, 'videos', 'media', rank=video_rank)
+        self.assertEqual(
+            [d['resource']['video_key'] for d in deletes], ['a1', 'w1', 'i3'])
+
+    def test_channels(self):
+        """The first channel for each collection id is kept."""
+        deletes = duplicate_deletes(CHANNELS_FIXTURE, 'channels', 'collection')
+        self.assertEqual(list(deletes), [{'type': 'channels', 'resource': {'channel_key': 'd1'}}])
+
+    def test_orphans(self):
+        """Managed resources without an id are deleted only if requested."""
+        deletes = duplicate_deletes(
+            VIDEOS_FIXTURE, 'videos', 'media', rank=video_rank, delete_orphans=True)
+        keys = [d['resource']['video_key'] for d in deletes]
+        self.assertIn('z', keys)
+
+        # Videos with no SMS custom properties are not managed by sms2jwplayer
+        self.assertNotIn('x', keys)
+
+    def test_incremental(self):
+        """Delete jobs are yielded before all resources are consumed."""
+        consumed = []
+
+        def videos():
+            for video in VIDEOS_FIXTURE:
+                consumed.append(video['key'])
+                yield video
+
+        next(duplicate_deletes(videos(), 'videos', 'media', rank=video_rank))
+        self.assertEqual(consumed, ['a1', 'v1'])
+
+    def test_write_delete_job(self):
+        """The written job is valid JSON."""
+        fobj = io.StringIO()
+        deletes = duplicate_deletes(CHANNELS_FIXTURE, 'channels', 'collection')
+        self.assertEqual(write_delete_job(fobj, deletes), 1)
+        self.assertEqual(json.loads(fobj.getvalue()), {
+            'delete': [{'type': 'channels', 'resource': {'channel_key': 'd1'}}]})
+
+
+class TidyCommandTests(unittest.TestCase):
+    def tidy(self, *args, videos=VIDEOS_FIXTURE):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metadata_fn = os.path.join(tmp_dir, 'metadata.json')
+            with open(metadata_fn, 'w') as f:
+                json.dump({'videos': videos, 'channels': CHANNELS_FIXTURE}, f)
+            output_fn = os.path.join(tmp_dir, 'output.json')
+            run('tidy', '--output=' + output_fn, *args, metadata_fn)
+            with open(output_fn) as f:
+                return json.load(f)['delete']
+
+    def test_tidy(self):
+        """The tidy command writes delete jobs for duplicate videos and channels."""
+        deletes = self.tidy()
+        self.assertEqual(
+            [d['resource'] for d in deletes],
+            [{'video_key': 'a1'}, {'video_key': 'w1'}, {'video_key': 'i3'},
+             {'channel_key': 'd1'}])
+
+    def test_unmanaged_orphans_survive(self):
+        """Only orphans with SMS custom properties are deleted."""
+        deletes = self.tidy('--delete-orphans')
+        keys = [d['resource'].get('video_key', d['resource'].get('channel_key')) for d in deletes]
+        self.assertIn('z', keys)
+        self.assertNotIn('x', keys)
+        self.assertNotIn('y', keys)
+
+    def test_max_deletes(self):
+        """No delete jobs are written if there would be more than --max-deletes."""
+        self.assertEqual(self.tidy('--delete-orphans', '--max-deletes=4'), [])
+        self.assertEqual(len(self.tidy('--delete-orphans', '--max-deletes=5')), 5)
+
+    def test_no_max_deletes_by_default(self):
+        """The number of delete jobs is not limited unless --max-deletes is given."""
+        videos = [
+            {'key': '{}{}'.format(prefix, n), 'mediatype': 'video',
+             'custom': {'sms_media_id': 'media:{}:'.format(n)}}
+            for n in range(150) for prefix in 'vw'
+        ]
+        self.assertEqual(len(self.tidy(videos=videos)), 151)
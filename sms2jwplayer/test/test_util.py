@@ -1,8 +1,12 @@
+import hashlib
+import tempfile
 from unittest import mock
 
-from io import StringIO
-
-from sms2jwplayer.util import upload_thumbnail_from_url, resource_for_entity_id
+from sms2jwplayer.imagecache import ImageCache
+from sms2jwplayer.util import (
+    upload_thumbnail_from_url, resource_for_entity_id, get_api_url_overrides, decode_id_set,
+    encode_id_set, decode_id_list, encode_id_list,
+    MAX_THUMBNAIL_SIZE, THUMBNAIL_TIMEOUT)
 
 from .util import JWPlatformTestCase
 
@@ -37,17 +41,16 @@ class UtilTests(JWPlatformTestCase):
             }
         }
 
-        urlopen = self.patch_and_start('urllib.request.urlopen')
-        urlopen.return_value = StringIO("image")
-
-        requests_post = self.patch_and_start('requests.post')
-        requests_post.return_value = mock.Mock()
-        requests_post.return_value.json.return_value = {"status": "ok"}
+        session = mock.Mock()
+        session.get.return_value.headers = {'Content-Type': 'image/jpeg'}
+        session.get.return_value.iter_content.return_value = [b'ima', b'ge']
+        session.post.return_value.json.return_value = {"status": "ok"}
 
         # test
 
         response = upload_thumbnail_from_url(
-            '3Kgs63f3', 'https://sms.cam.ac.uk/image/1393664', client=self.client
+            '3Kgs63f3', 'https://sms.cam.ac.uk/image/1393664', client=self.client,
+            session=session
         )
 
         # check
@@ -56,14 +59,60 @@ class UtilTests(JWPlatformTestCase):
 
         self.client.videos.thumbnails.update.assert_called_with(video_key='3Kgs63f3')
 
-        urlopen.assert_called_with('https://sms.cam.ac.uk/image/1393664')
+        session.get.assert_called_with(
+            'https://sms.cam.ac.uk/image/1393664', stream=True, timeout=THUMBNAIL_TIMEOUT)
+        session.get.return_value.close.assert_called_once_with()
+
+        args, kwargs = session.post.call_args
+        self.assertEqual(args, ('http://upload.jwplatform.com/v1/videos/upload',))
+        self.assertEqual(kwargs['params'], query)
+
+        # The body is a generator which streams the image
+        body = b''.join(kwargs['data'])
+        self.assertIn(b'filename="1393664"', body)
+        self.assertIn(b'Content-Type: image/jpeg\r\n\r\nimage\r\n', body)
+        boundary = kwargs['headers']['Content-Type'].split('boundary=')[1]
+        self.assertTrue(body.endswith('--{}--\r\n'.format(boundary).encode('ascii')))
+
+    def test_upload_thumbnail_from_url__too_large(self):
+        """Images larger than the size limit are not uploaded."""
+        self.client.videos.thumbnails.update.return_value = {'link': {
+            'protocol': 'http', 'address': 'upload.jwplatform.com', 'path': '/v1/videos/upload',
+            'query': {},
+        }}
+        session = mock.Mock()
+        session.get.return_value.headers = {'Content-Length': str(MAX_THUMBNAIL_SIZE + 1)}
 
-        requests_post.assert_called_with(
-            'http://upload.jwplatform.com/v1/videos/upload',
-            params=query,
-            files={'file': urlopen.return_value}
+        response = upload_thumbnail_from_url(
+            '3Kgs63f3', 'https://sms.cam.ac.uk/image/1393664', client=self.client,
+            session=session
         )
 
+        self.assertEqual(response['status'], 'error')
+        session.post.assert_not_called()
+
+    def test_upload_thumbnail_from_url__image_cache(self):
+        """Images are taken from the image cache if one is given."""
+        self.client.videos.thumbnails.update.return_value = {'link': {
+            'protocol': 'http', 'address': 'upload.jwplatform.com', 'path': '/v1/videos/upload',
+            'query': {},
+        }}
+        session = mock.Mock()
+        session.get.return_value.iter_content.return_value = [b'image']
+        session.post.return_value.json.return_value = {'status': 'ok'}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_cache = ImageCache(tmp_dir)
+            for video_key in ['abc', 'def']:
+                upload_thumbnail_from_url(
+                    video_key, 'https://sms.cam.ac.uk/image/1', client=self.client,
+                    session=session, image_md5=hashlib.md5(b'image').hexdigest(),
+                    image_cache=image_cache)
+                self.assertIn(b'image', b''.join(session.post.call_args[1]['data']))
+
+        self.assertEqual(session.get.call_count, 1)
+        self.assertEqual(session.post.call_count, 2)
+
     def test_resource_for_entity_id__success(self):
         """Test that a channel is found"""
 
@@ -110,3 +159,42 @@ class UtilTests(JWPlatformTestCase):
             ])
 
         self.assertEquals(channel, CHANNEL_FIXTURE)
+
+    def test_api_url_overrides(self):
+        """The port of JWPLAYER_API_URL defaults according to its scheme."""
+        for url, port in [('https://api.example.com', 443), ('http://127.0.0.1', 80),
+                          ('https://127.0.0.1:8443/', 8443)]:
+            with mock.patch.dict('os.environ', {'JWPLAYER_API_URL': url}):
+                self.assertEqual(get_api_url_overrides()['port'], port)
+
+    def test_id_set_round_trip(self):
+        """Sets of ids survive encoding and the encoding is more compact than a CSV list."""
+        for ids in [set(), {0}, {127, 128}, {1, 5, 1000000, 2 ** 40}, set(range(1000, 5000, 3))]:
+            self.assertEqual(decode_id_set(encode_id_set(ids)), ids)
+
+        ids = set(range(100000, 110000, 7))
+        self.assertLess(len(encode_id_set(ids)), len(','.join(str(i) for i in ids)) / 4)
+
+    def test_id_set_legacy(self):
+        """Comma separated lists of ids are decoded."""
+        self.assertEqual(decode_id_set('1,20,3'), {1, 3, 20})
+        self.assertEqual(decode_id_set(''), set())
+
+    def test_id_set_invalid(self):
+        with self.assertRaises(ValueError):
+            decode_id_set('~gA')
+        with self.assertRaises(ValueError):
+            encode_id_set([-1])
+
+    def test_id_list_round_trip(self):
+        """Lists of ids keep their order and repeats when encoded."""
+        for ids in [[], [0], [128, 127], [5, 1, 2 ** 40, 5, 0], list(range(5000, 1000, -3))]:
+            self.assertEqual(decode_id_list(encode_id_list(ids)), ids)
+        self.assertEqual(decode_id_list(encode_id_list(['3', '1'])), [3, 1])
+
+    def test_id_list_legacy(self):
+        """Comma separated lists of ids are decoded in order."""
+        self.assertEqual(decode_id_list('1,20,3'), [1, 20, 3])
+        self.assertEqual(decode_id_list(''), [])
+        with self.assertRaises(ValueError):
+            decode_id_list('^gA')
@@ -6,81 +6,165 @@ ways:
 - Each media id will have exactly one video associated with it with preference given to ones of
   type "video". Other videos will be deleted.
 
+- Each collection id will have exactly one channel associated with it. Other channels will be
+  deleted.
+
+- If --delete-orphans is given, videos without a media id and channels without a collection id
+  will be deleted if they have any other "sms_" custom property. Resources with no such property
+  are not managed by sms2jwplayer and are never deleted.
+
+As a safeguard, if --max-deletes is given and there would be more delete jobs than that, an error
+is logged and none are written. By default the number of delete jobs is not limited.
+
+Metadata is processed as a stream so that only the key of the preferred resource for each SMS id
+is held in memory. When several resources are equally preferred, the first one seen is kept.
+Delete jobs are spooled to a temporary file as soon as they are known.
+
 """
+import itertools
 import json
 import logging
+import tempfile
 
 from . import util
 
 
 LOG = logging.getLogger(__name__)
 
+#: Preference of video media types when choosing which of several videos with the same media id
+#: to keep. Lower values are preferred. Videos with other media types are never kept.
+MEDIATYPE_RANKS = {'video': 0, 'audio': 1}
+
+#: Rank of resources which may not be kept
+UNKEEPABLE = float('inf')
+
 
 def main(opts):
-    videos = []
-    for metadata_fn in opts['<metadata>']:
-        with open(metadata_fn) as f:
-            videos.extend(json.load(f).get('videos', []))
-    LOG.info('Loaded metadata for %s videos', len(videos))
+    # Imported here to keep start up of the tidy subcommand fast
+    from .snapshot import load_resources
+
+    delete_orphans = opts.get('--delete-orphans', False)
+
+    videos, n_videos = load_resources(opts, 'videos')
+    channels, n_channels = load_resources(opts, 'channels')
+    LOG.info('Tidying metadata for %s videos and %s channels', n_videos, n_channels)
 
-    with util.output_stream(opts) as fobj:
-        process_videos(opts, fobj, videos)
+    deletes = itertools.chain(
+        duplicate_deletes(videos, 'videos', 'media', rank=video_rank,
+                          delete_orphans=delete_orphans),
+        duplicate_deletes(channels, 'channels', 'collection', delete_orphans=delete_orphans),
+    )
 
+    max_deletes = opts.get('--max-deletes')
+    max_deletes = int(max_deletes) if max_deletes is not None else None
 
-def process_videos(opts, fobj, videos):
+    with tempfile.TemporaryFile('w+') as spool:
+        n_deletes = write_delete_job(spool, deletes)
+        LOG.info('Number of delete jobs: %s', n_deletes)
+
+        with util.output_stream(opts) as fobj:
+            if max_deletes is not None and n_deletes > max_deletes:
+                LOG.error('Not deleting %s resource(s) since this is more than the maximum of %s',
+                          n_deletes, max_deletes)
+                write_delete_job(fobj, [])
+            else:
+                spool.seek(0)
+                for line in spool:
+                    fobj.write(line)
+
+
+def video_rank(video):
+    """Return the rank of *video* from :py:data:`.MEDIATYPE_RANKS` or ``None``."""
+    return MEDIATYPE_RANKS.get(video.get('mediatype'))
+
+
+def duplicate_deletes(resources, data_type, entity_type, rank=None, delete_orphans=False):
     """
-    Process videos and write update job to fobj.
+    A generator which yields delete jobs for resources of *data_type* from *resources* which
+    share their sms_<entity_type>_id with another resource. Of each group of resources with the
+    same id, the one with the lowest rank is kept. *rank* is a callable taking a resource and
+    returning its rank or ``None`` if it may not be kept. If *rank* is ``None``, all resources
+    have the same rank. If *delete_orphans* is ``True``, delete jobs are also yielded for
+    resources with no id which are managed by sms2jwplayer as determined by
+    :py:func:`.is_managed`.
+
+    Each delete job is yielded as soon as the resource is known to be unwanted and only the key
+    and rank of the kept resource for each id is remembered.
 
     """
-    # Delete jobs
-    deletes = []
-
-    # Group videos by media id
-    videos_by_media_id = {}
-    n_grouped = 0
-    for video in videos:
-        media_id_prop = util.get_key_path(video, 'custom.sms_media_id')
-        if media_id_prop is None:
+    def delete(key):
+        return {'type': data_type, 'resource': {util.DELETE_KEY_PARAMS[data_type]: key}}
+
+    # Map from id to key and rank of the resource which is currently kept
+    kept = {}
+
+    # Map from id to keys of resources which should be deleted once a resource which may be
+    # kept is found
+    pending = {}
+
+    n_resources, n_orphans = 0, 0
+    for resource in resources:
+        n_resources += 1
+
+        id_prop = util.get_key_path(resource, 'custom.sms_{}_id'.format(entity_type))
+        if id_prop is None:
+            n_orphans += 1
+            if delete_orphans and is_managed(resource):
+                yield delete(resource['key'])
             continue
 
         try:
-            media_id = int(util.parse_custom_prop('media', media_id_prop))
+            entity_id = int(util.parse_custom_prop(entity_type, id_prop))
         except ValueError:
-            LOG.error('Could not parse media id prop: %s', media_id_prop)
+            LOG.error('Could not parse %s id prop: %s', entity_type, id_prop)
+            continue
+
+        resource_rank = rank(resource) if rank is not None else 0
+        resource_rank = resource_rank if resource_rank is not None else UNKEEPABLE
+
+        current = kept.get(entity_id)
+        if current is None:
+            kept[entity_id] = (resource['key'], resource_rank)
+            continue
+
+        if resource_rank < current[1]:
+            kept[entity_id] = (resource['key'], resource_rank)
+            unwanted_key = current[0]
         else:
-            group = videos_by_media_id.get(media_id, [])
-            group.append(video)
-            videos_by_media_id[media_id] = group
-            n_grouped += 1
-
-    LOG.info('Grouped %s videos by media id into %s groups', n_grouped, len(videos_by_media_id))
-    LOG.info('Videos without media id: %s', len(videos) - n_grouped)
-
-    for media_id, group in videos_by_media_id.items():
-        video_keys = set(video['key'] for video in group)
-        blessed_key = None
-
-        # Attempt to find a video clip first
-        for video in group:
-            if video['mediatype'] == 'video':
-                blessed_key = video['key']
-                break
-
-        # If failed, find an audio clip
-        if blessed_key is None:
-            for video in group:
-                if video['mediatype'] == 'audio':
-                    blessed_key = video['key']
-                    break
-
-        if blessed_key is None:
-            LOG.warning('Could not find video or audio media for media id %s', media_id)
+            unwanted_key = resource['key']
+
+        if kept[entity_id][1] == UNKEEPABLE:
+            pending.setdefault(entity_id, []).append(unwanted_key)
             continue
 
-        # Remove the blessed key from the video keys, the rest should be deleted
-        video_keys.remove(blessed_key)
-        for key in video_keys:
-            deletes.append({'type': 'videos', 'resource': {'video_key': key}})
+        yield delete(unwanted_key)
+        for key in pending.pop(entity_id, []):
+            yield delete(key)
 
-    LOG.info('Number of delete jobs: %s', len(deletes))
-    json.dump({'delete': deletes}, fobj)
+    for entity_id in pending:
+        LOG.warning('Could not find resource to keep for %s id %s', entity_type, entity_id)
+
+    LOG.info('Processed %s %s of which %s have no %s id', n_resources, data_type, n_orphans,
+             entity_type)
+
+
+def is_managed(resource):
+    """Return ``True`` if *resource* has any "sms_" custom property set by sms2jwplayer."""
+    return any(prop.startswith('sms_') for prop in resource.get('custom', {}))
+
+
+def write_delete_job(fobj, deletes):
+    """
+    Write an update job with the delete jobs from the iterable *deletes* to *fobj*. Each delete
+    job is written as it is taken from *deletes*. Returns the number of delete jobs written.
+
+    """
+    fobj.write('{"delete": [')
+    n_deletes = 0
+    for delete in deletes:
+        if n_deletes > 0:
+            fobj.write(', ')
+        json.dump(delete, fobj)
+        n_deletes += 1
+    fobj.write(']}')
+    return n_deletes
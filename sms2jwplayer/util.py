@@ -2,26 +2,54 @@
 The :py:mod:`~sms2jwplayer.util` module contains general utility functions for the rest of the
 program to use.
 
+Since every subcommand imports this module, heavyweight dependencies such as the jwplatform
+client, requests and the SMS CSV parser are imported within the functions which need them so
+that subcommands which do not talk to jwplayer start quickly.
+
 """
 
+import base64
 import contextlib
+import itertools
 import logging
 import os
 import re
 import sys
-import urllib
-
-import jwplatform
-import requests
+import threading
+import urllib.parse
 import time
 
-from sms2jwplayer.csv import MediaItem, CollectionItem
+from . import metrics
 
 LOG = logging.getLogger(__name__)
 
 #: regex for parsing a custom prop field
 CUSTOM_PROP_VALUE_RE = re.compile(r'^([a-z][a-z0-9_]*):(.*):$')
 
+#: Prefix of a set of ids in the compact encoding written by encode_id_set()
+COMPACT_ID_SET_PREFIX = '~'
+
+#: Prefix of an ordered list of ids in the compact encoding written by encode_id_list()
+COMPACT_ID_LIST_PREFIX = '^'
+
+#: Port used for each scheme of JWPLAYER_API_URL if the URL does not give one
+DEFAULT_API_PORTS = {'http': 80, 'https': 443}
+
+#: Name of the key parameter passed to the delete API for each data type
+DELETE_KEY_PARAMS = {'videos': 'video_key', 'channels': 'channel_key'}
+
+#: Maximum size in bytes of thumbnail images which are uploaded
+MAX_THUMBNAIL_SIZE = 10 * 1024 * 1024
+
+#: Number of bytes read from the source of a thumbnail image at a time while uploading it
+THUMBNAIL_CHUNK_SIZE = 64 * 1024
+
+#: Timeout in seconds for connecting to and reading from servers when transferring thumbnails
+THUMBNAIL_TIMEOUT = 60
+
+# Per-thread state such as pooled HTTP sessions
+_THREAD_LOCAL = threading.local()
+
 
 class JWPlatformClientError(RuntimeError):
     """
@@ -38,6 +66,8 @@ def get_jwplatform_client():
     JWPlatformClientError if credentials are not available
 
     """
+    import jwplatform
+
     api_key = os.environ.get('JWPLAYER_API_KEY')
     if api_key is None:
         raise JWPlatformClientError('Set jwplayer API key in JWPLAYER_API_KEY environment '
@@ -48,7 +78,43 @@ def get_jwplatform_client():
         raise JWPlatformClientError('Set jwplayer API secret in JWPLAYER_API_SECRET environment '
                                     'variable')
 
-    return jwplatform.Client(api_key, api_secret)
+    client = jwplatform.Client(api_key, api_secret, **get_api_url_overrides())
+
+    # Record the latency and outcome of each API call if metrics are to be exported
+    if metrics.REGISTRY.enabled:
+        client = metrics.InstrumentedClient(client, metrics.REGISTRY)
+
+    return client
+
+
+def get_api_url_overrides():
+    """
+    Examine the environment and return a dictionary of keyword arguments for jwplatform.Client
+    which point it at the host given in the JWPLAYER_API_URL environment variable. This allows the
+    tool to be run against a local stand-in for JWPlatform such as
+    :py:mod:`sms2jwplayer.test.fakeapi`. If the variable is not set, return an empty dictionary.
+
+    """
+    api_url = os.environ.get('JWPLAYER_API_URL')
+    if api_url is None:
+        return {}
+
+    parsed = urllib.parse.urlsplit(api_url)
+    return {
+        'scheme': parsed.scheme, 'host': parsed.hostname,
+        'port': parsed.port if parsed.port is not None else DEFAULT_API_PORTS[parsed.scheme],
+    }
+
+
+def get_v2_api_url(path):
+    """
+    Return the absolute URL of a path on the JWPlatform v2 API. The base URL may be overridden in
+    the same way as for :py:func:`.get_jwplatform_client` by the JWPLAYER_API_URL environment
+    variable.
+
+    """
+    base = os.environ.get('JWPLAYER_API_URL', 'https://api.jwplayer.com')
+    return base.rstrip('/') + '/v2/' + path.lstrip('/')
 
 
 @contextlib.contextmanager
@@ -96,6 +162,119 @@ def get_key_path(obj, keypath):
     return obj
 
 
+def encode_id_set(ids):
+    """
+    Encode the non-negative integer ids in the iterable *ids* as a compact string suitable for a
+    custom prop. The ids are sorted and the difference between each id and the previous one is
+    written as an unsigned LEB128 varint. The bytes are base64 encoded with the URL-safe alphabet
+    and prefixed by :py:data:`.COMPACT_ID_SET_PREFIX`. An empty set is encoded as the empty
+    string. The encoding may be decoded by :py:func:`.decode_id_set`.
+
+    """
+    deltas, previous = [], 0
+    for id_ in sorted({int(id_) for id_ in ids}):
+        if id_ < 0:
+            raise ValueError('Cannot encode negative id: {}'.format(id_))
+        deltas.append(id_ - previous)
+        previous = id_
+
+    if len(deltas) == 0:
+        return ''
+    return COMPACT_ID_SET_PREFIX + _encode_varints(deltas)
+
+
+def decode_id_set(value):
+    """
+    Return the set of integer ids encoded in *value* by :py:func:`.encode_id_set`. For backwards
+    compatibility, *value* may also be a comma separated list of ids. Raises ValueError if
+    *value* is malformed.
+
+    """
+    value = value.strip()
+    if value == '':
+        return set()
+    if not value.startswith(COMPACT_ID_SET_PREFIX):
+        return {int(id_) for id_ in value.split(',')}
+
+    return set(itertools.accumulate(_decode_varints(value[len(COMPACT_ID_SET_PREFIX):], value)))
+
+
+def encode_id_list(ids):
+    """
+    As :py:func:`.encode_id_set` but the order of the integer ids in the iterable *ids*, and any
+    repeated ids, are preserved. The difference between each id and the previous one is
+    zigzag encoded so that ids may decrease. The string is prefixed by
+    :py:data:`.COMPACT_ID_LIST_PREFIX`. The encoding may be decoded by
+    :py:func:`.decode_id_list`.
+
+    """
+    deltas, previous = [], 0
+    for id_ in (int(id_) for id_ in ids):
+        delta, previous = id_ - previous, id_
+        deltas.append(delta * 2 if delta >= 0 else -delta * 2 - 1)
+
+    if len(deltas) == 0:
+        return ''
+    return COMPACT_ID_LIST_PREFIX + _encode_varints(deltas)
+
+
+def decode_id_list(value):
+    """
+    Return the list of integer ids encoded in *value* by :py:func:`.encode_id_list`. For
+    backwards compatibility, *value* may also be a comma separated list of ids. Raises
+    ValueError if *value* is malformed.
+
+    """
+    value = value.strip()
+    if value == '':
+        return []
+    if not value.startswith(COMPACT_ID_LIST_PREFIX):
+        return [int(id_) for id_ in value.split(',')]
+
+    deltas = _decode_varints(value[len(COMPACT_ID_LIST_PREFIX):], value)
+    return list(itertools.accumulate(
+        delta // 2 if delta % 2 == 0 else -(delta + 1) // 2 for delta in deltas))
+
+
+def _encode_varints(values):
+    """
+    Return the non-negative integers in *values* written as unsigned LEB128 varints and base64
+    encoded with the URL-safe alphabet without padding.
+
+    """
+    data = bytearray()
+    for value in values:
+        while value >= 0x80:
+            data.append((value & 0x7f) | 0x80)
+            value >>= 7
+        data.append(value)
+    return base64.urlsafe_b64encode(bytes(data)).decode('ascii').rstrip('=')
+
+
+def _decode_varints(encoded, value):
+    """
+    Return the list of integers encoded by :py:func:`._encode_varints` in *encoded* which is
+    part of *value*. Raises ValueError if *encoded* is malformed.
+
+    """
+    try:
+        data = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid id encoding: {}'.format(value)) from e
+
+    decoded, current, shift = [], 0, 0
+    for byte in data:
+        current |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        decoded.append(current)
+        current, shift = 0, 0
+    if shift != 0:
+        raise ValueError('Truncated id encoding: {}'.format(value))
+    return decoded
+
+
 def parse_custom_prop(expected_type, field):
     """
     Parses a custom prop content of the form "<type>:<value>:". Returns the value tuple.
@@ -120,11 +299,13 @@ class VideoNotFoundError(RuntimeError):
     """
 
 
-def key_for_media_id(media_id, client=None):
+def key_for_media_id(media_id, client=None, snapshot=None):
     """
     :param media_id: media id of the SMS item to match the JWPlatform video
     :param client: (options) an authenticated JWPlatform client as returned by
         :py:func:`.get_jwplatform_client`. If ``None``, call :py:func:`.get_jwplatform_client`.
+    :param snapshot: (optional) a :py:class:`~sms2jwplayer.snapshot.SnapshotStore` to consult
+        before querying JWPlatform.
     :raises: :py:class:`.VideoNotFoundError`
         if the clip id does not correspond to a JWPlatform video.
     :return: The key of a JWPlatform video matching the media id
@@ -136,7 +317,7 @@ def key_for_media_id(media_id, client=None):
         :py:func:`.get_jwplatform_client`. If ``None``, call :py:func:`.get_jwplatform_client`.
 
     """
-    video = resource_for_entity_id('videos', 'media', media_id, client)
+    video = resource_for_entity_id('videos', 'media', media_id, client, snapshot)
 
     # If no channel found, raise error
     if video is None:
@@ -155,16 +336,18 @@ class ChannelNotFoundError(RuntimeError):
     """
 
 
-def key_for_collection_id(collection_id, client=None):
+def key_for_collection_id(collection_id, client=None, snapshot=None):
     """
     :param collection_id: collection id of the SMS item to match the JWPlatform video
     :param client: (options) an authenticated JWPlatform client as returned by
         :py:func:`.get_jwplatform_client`. If ``None``, call :py:func:`.get_jwplatform_client`.
+    :param snapshot: (optional) a :py:class:`~sms2jwplayer.snapshot.SnapshotStore` to consult
+        before querying JWPlatform.
     :raises: :py:class:`.ChannelNotFoundError`
         if the clip id does not correspond to a JWPlatform channel.
     :return: The key of a JWPlatform channel matching the collection id
     """
-    channel = resource_for_entity_id('channels', 'collection', collection_id, client)
+    channel = resource_for_entity_id('channels', 'collection', collection_id, client, snapshot)
 
     # If no channel found, raise error
     if channel is None:
@@ -177,7 +360,7 @@ def key_for_collection_id(collection_id, client=None):
     return channel['key']
 
 
-def resource_for_entity_id(resource_type, entity_type, id, client=None):
+def resource_for_entity_id(resource_type, entity_type, id, client=None, snapshot=None):
     """
     Retrieve JWPlatform resource matching an SMS entity id stored in it's custom params
 
@@ -186,7 +369,34 @@ def resource_for_entity_id(resource_type, entity_type, id, client=None):
     :param id: the SMS entity id
     :param client: (options) an authenticated JWPlatform client as returned by
         :py:func:`.get_jwplatform_client`. If ``None``, call :py:func:`.get_jwplatform_client`.
+    :param snapshot: (optional) a :py:class:`~sms2jwplayer.snapshot.SnapshotStore`. If a
+        matching resource is found in the snapshot, it is returned without querying JWPlatform.
+        Since the snapshot may be stale, JWPlatform is still queried if there is no match.
     :return: The JWPlatform resource matching the SMS entity id or None
+    """
+    matching = []
+    if snapshot is not None:
+        matching = snapshot.by_entity_id(resource_type, entity_type, id)
+
+    if len(matching) == 0:
+        matching = search_resources_for_entity_id(resource_type, entity_type, id, client)
+
+    if len(matching) == 0:
+        # no matches are found
+        return None
+
+    if len(matching) > 1:
+        # too many matches are found
+        LOG.warning('{} {} matches at least 2 {}'.format(entity_type, id, resource_type))
+
+    return matching[0]
+
+
+def search_resources_for_entity_id(resource_type, entity_type, id, client=None):
+    """
+    Search JWPlatform for resources matching an SMS entity id stored in their custom params and
+    return a list of matches. Parameters are as for :py:func:`.resource_for_entity_id`.
+
     """
     client = client if client is not None else get_jwplatform_client()
 
@@ -200,33 +410,55 @@ def resource_for_entity_id(resource_type, entity_type, id, client=None):
     })
 
     # Find all resources with matching entity id
-    matching = [
+    return [
         resource for resource in response.get(resource_type, [])
         if resource.get('custom', {}).get(entity_id_name) == entity_id_value
     ]
 
-    if len(matching) == 0:
-        # no matches are found
-        return None
 
-    if len(matching) > 1:
-        # too many matches are found
-        LOG.warning('{} {} matches at least 2 {}'.format(entity_type, id, resource_type))
+class ThumbnailTooLargeError(RuntimeError):
+    """
+    The thumbnail image is larger than :py:data:`.MAX_THUMBNAIL_SIZE`.
+    """
 
-    return matching[0]
 
+def get_http_session():
+    """
+    Return a :py:class:`requests.Session` for the calling thread. Sessions are re-used so that
+    connections to the same host are pooled between requests.
 
-def upload_thumbnail_from_url(video_key, image_url, delay=None, client=None):
+    """
+    session = getattr(_THREAD_LOCAL, 'session', None)
+    if session is None:
+        import requests
+        session = requests.Session()
+        _THREAD_LOCAL.session = session
+    return session
+
+
+def upload_thumbnail_from_url(video_key, image_url, delay=None, client=None, session=None,
+                              image_md5=None, image_cache=None):
     """
     Updates the thumbnail for a particular video object with the image at image_url.
 
+    The image is streamed from image_url to jwplayer in chunks of :py:data:`.THUMBNAIL_CHUNK_SIZE`
+    bytes rather than being read into memory. Images larger than :py:data:`.MAX_THUMBNAIL_SIZE`
+    are not uploaded and an error response is returned instead.
+
     :param video_key: <string> Video's object ID. Can be found within JWPlayer Dashboard.
     :param image_url: The public URL on the image to use as a thumbnail
     :param delay: delay (in seconds) to apply between API calls
     :param client: (options) an authenticated JWPlatform client as returned by
         :py:func:`.get_jwplatform_client`. If ``None``, call :py:func:`.get_jwplatform_client`.
+    :param session: (optional) the :py:class:`requests.Session` used to download and upload the
+        image. If ``None``, call :py:func:`.get_http_session`.
+    :param image_md5: (optional) the MD5 hash of the image as recorded in SMS
+    :param image_cache: (optional) an :py:class:`~sms2jwplayer.imagecache.ImageCache`. If this
+        and image_md5 are given, the image is read from the cache rather than downloaded each
+        time.
     """
     client = client if client is not None else get_jwplatform_client()
+    session = session if session is not None else get_http_session()
 
     response = client.videos.thumbnails.update(video_key=video_key)
     if delay:
@@ -238,23 +470,102 @@ def upload_thumbnail_from_url(video_key, image_url, delay=None, client=None):
     # add required 'api_format' to the upload query params
     response['link']['query']['api_format'] = 'json'
 
-    files = {'file': urllib.request.urlopen(image_url)}
+    filename = os.path.basename(urllib.parse.urlsplit(image_url).path) or 'image'
 
-    return requests.post(url, params=response['link']['query'], files=files).json()
+    if image_cache is not None and image_md5:
+        from .imagecache import ImageTooLargeError, read_chunks
 
+        try:
+            with image_cache.open(image_md5, image_url, session,
+                                  max_size=MAX_THUMBNAIL_SIZE) as image:
+                return _post_thumbnail(
+                    session, url, response['link']['query'], filename, image.content_type,
+                    read_chunks(image.path), image_url)
+        except ImageTooLargeError:
+            return _thumbnail_too_large(image_url)
 
+    source = session.get(image_url, stream=True, timeout=THUMBNAIL_TIMEOUT)
+    try:
+        source.raise_for_status()
+
+        length = source.headers.get('Content-Length')
+        if length is not None and int(length) > MAX_THUMBNAIL_SIZE:
+            return _thumbnail_too_large(image_url)
+
+        return _post_thumbnail(
+            session, url, response['link']['query'], filename,
+            source.headers.get('Content-Type', 'application/octet-stream'),
+            source.iter_content(THUMBNAIL_CHUNK_SIZE), image_url)
+    finally:
+        source.close()
+
+
+def _post_thumbnail(session, url, params, filename, content_type, chunks, image_url):
+    """
+    Upload the image whose content is the iterable of byte strings *chunks* to the jwplayer
+    upload *url* and return the decoded response.
+
+    """
+    import uuid
+
+    boundary = uuid.uuid4().hex
+    body = _multipart_file_body(boundary, 'file', filename, content_type, chunks)
+    try:
+        upload = session.post(
+            url, params=params, data=body, timeout=THUMBNAIL_TIMEOUT,
+            headers={'Content-Type': 'multipart/form-data; boundary=' + boundary})
+    except ThumbnailTooLargeError:
+        return _thumbnail_too_large(image_url)
+    return upload.json()
+
+
+def _thumbnail_too_large(image_url):
+    LOG.warning('Not uploading thumbnail larger than %s bytes: %s', MAX_THUMBNAIL_SIZE, image_url)
+    return {
+        'status': 'error', 'code': 'ThumbnailTooLarge',
+        'message': 'Thumbnail larger than {} bytes: {}'.format(MAX_THUMBNAIL_SIZE, image_url),
+    }
+
+
+def _multipart_file_body(boundary, name, filename, content_type, chunks):
+    """
+    A generator which yields a multipart/form-data request body containing a single file field
+    whose content is taken from the iterable of byte strings *chunks*. Raises
+    :py:class:`.ThumbnailTooLargeError` if the content exceeds :py:data:`.MAX_THUMBNAIL_SIZE`.
+
+    """
+    yield (
+        '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+        'Content-Type: {}\r\n\r\n'.format(boundary, name, filename, content_type)
+    ).encode('utf8')
+
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > MAX_THUMBNAIL_SIZE:
+            raise ThumbnailTooLargeError()
+        yield chunk
+
+    yield '\r\n--{}--\r\n'.format(boundary).encode('utf8')
+
+
+#: Map from data type to (sub command, jwplayer data type, name of SMS item type in
+#: :py:mod:`sms2jwplayer.csv`)
 DATA_TYPE_DICT = {
-    'videos': ('videos', 'videos', MediaItem),
-    'channels': ('channels', 'channels', CollectionItem),
-    'videos_in_channels': ('videos_in_channels', 'channels', CollectionItem)
+    'videos': ('videos', 'videos', 'MediaItem'),
+    'channels': ('channels', 'channels', 'CollectionItem'),
+    'videos_in_channels': ('videos_in_channels', 'channels', 'CollectionItem')
 }
 
 
 def get_data_type(opts):
     """Gets the type of JWPlayer data ('videos' or 'channels' or 'videos_in_channels')
     from the CL options"""
-    return next(
+    from sms2jwplayer import csv as smscsv
+
+    sub_cmd, data_type, item_type_name = next(
         DATA_TYPE_DICT[data_type]
         for data_type in ('videos', 'channels', 'videos_in_channels')
         if opts.get(data_type, False)
     )
+    return sub_cmd, data_type, getattr(smscsv, item_type_name)